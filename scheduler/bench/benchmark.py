@@ -0,0 +1,143 @@
+"""Offline end-to-end benchmark of the scheduler against the mock VCD/IAM server.
+
+Runs the real vmscheduler code paths, Environment, refresh_tags, the
+ActionExecutor and the TaskTracker, against bench.mock_vcd and reports
+refresh time, action dispatch latency, time to powered on and requests per
+cycle. For example:
+
+    python -m bench.benchmark --vms 3000 --latency 0.02 --actions 200
+"""
+
+import argparse
+import logging
+import os
+import time
+
+from types import SimpleNamespace
+
+from bench import mock_vcd
+
+
+def parse_arg() -> argparse.Namespace:
+    """Parse input arguments.
+
+    Returns:
+        argparse object with parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(prog="benchmark")
+
+    parser.add_argument("--vms", type=int, default=3000, help="Number of Virtual Machines (up to 50000)")
+    parser.add_argument("--vapp-size", type=int, default=5, help="Virtual Machines per vApp")
+    parser.add_argument("--tagged", type=float, default=0.5, help="Fraction of tagged Virtual Machines")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 503")
+    parser.add_argument("--unauthorized-rate", type=float, default=0.0, help="Fraction of VCD requests failing with 401")
+    parser.add_argument("--actions", type=int, default=200, help="Number of power actions dispatched")
+    parser.add_argument("--modes", default="metadata,query", help="Discovery modes to measure")
+    parser.add_argument("--changes", type=int, default=20, help="Virtual Machines retagged before an incremental refresh")
+    parser.add_argument("--task-duration", type=float, default=2.0, help="Seconds until a power task succeeds")
+
+    return parser.parse_args()
+
+
+def report(name: str, elapsed: float, cloud: mock_vcd.MockCloud, extra: str = ""):
+    counts = cloud.reset_counts()
+    total = sum(counts.values())
+    detail = ", ".join(f"{endpoint} {count}" for endpoint, count in sorted(counts.items()))
+    print(f"{name:<28} {elapsed:8.2f}s {total:7d} requests {cloud.reset_bytes() / 1024:9.0f} KiB  {extra}")
+    print(f"{'':<28} {detail}")
+
+
+def main() -> int:
+
+    args = parse_arg()
+    cloud = mock_vcd.MockCloud(vms=args.vms, vapp_size=args.vapp_size, tagged=args.tagged, latency=args.latency,
+                               error_rate=args.error_rate, unauthorized_rate=args.unauthorized_rate, task_duration=args.task_duration)
+    mock_vcd.start(cloud)
+
+    # The API base URLs are read when the scheduler modules are imported
+    os.environ.update({
+        "ibmcloud_api_key": "mock",
+        "ibmcloud_region": "eu-de",
+        "ibmcloud_vcfaas_site": mock_vcd.site_name,
+        "ibmcloud_iam_url": cloud.base_url,
+        "ibmcloud_vcfaas_url": cloud.base_url,
+    })
+
+    import vmscheduler
+    import lib.metadata_cache as metadata_cache
+    import lib.tag_store as tag_store
+    import lib.tasks as tasks
+    from lib.actions import ActionExecutor
+    from lib.tasks import TaskTracker, percentile
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{args.vms} Virtual Machines, {args.latency * 1000:.0f} ms latency, "
+          f"{args.error_rate:.0%} errors, {args.unauthorized_rate:.0%} unauthorized")
+
+    # Authentication and discovery
+
+    start = time.monotonic()
+    env = vmscheduler.Environment(vmscheduler.load_sites()[0])
+    report("environment", time.monotonic() - start, cloud)
+
+    # Tag refresh, a second metadata refresh is served from the metadata cache
+
+    ns = SimpleNamespace(env=env, shard=None, metadata_cache=metadata_cache.MetadataCache(), metadata_fetched={},
+                         inventory=tag_store.Inventory(version=0, tags=tag_store.TagStore().freeze(), published=time.time()))
+    vm_tags = []
+    for mode in args.modes.split(","):
+        vmscheduler.discovery_mode = mode
+        for run in ("cold", "warm") if mode == "metadata" else ("cold",):
+            # Every run fetches all metadata, the slower cadence of VMs without an action due is not measured
+            ns.metadata_fetched.clear()
+            start = time.monotonic()
+            vm_tags, vm_count = vmscheduler.refresh_tags(ns)
+            report(f"refresh {mode} {run}", time.monotonic() - start, cloud,
+                   f"{len(vm_tags)} tags from {vm_count} VMs")
+
+    # Incremental refresh of the Virtual Machines retagged since the watermark
+
+    ns.inventory = tag_store.Inventory(version=0, tags=vm_tags.freeze(), published=time.time())
+    watermark = vmscheduler.audit_timestamp(time.time() - 1)
+    for n in range(0, args.vms, max(args.vms // max(args.changes, 1), 1))[:args.changes]:
+        cloud.retag(n, not cloud.metadata(n)["metadataEntry"])
+    start = time.monotonic()
+    changed_tags, vm_count, watermark, _ = vmscheduler.refresh_changed_tags(ns, watermark)
+    diff = changed_tags.diff(vm_tags)
+    report("refresh incremental", time.monotonic() - start, cloud,
+           f"{len(changed_tags)} tags, {vm_count} VMs re-fetched, {len(diff.added)} added, {len(diff.removed)} removed")
+
+    # Action dispatch
+
+    actions = [tag for tag in vm_tags if tag["key"] == "ibm.manage.up"][:args.actions]
+    tracker = TaskTracker(env)
+    executor = ActionExecutor(workers=vmscheduler.action_workers, coalesce_vapps=vmscheduler.vapp_coalescing,
+                              admission=vmscheduler.admission_controller(env.name), tracker=tracker)
+    cycle = time.time()
+    start = time.monotonic()
+    results = executor.run(env, actions)
+    latencies = [result["latency"] for result in results]
+    failed = sum(result["outcome"] == "failed" for result in results)
+    report("actions", time.monotonic() - start, cloud,
+           f"{len(actions)} actions, {len(results)} calls, {failed} failed, latency p50 "
+           f"{percentile(latencies, 50) or 0:.2f}s p99 {percentile(latencies, 99) or 0:.2f}s")
+
+    # Task tracking until every power-on task finished, polled every second instead of every poll_interval
+
+    tasks.poll_interval = 1
+    start = time.monotonic()
+    tracker.track(cycle, results)
+    while tracker.outstanding() and time.monotonic() - start < tasks.task_timeout:
+        time.sleep(0.1)
+    stats = tracker.percentiles(cycle)
+    report("tasks", time.monotonic() - start, cloud,
+           f"{stats['count']} powered on, time to powered on p50 {stats['p50'] or 0:.1f}s p99 {stats['p99'] or 0:.1f}s")
+
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    exit(main())
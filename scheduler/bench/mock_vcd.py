@@ -0,0 +1,409 @@
+"""Local stand-in for the IBM Cloud IAM, VCFaaS and VMware Cloud Director APIs.
+
+Emulates the endpoints used by the scheduler for a synthetic inventory so the
+real vmscheduler code paths can be measured without IBM Cloud credentials:
+
+- POST /identity/token
+- GET  /v1/director_sites, /v1/vdcs
+- POST /cloudapi/1.0.0/sessions
+- GET  /cloudapi/1.0.0/auditTrail (metadata and power events)
+- GET  /api/query?type=vm|task
+- GET  /api/vApp/vm-<n>/metadata (with ETag / If-None-Match)
+- GET  /api/vApp/vm-<n>, /api/vApp/vapp-<n>
+- POST /api/vApp/{vm,vapp}-<n>/power/action/powerOn|powerOff
+
+Latency, 5xx errors and 401s can be injected, every request is counted per
+endpoint class and responses are gzipped when the client accepts it.
+
+For example, to run the scheduler against it:
+
+    python -m bench.mock_vcd --vms 3000 --port 8080
+    export ibmcloud_iam_url=http://127.0.0.1:8080 ibmcloud_vcfaas_url=http://127.0.0.1:8080
+    export ibmcloud_api_key=mock ibmcloud_region=eu-de ibmcloud_vcfaas_site="Mock Site"
+    python vmscheduler.py
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from lib.requests_session import endpoint
+from lib.tags import boot_order_tag
+
+site_name = "Mock Site"
+org_name = "mock-org"
+up_cron = "0 8 * * 1-5"
+down_cron = "0 18 * * 1-5"
+
+
+def iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class MockCloud:
+
+    # Synthetic inventory and request accounting shared by the handler threads
+
+    def __init__(self, vms: int = 1000, vapp_size: int = 5, tagged: float = 0.5, template_every: int = 50,
+                 latency: float = 0.0, error_rate: float = 0.0, unauthorized_rate: float = 0.0,
+                 token_ttl: float = 1800, task_duration: float = 5.0, seed: int = 0):
+        self.vms = vms
+        self.vapp_size = vapp_size
+        self.tagged = tagged
+        self.template_every = template_every
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unauthorized_rate = unauthorized_rate
+        self.token_ttl = token_ttl
+        self.task_duration = task_duration
+        self.base_url = None
+
+        self._random = random.Random(seed)
+        self._tagged = [random.Random(seed + n).random() < tagged for n in range(vms)]
+        self._powered_on = [False] * vms
+        self._tokens = {}
+        self._tasks = {}
+        self._events = []
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.bytes_sent = 0
+
+    # Accounting
+
+    def count(self, name: str):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def count_bytes(self, size: int):
+        with self._lock:
+            self.bytes_sent += size
+
+    def reset_counts(self) -> dict:
+        with self._lock:
+            counts, self.requests = self.requests, {}
+        return counts
+
+    def reset_bytes(self) -> int:
+        with self._lock:
+            sent, self.bytes_sent = self.bytes_sent, 0
+        return sent
+
+    def inject(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def inject_unauthorized(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.unauthorized_rate
+
+    # Tokens
+
+    def issue_token(self, kind: str) -> SimpleNamespace:
+        token = SimpleNamespace(value=f"{kind}-{uuid.uuid4().hex}", expires=time.time() + self.token_ttl)
+        with self._lock:
+            self._tokens[token.value] = token
+        return token
+
+    def authorized(self, authorization: str) -> bool:
+        value = authorization[len("Bearer "):].split(";")[0] if authorization.startswith("Bearer ") else ""
+        with self._lock:
+            token = self._tokens.get(value)
+        return token is not None and token.expires > time.time()
+
+    # Inventory
+
+    def vm_href(self, n: int) -> str:
+        return f"{self.base_url}/api/vApp/vm-{n}"
+
+    def vapp_href(self, n: int) -> str:
+        return f"{self.base_url}/api/vApp/vapp-{n // self.vapp_size}"
+
+    def metadata(self, n: int, keys: list = None) -> dict:
+        entries = []
+        if self._tagged[n]:
+            for key, value in (("ibm.manage.up", up_cron), ("ibm.manage.down", down_cron)):
+                if keys is None or key in keys:
+                    entries.append({"key": key, "typedValue": {"_type": "MetadataStringValue", "value": value}})
+            # The first Virtual Machine of each vApp boots before the others
+            if n % self.vapp_size == 0 and (keys is None or boot_order_tag in keys):
+                entries.append({"key": boot_order_tag, "typedValue": {"_type": "MetadataNumberValue", "value": 1}})
+        return {"metadataEntry": entries}
+
+    def metadata_etag(self, n: int) -> str:
+        return '"' + hashlib.md5(json.dumps(self.metadata(n), sort_keys=True).encode()).hexdigest() + '"'
+
+    def vm_record(self, n: int) -> dict:
+        return {
+            "name": f"vm-{n:05d}",
+            "href": self.vm_href(n),
+            "status": "POWERED_ON" if self._powered_on[n] else "POWERED_OFF",
+            "container": self.vapp_href(n),
+            "containerName": f"vapp-{n // self.vapp_size}",
+            "vdc": f"{self.base_url}/api/vdc/vdc-{n % 4}",
+            "isVAppTemplate": self.template_every > 0 and n % self.template_every == self.template_every - 1,
+            "isInMaintenanceMode": False,
+            "isExpired": False,
+        }
+
+    def vm_records(self, filter: str, fields: list) -> list:
+        # A filter is a ; separated conjunction of optionally parenthesised , separated alternatives
+        clauses = [[a.split("==", 1) for a in c.strip("()").split(",") if "==" in a] for c in filter.split(";") if "==" in c]
+        metadata_keys = [f[len("metadata:"):] for f in fields if f.startswith("metadata:")]
+
+        candidates = range(self.vms)
+        for clause in clauses:
+            if all(field in ("name", "href") for field, _ in clause):
+                numbers = [value.rpartition("vm-")[2] for _, value in clause]
+                candidates = sorted({int(number) for number in numbers if number.isdigit()})
+                break
+
+        records = []
+        for n in candidates:
+            if not 0 <= n < self.vms:
+                continue
+            record = self.vm_record(n)
+            if not all(any(str(record.get(field)).lower() == value.lower() for field, value in clause) for clause in clauses):
+                continue
+            if fields:
+                record = {field: record[field] for field in record if field in fields or field == "href"}
+            if metadata_keys:
+                record["metadata"] = self.metadata(n, metadata_keys)
+            records.append(record)
+        return records
+
+    def retag(self, n: int, tagged: bool):
+        """Change the tags of a Virtual Machine, recording a metadata event in the audit trail"""
+
+        with self._lock:
+            self._tagged[n] = tagged
+            self._events.append({"eventType": "com/vmware/cloud/event/vm/metadata/modify", "timestamp": iso(time.time()),
+                                 "entity": {"id": f"urn:vcloud:vm:{n}", "name": f"vm-{n:05d}"}})
+
+    def audit_events(self, since: str) -> list:
+        with self._lock:
+            return [event for event in self._events if event["timestamp"] >= since]
+
+    def power(self, n_list: list, on: bool) -> dict:
+        task = {"href": f"{self.base_url}/api/task/{uuid.uuid4()}", "status": "running", "startTime": iso(time.time())}
+        with self._lock:
+            for n in n_list:
+                self._powered_on[n] = on
+                self._events.append({"eventType": f"com/vmware/cloud/event/vm/{'deploy' if on else 'undeploy'}",
+                                     "timestamp": task["startTime"], "entity": {"id": f"urn:vcloud:vm:{n}", "name": f"vm-{n:05d}"}})
+            self._tasks[task["href"]] = time.time()
+        return task
+
+    def task_record(self, href: str, started: float) -> dict:
+        finished = time.time() - started >= self.task_duration
+        return {
+            "href": href,
+            "status": "success" if finished else "running",
+            "startDate": iso(started),
+            "endDate": iso(started + self.task_duration) if finished else None,
+        }
+
+    def task_records(self, filter: str, fields: list) -> list:
+        # Only an href alternative is honoured, any other filter returns every task
+        hrefs = {a.partition("href==")[2] for a in filter.strip("()").split(",") if a.startswith("href==")}
+        with self._lock:
+            tasks = [(href, started) for href, started in self._tasks.items() if not hrefs or href in hrefs]
+
+        records = [self.task_record(href, started) for href, started in tasks]
+        if fields:
+            records = [{field: record[field] for field in record if field in fields or field == "href"} for record in records]
+        return records
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    # Routes the emulated endpoints, the MockCloud is set on the server
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body=None, headers: dict = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if len(data) > 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.server.cloud.count_bytes(len(data))
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method: str):
+        cloud = self.server.cloud
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        cloud.count(endpoint(f"{cloud.base_url}{self.path}"))
+        if cloud.latency:
+            time.sleep(cloud.latency)
+
+        if cloud.inject():
+            return self.reply(503, {"message": "injected error"})
+
+        # IBM Cloud IAM and VCFaaS
+
+        if path == "/identity/token" and method == "POST":
+            token = cloud.issue_token("iam")
+            return self.reply(200, {"access_token": token.value, "expires_in": int(cloud.token_ttl), "expiration": int(token.expires)})
+
+        if path.startswith("/v1/") and not cloud.authorized(self.headers.get("authorization", "")):
+            return self.reply(401, {"message": "unauthorized"})
+
+        if path == "/v1/director_sites":
+            return self.reply(200, {"director_sites": [{"id": "site-1", "name": site_name}]})
+
+        if path == "/v1/vdcs":
+            return self.reply(200, {"vdcs": [{"director_site": {"id": "site-1", "url": f"{cloud.base_url}/tenant/{org_name}"}, "org_name": org_name}]})
+
+        # VMware Cloud Director
+
+        if path == "/cloudapi/1.0.0/sessions" and method == "POST":
+            if not cloud.authorized(self.headers.get("Authorization", "")):
+                return self.reply(401, {"message": "unauthorized"})
+            token = cloud.issue_token("vcd")
+            return self.reply(200, {"id": "session"}, {"X-VMWARE-VCLOUD-ACCESS-TOKEN": token.value})
+
+        if cloud.inject_unauthorized() or not cloud.authorized(self.headers.get("Authorization", "")):
+            return self.reply(401, {"message": "unauthorized"})
+
+        if path == "/cloudapi/1.0.0/auditTrail":
+            page = int(query.get("page", 1))
+            page_size = int(query.get("pageSize", 25))
+            since = query.get("filter", "").partition("timestamp=ge=")[2]
+            events = cloud.audit_events(since)
+            return self.reply(200, {"resultTotal": len(events), "pageCount": max((len(events) + page_size - 1) // page_size, 1),
+                                    "page": page, "pageSize": page_size,
+                                    "values": events[(page - 1) * page_size:page * page_size]})
+
+        if path == "/api/query":
+            page = int(query.get("page", 1))
+            page_size = int(query.get("pageSize", 25))
+            fields = query["fields"].split(",") if query.get("fields") else []
+            if query.get("type") == "task":
+                records = cloud.task_records(query.get("filter", ""), fields)
+            else:
+                records = cloud.vm_records(query.get("filter", ""), fields)
+            return self.reply(200, {"total": len(records), "page": page, "pageSize": page_size,
+                                    "record": records[(page - 1) * page_size:page * page_size]})
+
+        parts = path.split("/")
+        if len(parts) >= 4 and parts[1] == "api" and parts[2] == "vApp":
+            kind, _, number = parts[3].partition("-")
+            if not number.isdigit():
+                return self.reply(404, {"message": "not found"})
+            n = int(number)
+
+            if kind == "vm" and n < cloud.vms:
+                if parts[4:] == ["metadata"]:
+                    etag = cloud.metadata_etag(n)
+                    if self.headers.get("If-None-Match") == etag:
+                        return self.reply(304, headers={"ETag": etag})
+                    return self.reply(200, cloud.metadata(n), {"ETag": etag})
+                if parts[4:6] == ["power", "action"] and method == "POST":
+                    return self.reply(202, cloud.power([n], parts[6] == "powerOn"))
+                if not parts[4:]:
+                    return self.reply(200, cloud.vm_record(n))
+
+            if kind == "vapp":
+                members = [m for m in range(n * cloud.vapp_size, (n + 1) * cloud.vapp_size) if m < cloud.vms]
+                if parts[4:6] == ["power", "action"] and method == "POST":
+                    return self.reply(202, cloud.power(members, parts[6] == "powerOn"))
+                if not parts[4:] and members:
+                    on = [cloud.vm_record(m)["status"] == "POWERED_ON" for m in members]
+                    status = 4 if all(on) else 8 if not any(on) else 10
+                    return self.reply(200, {"name": f"vapp-{n}", "href": cloud.vapp_href(members[0]), "status": status,
+                                            "children": {"vm": [{"href": cloud.vm_href(m)} for m in members]}})
+
+        return self.reply(404, {"message": "not found"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+def start(cloud: MockCloud, port: int = 0) -> ThreadingHTTPServer:
+    """Serve the mock APIs from a background thread
+
+    Args:
+        cloud: The synthetic inventory
+        port: The TCP port, 0 picks a free one
+
+    Returns:
+        The running server, its base URL is cloud.base_url
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.cloud = cloud
+    cloud.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="mock_vcd", daemon=True).start()
+    return server
+
+
+def parse_arg() -> argparse.Namespace:
+    """Parse input arguments.
+
+    Returns:
+        argparse object with parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(prog="mock_vcd")
+
+    parser.add_argument("--port", type=int, default=8080, help="TCP port to listen on")
+    parser.add_argument("--vms", type=int, default=1000, help="Number of Virtual Machines (up to 50000)")
+    parser.add_argument("--vapp-size", type=int, default=5, help="Virtual Machines per vApp")
+    parser.add_argument("--tagged", type=float, default=0.5, help="Fraction of tagged Virtual Machines")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 503")
+    parser.add_argument("--unauthorized-rate", type=float, default=0.0, help="Fraction of VCD requests failing with 401")
+    parser.add_argument("--token-ttl", type=float, default=1800, help="Lifetime in seconds of issued tokens")
+    parser.add_argument("--task-duration", type=float, default=5.0, help="Seconds until a power task succeeds")
+
+    return parser.parse_args()
+
+
+def main() -> int:
+
+    args = parse_arg()
+    cloud = MockCloud(vms=args.vms, vapp_size=args.vapp_size, tagged=args.tagged, latency=args.latency,
+                      error_rate=args.error_rate, unauthorized_rate=args.unauthorized_rate,
+                      token_ttl=args.token_ttl, task_duration=args.task_duration)
+    server = start(cloud, args.port)
+    print(f"Mock IAM/VCFaaS/VCD serving {args.vms} Virtual Machines on {cloud.base_url}")
+
+    try:
+        while True:
+            time.sleep(60)
+            print(f"Requests in the last minute: {cloud.reset_counts()}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    exit(main())
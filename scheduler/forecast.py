@@ -0,0 +1,112 @@
+# Forecast the power actions of a tag inventory over the coming days
+
+import argparse
+import csv
+import logging
+import os
+import time
+
+from datetime import datetime, timedelta
+
+import lib.forecast as forecast
+import lib.snapshot as snapshot
+import lib.tags as tags
+
+from lib.tag_store import Inventory, TagStore
+
+def parse_arg() -> argparse.Namespace:
+    """Parse input arguments.
+
+    Returns:
+        argparse object with parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__))
+
+    parser.add_argument("snapshots", nargs="*", help="Tag snapshot files written by the scheduler, eg, snapshots/*.json.gz")
+    parser.add_argument("--live", action="store_true", help="Discover the tags of the configured sites instead of reading snapshots")
+    parser.add_argument("--region", default=os.environ.get("ibmcloud_region"), help="VCFaaS Director region the tags are evaluated in.")
+    parser.add_argument("--days", type=int, default=7, help="Days to forecast")
+    parser.add_argument("--initial", choices=["infer", "on", "off"], default="infer",
+                        help="Power state of the Virtual Machines at the start, infer replays the previous week")
+    parser.add_argument("--top", type=int, default=10, help="Number of busiest minutes listed")
+    parser.add_argument("--csv", help="Write the actions per minute to this CSV file")
+
+    return parser.parse_args()
+
+def live_inventories() -> list:
+    """
+    Returns the region and tags of every configured site, discovered like the scheduler does
+    """
+
+    import vmscheduler
+    from types import SimpleNamespace
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    inventories = []
+    for site in vmscheduler.load_sites():
+        env = vmscheduler.Environment(site)
+        ns = SimpleNamespace(env=env, shard=None, metadata_cache=vmscheduler.metadata_cache.MetadataCache(), metadata_fetched={},
+                             inventory=Inventory(version=0, tags=TagStore().freeze(), published=time.time()))
+        vm_tags, _ = vmscheduler.refresh_tags(ns)
+        env.credentials.stop()
+        inventories.append((site['region'], vm_tags))
+
+    return inventories
+
+def main() -> int:
+
+    # parse input arguments
+    args = parse_arg()
+
+    if args.live:
+        inventories = live_inventories()
+    else:
+        if not args.snapshots:
+            print('ERROR: No snapshot files given, use --live to discover the tags')
+            exit(1)
+        if not tags.is_valid_region(args.region):
+            print(f'ERROR: {args.region} is not a registered region.')
+            exit(1)
+        logging.getLogger().setLevel(logging.WARNING)
+        inventories = [(args.region, TagStore(tag for path in args.snapshots for tag in snapshot.load(path)))]
+
+    for index, (region, vm_tags) in enumerate(inventories):
+        start_time = time.monotonic()
+        start = tags.get_now(region).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        result = forecast.forecast(vm_tags, start, args.days, args.initial)
+        elapsed = time.monotonic() - start_time
+
+        def local(timestamp: int) -> str:
+            return datetime.fromtimestamp(timestamp, start.tzinfo).strftime('%Y-%m-%d %H:%M %Z')
+
+        print(f'Forecast for region {region} from {start:%Y-%m-%d %H:%M %Z} over {args.days} days')
+        print(f'{result.tags} tags on {result.vms} Virtual Machines, {result.schedules} distinct schedules, computed in {elapsed:.2f} seconds')
+        print(f'Power-ons: {sum(ups for _, ups, _ in result.timeline)}, power-offs: {sum(downs for _, _, downs in result.timeline)}')
+        print(f'Peak power-ons in one minute: {result.peak_power_on[1]} at {local(result.peak_power_on[0])}')
+        print(f'Peak Virtual Machines powered on: {result.peak_powered_on[1]} at {local(result.peak_powered_on[0])}')
+        print(f'Projected powered on hours: {result.powered_on_hours:.0f}')
+
+        print('\nBusiest minutes:')
+        busiest = sorted(result.timeline, key=lambda row: row[1] + row[2], reverse=True)[:args.top]
+        for minute, ups, downs in sorted(busiest):
+            print(f'  {local(minute)}  {ups:6d} power-ons  {downs:6d} power-offs')
+
+        print('\nPer VDC:')
+        for vdc, totals in sorted(result.vdcs.items(), key=lambda item: str(item[0])):
+            peak = max(totals.on_minutes.items(), key=lambda item: item[1], default=(result.peak_power_on[0], 0))
+            print(f'  {vdc or "unknown"}: {totals.power_on} power-ons (peak {peak[1]}/minute at {local(peak[0])}), '
+                  f'{totals.power_off} power-offs, {totals.powered_on_hours:.0f} powered on hours')
+
+        if args.csv:
+            path = args.csv if len(inventories) == 1 else f'{os.path.splitext(args.csv)[0]}-{index}-{region}.csv'
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['minute', 'power_on', 'power_off'])
+                for minute, ups, downs in result.timeline:
+                    writer.writerow([datetime.fromtimestamp(minute, start.tzinfo).isoformat(), ups, downs])
+            print(f'\nWrote {len(result.timeline)} minutes to {path}')
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,385 @@
+"""Module with the power action executor.
+
+Due power actions are dispatched concurrently over a bounded worker pool and
+every action reports its outcome and latency. Power-offs are sent first and
+power-ons in boot order. With an admission controller, power-ons only take a
+worker once admitted and the task tracker releases their slots.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import requests
+
+import lib.cloud_director as cloud_director
+import lib.profiling as profiling
+import lib.requests_session as requests_session
+import lib.tracing as tracing
+
+log = logging.getLogger(__name__)
+
+
+def execute_action(env, action: dict) -> dict[str, Any]:
+    """Power a Virtual Machine on or off according to a due tag
+
+    Args:
+        env: The scheduler Environment
+        action: The due tag
+
+    Returns:
+        The action outcome with the keys action, outcome (powered_on,
+        powered_off, already_on, already_off, skipped or failed), task,
+        error and latency in seconds
+    """
+
+    result = {"action": action, "outcome": "skipped", "task": None, "error": None}
+    start = time.monotonic()
+
+    with tracing.span("power_action", href=action["vm_href"], key=action["key"]):
+        _execute_action(env, action, result)
+
+    result["latency"] = time.monotonic() - start
+    return result
+
+
+def _execute_action(env, action: dict, result: dict):
+    try:
+        log.info(f'Processing Actions:')
+        log.info(f'    Name: {action["name"]}')
+        log.info(f'    Key: {action["key"]}')
+        log.info(f'    Value: {action["value"]}')
+        log.info(f'    href: {action["vm_href"]}')
+
+        #Get current status, a coalesced vApp action carries the status read when coalescing
+        if action.get("vapp"):
+            log.info(f'    Virtual Machines: {len(action["members"])}')
+            status = action["status"]
+        else:
+            filter = f'name=={action["name"]}'
+            query_vms =  cloud_director.query_vm(director_url = env.director_url, 
+                                                vmware_access_token = env.vmware_access_token, 
+                                                filter = filter,
+                                                fields = ["name", "status"])
+            status = query_vms[0]["status"]
+
+        if action["key"] == 'ibm.manage.up':
+            if status == 'POWERED_ON':
+                log.info(f'WARNING: Virtual Machine: {action["name"]} was already powered on')
+                result["outcome"] = "already_on"
+            else:
+                log.info(f'Powering on Virtual Machine: {action["name"]}')
+                result["task"] = cloud_director.powerOn(action["vm_href"], env.vmware_access_token)
+                result["outcome"] = "powered_on"
+        elif action["key"]== 'ibm.manage.down':
+            if status in cloud_director.powered_off:
+                log.info(f'WARNING: Virtual Machine: {action["name"]} was already powered off')
+                result["outcome"] = "already_off"
+            else:
+                log.info(f'Powering off Virtual Machine: {action["name"]}')
+                result["task"] = cloud_director.powerOff(action["vm_href"], env.vmware_access_token)
+                result["outcome"] = "powered_off"
+    except requests.exceptions.HTTPError as e:
+        log.error(f'Failed to execute {action["key"]} on {action["vm_href"]}')
+        log.error(e)
+        result["outcome"] = "failed"
+        result["error"] = str(e)
+        if e.response is not None and e.response.status_code == 401:
+            env.rehydrate(e)
+    except Exception as e:
+        log.error(f'Failed to execute {action["key"]} on {action["vm_href"]}')
+        log.error(e)
+        result["outcome"] = "failed"
+        result["error"] = str(e)
+
+
+def chain(done: Future, future: Future):
+    """Complete a future with the outcome of a finished one"""
+
+    if done.exception() is not None:
+        future.set_exception(done.exception())
+    else:
+        future.set_result(done.result())
+
+
+def run_order(action: dict) -> tuple:
+    """Return the dispatch order of an action, power-offs first then power-ons by boot order"""
+
+    boot_order = action.get("boot_order")
+    return (action["key"] == 'ibm.manage.up', boot_order is None, boot_order or 0)
+
+
+def get_vapp_action(env, vapp_href: str, key: str, group: list) -> Optional[dict[str, Any]]:
+    """Return a single vApp action if the group covers every Virtual Machine of the vApp
+
+    Args:
+        env: The scheduler Environment
+        vapp_href: The href of the vApp
+        key: The tag key shared by the group
+        group: The due tags of Virtual Machines in the vApp
+
+    Returns:
+        The vApp action or None if the vApp holds other Virtual Machines or cannot be read
+    """
+
+    try:
+        try:
+            vapp = cloud_director.get_vapp_vm(vmware_access_token=env.vmware_access_token, href=vapp_href)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 401:
+                raise
+            # Discard the rejected token and read the vApp once more
+            env.rehydrate(e)
+            vapp = cloud_director.get_vapp_vm(vmware_access_token=env.vmware_access_token, href=vapp_href)
+    except requests.exceptions.RequestException as e:
+        log.error(f'Failed to retrieve vApp {vapp_href}, powering its Virtual Machines individually')
+        log.error(e)
+        return None
+
+    children = {vm["href"] for vm in (vapp.get("children") or {}).get("vm", [])}
+    if children != {action["vm_href"] for action in group}:
+        return None
+
+    boot_orders = [action.get("boot_order") for action in group if action.get("boot_order") is not None]
+
+    return {
+        "key": key,
+        "value": group[0]["value"],
+        "vm_href": vapp_href,
+        "name": vapp["name"],
+        "vdc": group[0].get("vdc"),
+        "boot_order": min(boot_orders, default=None),
+        "vapp": True,
+        "status": cloud_director.status.get(vapp.get("status"), "UNKNOWN"),
+        "members": group,
+    }
+
+
+class ActionExecutor:
+
+    # Bounded worker pool dispatching power actions concurrently
+
+    def __init__(self, workers: int, coalesce_vapps: bool = True, admission=None, tracker=None):
+        self.workers = workers
+        self.coalesce_vapps = coalesce_vapps
+        self.admission = admission
+        self.tracker = tracker
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="action")
+
+    def coalesce(self, env, actions: list) -> list:
+        """Replace the actions of a vApp whose Virtual Machines all share the same due action with one vApp action
+
+        Args:
+            env: The scheduler Environment
+            actions: The due tags
+
+        Returns:
+            The actions to execute
+        """
+
+        groups = {}
+        for action in actions:
+            if action.get("vapp_href"):
+                groups.setdefault((action["vapp_href"], action["key"]), []).append(action)
+
+        candidates = [(vapp_href, key, group) for (vapp_href, key), group in groups.items() if len(group) > 1]
+        futures = [tracing.submit(self._executor, get_vapp_action, env, *candidate) for candidate in candidates]
+        vapp_actions = [vapp_action for vapp_action in (future.result() for future in futures) if vapp_action]
+
+        coalesced = {id(member) for vapp_action in vapp_actions for member in vapp_action["members"]}
+        if vapp_actions:
+            log.info(f'Coalesced {len(coalesced)} Virtual Machine actions into {len(vapp_actions)} vApp actions')
+
+        return [action for action in actions if id(action) not in coalesced] + vapp_actions
+
+    def run(self, env, actions: list) -> list[dict[str, Any]]:
+        """Execute the actions concurrently and wait for all of them
+
+        Args:
+            env: The scheduler Environment
+            actions: The due tags
+
+        Returns:
+            The action outcomes, a coalesced vApp action reports a single outcome
+        """
+
+        start = time.monotonic()
+        with profiling.profiler.cycle("actions"), tracing.span("action_cycle", actions=len(actions)), \
+                requests_session.retry_budget():
+            if self.coalesce_vapps:
+                actions = self.coalesce(env, actions)
+
+            # The pool picks up actions in submission order, so boot order holds even without admission
+            futures = []
+            for action in sorted(actions, key=run_order):
+                if self.admission is not None and action["key"] == 'ibm.manage.up':
+                    futures.append(self.admit(env, action))
+                else:
+                    futures.append(tracing.submit(self._executor, execute_action, env, action))
+            results = [future.result() for future in futures]
+
+        summarise(results, time.monotonic() - start)
+        return results
+
+    def admit(self, env, action: dict) -> Future:
+        """Queue a power-on on the admission controller, it takes a worker once admitted
+
+        Args:
+            env: The scheduler Environment
+            action: The due tag
+
+        Returns:
+            The future of the action outcome
+        """
+
+        future = Future()
+        context = contextvars.copy_context()
+
+        def start(ticket):
+            # On the dispatcher thread, keep the retry budget and span of the batch
+            try:
+                submitted = context.run(tracing.submit, self._executor, self._power_on, env, action, ticket)
+            except Exception as e:
+                # The controller releases the ticket, eg, the pool shut down
+                future.set_result({"action": action, "outcome": "failed", "task": None, "error": str(e), "latency": 0})
+                raise
+            submitted.add_done_callback(lambda done: chain(done, future))
+
+        self.admission.enqueue(action, start)
+        return future
+
+    def _power_on(self, env, action: dict, ticket) -> dict[str, Any]:
+        try:
+            result = execute_action(env, action)
+        except Exception:
+            self.admission.release(ticket)
+            raise
+
+        # The slot covers the boot when limits are set, until the tracker sees the task finish
+        task = result["task"]
+        if self.admission.holds and self.tracker is not None and result["outcome"] == "powered_on" and task and "href" in task:
+            self.tracker.hold(task, lambda: self.admission.release(ticket))
+        else:
+            self.admission.release(ticket)
+
+        return result
+
+    def dispatch(self, env, actions: list, callback: Optional[Callable[[list], Any]] = None) -> threading.Thread:
+        """Execute the actions in the background so the caller keeps ticking
+
+        Args:
+            env: The scheduler Environment
+            actions: The due tags
+            callback: Called with the action outcomes once all actions finished
+
+        Returns:
+            The thread running the batch
+        """
+
+        def run_batch():
+            try:
+                results = self.run(env, actions)
+            except Exception as e:
+                # Report every action of the batch as failed so it is retried instead of silently lost
+                log.error(f'Failed to execute a batch of {len(actions)} actions')
+                log.exception(e)
+                results = [{"action": action, "outcome": "failed", "task": None, "error": str(e), "latency": 0} for action in actions]
+            if callback is not None:
+                callback(results)
+
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(run_batch,), name="dispatch", daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RetryQueue:
+
+    # Failed actions waiting for another attempt, filled by the batch callbacks and drained by the schedule loop
+
+    def __init__(self, retries: int, delay: float):
+        """
+        Args:
+            retries: Attempts after the first failed one, 0 never retries
+            delay: Seconds before the first retry, each further retry waits one more delay
+        """
+
+        self.retries = retries
+        self.delay = delay
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, results: list, attempt: int) -> int:
+        """Queue the failed actions of a batch for another attempt
+
+        Args:
+            results: The action outcomes of the batch
+            attempt: The attempt the batch was, 0 for the scheduled fire
+
+        Returns:
+            The number of actions queued
+        """
+
+        # A failed vApp action is retried per Virtual Machine, the batch coalesces them again
+        failed = [tag for result in results if result["outcome"] == "failed"
+                  for tag in (result["action"]["members"] if result["action"].get("vapp") else [result["action"]])]
+        if not failed:
+            return 0
+
+        if attempt >= self.retries:
+            for tag in failed:
+                log.error(f'Giving up {tag["key"]} on {tag["name"]} after {attempt + 1} attempts')
+            return 0
+
+        due = time.monotonic() + self.delay * (attempt + 1)
+        with self._lock:
+            self._pending.extend((due, attempt + 1, tag) for tag in failed)
+
+        log.info(f'Retrying {len(failed)} failed actions in {self.delay * (attempt + 1):.0f} seconds')
+        return len(failed)
+
+    def pop_due(self, now: float) -> dict[int, list]:
+        """Return the actions due for another attempt by attempt number
+
+        Args:
+            now: The monotonic time
+        """
+
+        with self._lock:
+            due = [item for item in self._pending if item[0] <= now]
+            self._pending = [item for item in self._pending if item[0] > now]
+
+        attempts = {}
+        for _, attempt, tag in due:
+            attempts.setdefault(attempt, []).append(tag)
+        return attempts
+
+    def next_due(self, now: float) -> Optional[float]:
+        """Return the seconds until the next retry is due, None if none is pending"""
+
+        with self._lock:
+            if not self._pending:
+                return None
+            return max(min(item[0] for item in self._pending) - now, 0)
+
+
+def summarise(results: list, elapsed: float):
+    """Log the outcome counts and latencies of a batch of actions"""
+
+    if not results:
+        return
+
+    outcomes = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+
+    latencies = sorted(result["latency"] for result in results)
+    log.info(f'Executed {len(results)} actions in {elapsed:.1f} seconds: '
+             + ", ".join(f'{outcome} {count}' for outcome, count in sorted(outcomes.items())))
+    log.info(f'Action latency: median {latencies[len(latencies) // 2]:.1f}s, max {latencies[-1]:.1f}s')
@@ -0,0 +1,226 @@
+"""Module with the power-on admission controller.
+
+Powering on many Virtual Machines at once contends for the storage and hosts
+of a VDC, so power-ons pass an admission controller before they are sent:
+
+- a token bucket ramps them at a sustained rate after an initial burst, a vApp
+  power-on costs one token per Virtual Machine
+- at most a number of Virtual Machines per VDC and per vApp may be powering
+  on at once, a slot is held until the power-on task finishes
+- waiting power-ons are admitted by boot order, lower first, so databases
+  come up before the application servers depending on them
+
+A power-on is always admitted when nothing else is powering on in its VDC
+and vApp, so a vApp larger than a limit still starts.
+
+Power-ons wait in the queue of a single dispatcher thread and only take an
+action worker once admitted, so a saturated VDC never holds the workers that
+power-ons in other VDCs and power-offs need.
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+import lib.metrics as metrics
+
+log = logging.getLogger(__name__)
+
+admission_wait_seconds = metrics.Histogram('vmscheduler_admission_wait_seconds', 'Time a power-on waited for admission', ('site',),
+                                           buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800))
+
+
+def cost(action: dict) -> int:
+    """Return the number of Virtual Machines an action powers on"""
+
+    return len(action["members"]) if action.get("vapp") else 1
+
+
+def priority(action: dict) -> tuple:
+    """Return the admission order of an action, Virtual Machines without a boot order go last"""
+
+    boot_order = action.get("boot_order")
+    return (boot_order is None, boot_order or 0)
+
+
+class AdmissionQueue:
+
+    # Waiting power-ons with the token bucket and the VDC and vApp slots, the caller serialises access
+
+    def __init__(self, rate: float = 0, burst: int = 10, vdc_limit: int = 0, vapp_limit: int = 0, now: float = 0):
+        """
+        Args:
+            rate: Power-ons admitted per second once the burst is spent, 0 does not ramp
+            burst: Power-ons admitted at once from a full bucket
+            vdc_limit: Virtual Machines powering on at once per VDC, 0 is unlimited
+            vapp_limit: Virtual Machines powering on at once per vApp, 0 is unlimited
+            now: The monotonic time the bucket is full at
+        """
+
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.vdc_limit = vdc_limit
+        self.vapp_limit = vapp_limit
+        self._tokens = float(self.burst)
+        self._refilled = now
+        self._in_flight = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    def in_flight(self, kind: str, name: str) -> int:
+        """Return the Virtual Machines powering on in a vdc or vapp scope"""
+
+        return self._in_flight.get((kind, name), 0)
+
+    def push(self, action: dict, now: float, start: Optional[Callable] = None) -> SimpleNamespace:
+        """Queue a power-on
+
+        Args:
+            action: The due tag or coalesced vApp action
+            now: The monotonic time it was queued at
+            start: Called with the ticket once it is admitted
+
+        Returns:
+            The admission ticket, to be released once the power-on finished
+        """
+
+        vapp = action["vm_href"] if action.get("vapp") else action.get("vapp_href")
+        ticket = SimpleNamespace(
+            action=action, start=start, queued=now, cost=cost(action),
+            priority=(*priority(action), next(self._sequence)),
+            scopes=[(scope, limit) for scope, limit in ((("vdc", action.get("vdc")), self.vdc_limit), (("vapp", vapp), self.vapp_limit))
+                    if limit and scope[1] is not None],
+        )
+        self._waiting.append(ticket)
+        self._waiting.sort(key=lambda waiting: waiting.priority)
+        return ticket
+
+    def pop(self, now: float) -> tuple[list, Optional[float]]:
+        """Admit the waiting power-ons that fit, in priority order
+
+        Args:
+            now: The monotonic time
+
+        Returns:
+            The admitted tickets, and the seconds until the bucket can admit the
+            first waiting power-on that fits, None when only a release can
+        """
+
+        if self.rate:
+            self._tokens = min(self._tokens + (now - self._refilled) * self.rate, self.burst)
+            self._refilled = now
+
+        admitted = []
+        wait = None
+        for ticket in list(self._waiting):
+            if not self._fits(ticket):
+                # A power-on waiting for a slot does not hold back the other VDCs and vApps
+                continue
+
+            if self.rate:
+                # A vApp larger than the burst waits for a full bucket and overdraws it
+                needed = min(ticket.cost, self.burst)
+                if self._tokens < needed:
+                    wait = (needed - self._tokens) / self.rate
+                    break
+                self._tokens -= ticket.cost
+
+            self._waiting.remove(ticket)
+            for scope, _ in ticket.scopes:
+                self._in_flight[scope] = self._in_flight.get(scope, 0) + ticket.cost
+            admitted.append(ticket)
+
+        return admitted, wait
+
+    def release(self, ticket: SimpleNamespace):
+        """Return the VDC and vApp slots of an admitted power-on"""
+
+        for scope, _ in ticket.scopes:
+            self._in_flight[scope] -= ticket.cost
+            if not self._in_flight[scope]:
+                del self._in_flight[scope]
+
+    def _fits(self, ticket: SimpleNamespace) -> bool:
+        # Within every limit, or alone in a scope it would exceed on its own
+        for scope, limit in ticket.scopes:
+            in_flight = self._in_flight.get(scope, 0)
+            if in_flight and in_flight + ticket.cost > limit:
+                return False
+        return True
+
+
+class AdmissionController:
+
+    # Dispatcher thread admitting the queued power-ons of a site
+
+    def __init__(self, rate: float = 0, burst: int = 10, vdc_limit: int = 0, vapp_limit: int = 0, site: str = ""):
+        """
+        Args:
+            rate: Power-ons admitted per second once the burst is spent, 0 does not ramp
+            burst: Power-ons admitted at once from a full bucket
+            vdc_limit: Virtual Machines powering on at once per VDC, 0 is unlimited
+            vapp_limit: Virtual Machines powering on at once per vApp, 0 is unlimited
+            site: The site label of the admission metrics
+        """
+
+        self.site = site
+        self._queue = AdmissionQueue(rate, burst, vdc_limit, vapp_limit, time.monotonic())
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._dispatch_loop, name="admission", daemon=True)
+        self._thread.start()
+
+    @property
+    def holds(self) -> bool:
+        """True if admitted power-ons hold a slot until their task finishes"""
+
+        return bool(self._queue.vdc_limit or self._queue.vapp_limit)
+
+    def enqueue(self, action: dict, start: Callable[[SimpleNamespace], None]) -> SimpleNamespace:
+        """Queue a power-on, start is called with its ticket on the dispatcher thread once admitted and must not block
+
+        Returns:
+            The admission ticket, to be released once the power-on finished
+        """
+
+        with self._condition:
+            ticket = self._queue.push(action, time.monotonic(), start)
+            self._condition.notify()
+        return ticket
+
+    def release(self, ticket: SimpleNamespace):
+        """Return the slots of an admitted power-on so the next waiting ones can start"""
+
+        with self._condition:
+            self._queue.release(ticket)
+            self._condition.notify()
+
+    def _dispatch_loop(self):
+
+        # Admit the waiting power-ons as the bucket refills and slots are released
+
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                admitted, wait = self._queue.pop(now)
+                if not admitted:
+                    self._condition.wait(wait)
+                    continue
+
+            for ticket in admitted:
+                waited = now - ticket.queued
+                admission_wait_seconds.observe(waited, site=self.site)
+                if waited >= 1:
+                    log.info(f'Power-on of {ticket.action["name"]} admitted after {waited:.1f} seconds')
+                try:
+                    ticket.start(ticket)
+                except Exception as e:
+                    log.error(f'Failed to start the power-on of {ticket.action["name"]}')
+                    log.error(e)
+                    self.release(ticket)
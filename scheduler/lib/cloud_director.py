@@ -1,8 +1,11 @@
 import logging
+import math
 import time
 
-from typing import Any, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Iterator, Optional
 from lib.requests_session import requests_session
+from lib.tracing import span, submit
 
 log = logging.getLogger(__name__)
 pageSize = 128
@@ -31,25 +34,29 @@ status = {-1: "FAILED_CREATION",
                21: "PARTIALLY_SUSPENDED",
 }
 
-def query_vm(director_url: str, vmware_access_token: str, filter: str) -> dict[str, Any]:
-    """List all VM filtered by the a filter
+# Statuses of a Virtual Machine or vApp whose Virtual Machines are not running, eg, an undeployed vApp is RESOLVED
+powered_off = {"POWERED_OFF", "RESOLVED", "VAPP_UNDEPLOYED"}
+
+def iter_query(director_url: str, vmware_access_token: str, query_type: str, filter: str, fields: Optional[list[str]] = None, workers: int = 1) -> Iterator[dict[str, Any]]:
+    """Stream the records of a paged VCD query as each page arrives
 
     Args:
         director_url: base director url, eg.: https://fradir01.vmware-solutions.cloud.ibm.com
         vmware_access_token: A VMWare VCD Session token.
+        query_type: The VCD query type, eg, vm or task
         filter: A VCD Query filter, for example, name==virtual_machine_1
+        fields: Optional list of record fields to return
+        workers: Number of pages fetched concurrently once the first page reveals
+            the total, 1 fetches the pages in order
 
-    Returns:
-       A list of Virtual Machine records
+    Yields:
+       The query records, in page order only when workers is 1
     
     Raises:
         requests.RequestException: all Requests package exceptions
             can be raised due to, e.g., connection or authorization errors.
     """
 
-    # request retry mechanism
-    s = requests_session()
-
     endpoint_url = "/".join([director_url, "api", "query"])
 
     headers = {
@@ -59,30 +66,82 @@ def query_vm(director_url: str, vmware_access_token: str, filter: str) -> dict[s
 
     params: dict[str, int | str] = {
         "filter": filter,
-        "type": "vm",
+        "type": query_type,
         "format": "records",
         "pageSize": pageSize
     }
-    
-    log.debug(f'Query Virtual Machines with filter: {filter}')
 
-    page_number = 0
-    record = []
-    more_pages = True
+    if fields:
+        params["fields"] = ",".join(fields)
+
+    def get_page(page_number: int) -> dict[str, Any]:
+        # request retry mechanism, sessions are per thread
+        s = requests_session()
 
-    while(more_pages):
-        page_number = page_number + 1
         log.debug(f"Getting page {page_number}")
-        params["page"] = page_number
+        with span("page_fetch", query_type=query_type, page=page_number):
+            r = s.get(url=endpoint_url, headers=headers, params={**params, "page": page_number})
+            r.raise_for_status()
+            return r.json()
+
+    log.debug(f'Query {query_type} with filter: {filter}')
+
+    page = get_page(1)
+    pages = math.ceil(page["total"] / pageSize)
+    yield from page.get("record", [])
+
+    if workers > 1 and pages > 2:
+        executor = ThreadPoolExecutor(max_workers=min(workers, pages - 1))
+        try:
+            futures = [submit(executor, get_page, page_number) for page_number in range(2, pages + 1)]
+            for future in as_completed(futures):
+                yield from future.result().get("record", [])
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    else:
+        for page_number in range(2, pages + 1):
+            yield from get_page(page_number).get("record", [])
+
+def iter_query_vm(director_url: str, vmware_access_token: str, filter: str, fields: Optional[list[str]] = None, workers: int = 1) -> Iterator[dict[str, Any]]:
+    """Stream all VM filtered by the a filter as each page arrives
+
+    Args:
+        director_url: base director url, eg.: https://fradir01.vmware-solutions.cloud.ibm.com
+        vmware_access_token: A VMWare VCD Session token.
+        filter: A VCD Query filter, for example, name==virtual_machine_1
+        fields: Optional list of record fields to return, metadata values are
+            requested inline with metadata:<key>, eg, metadata:ibm.manage.up
+        workers: Number of pages fetched concurrently after the first one
 
-        r = s.get(url=endpoint_url, headers=headers, params=params)
-        r.raise_for_status()
+    Yields:
+       Virtual Machine records
+    
+    Raises:
+        requests.RequestException: all Requests package exceptions
+            can be raised due to, e.g., connection or authorization errors.
+    """
 
-        total = r.json()["total"]            
-        record = record + r.json()["record"]
-        more_pages = page_number*pageSize < total
+    return iter_query(director_url, vmware_access_token, "vm", filter, fields, workers)
 
-    return record
+def query_vm(director_url: str, vmware_access_token: str, filter: str, fields: Optional[list[str]] = None) -> list[dict[str, Any]]:
+    """List all VM filtered by the a filter
+
+    Args:
+        director_url: base director url, eg.: https://fradir01.vmware-solutions.cloud.ibm.com
+        vmware_access_token: A VMWare VCD Session token.
+        filter: A VCD Query filter, for example, name==virtual_machine_1
+        fields: Optional list of record fields to return, metadata values are
+            requested inline with metadata:<key>, eg, metadata:ibm.manage.up
+
+    Returns:
+       A list of Virtual Machine records
+    
+    Raises:
+        requests.RequestException: all Requests package exceptions
+            can be raised due to, e.g., connection or authorization errors.
+    """
+
+    return list(iter_query_vm(director_url, vmware_access_token, filter, fields))
 
 def get_vapp_vm(vmware_access_token: str, href: str) -> dict[str, Any]:
     """Get the JSON Record of a VM or VAPP referenced by the provided href
@@ -149,6 +208,46 @@ def get_vm_metadata(vmware_access_token: str, href: str) -> dict[str, Any]:
 
     return r.json()
 
+def get_vm_metadata_if_modified(vmware_access_token: str, href: str, etag: Optional[str] = None) -> tuple[Optional[dict[str, Any]], Optional[str]]:
+    """Conditionally get the metadata record of a VM or VAPP referenced by the provided href/metadata
+
+    Args:
+        vmware_access_token: A VMWare VCD Session token.
+        href: THe href of the resource, eg, https://dirw002.eu-de.vmware.cloud.ibm.com/api/vApp/vm-0a782687-a2c2-44df-86f0-fce60e075d7c
+        etag: The ETag of the cached metadata record, sent as If-None-Match
+
+    Returns:
+        A tuple of the metadata record and its ETag. The record is None when
+        the server answered 304 Not Modified.
+    
+    Raises:
+        requests.RequestException: all Requests package exceptions
+            can be raised due to, e.g., connection or authorization errors.
+    """
+
+    # request retry mechanism
+    s = requests_session()
+
+    endpoint_url = "/".join([href, "metadata"])
+
+    headers = {
+        "Authorization": f"Bearer {vmware_access_token}",
+        "Accept": "application/*+json;version=38.1"
+    }
+
+    if etag:
+        headers["If-None-Match"] = etag
+
+    log.debug(f'Retrieving metadata for {href}')
+
+    r = s.get(url=endpoint_url, headers=headers)
+    r.raise_for_status()
+
+    if r.status_code == 304:
+        return None, etag
+
+    return r.json(), r.headers.get("ETag")
+
 def powerOff(href: str, vmware_access_token: str) -> dict[str, Any]:
     """Perform an Power Off operation on a VM or VAPP
 
@@ -209,4 +308,61 @@ def powerOn(href: str, vmware_access_token: str) -> dict[str, Any]:
     r = s.post(url=endpoint_url, headers=headers)
     r.raise_for_status()
 
-    return r.json()
\ No newline at end of file
+    return r.json()
+
+def iter_audit_trail(director_url: str, vmware_access_token: str, since: str) -> Iterator[dict[str, Any]]:
+    """Stream the audit trail events recorded from a point in time on, oldest first
+
+    Args:
+        director_url: base director url, eg.: https://fradir01.vmware-solutions.cloud.ibm.com
+        vmware_access_token: A VMWare VCD Session token.
+        since: ISO 8601 timestamp, only events at or after it are returned, eg, 2024-09-01T09:19:09.000Z
+
+    Yields:
+       Audit trail events with eventType, timestamp and the affected entity
+    
+    Raises:
+        requests.RequestException: all Requests package exceptions
+            can be raised due to, e.g., connection or authorization errors.
+    """
+
+    # request retry mechanism
+    s = requests_session()
+
+    endpoint_url = "/".join([director_url, "cloudapi", "1.0.0", "auditTrail"])
+
+    headers = {
+        "Authorization": f"Bearer {vmware_access_token}",
+        "Accept": "application/json;version=38.1"
+    }
+
+    params: dict[str, int | str] = {
+        "filter": f"timestamp=ge={since}",
+        "sortAsc": "timestamp",
+        "pageSize": pageSize,
+    }
+
+    log.debug(f'Audit trail since {since}')
+    page_number = 1
+    while True:
+        with span("page_fetch", query_type="audit_trail", page=page_number):
+            r = s.get(url=endpoint_url, headers=headers, params={**params, "page": page_number})
+            r.raise_for_status()
+            page = r.json()
+
+        yield from page.get("values", [])
+
+        if page_number >= page.get("pageCount", 1):
+            break
+        page_number += 1
+
+def entity_href(director_url: str, urn: str) -> Optional[str]:
+    """Return the href of a VM or vApp from its URN, eg, urn:vcloud:vm:<id>, None for other entities"""
+
+    prefix, _, id = urn.rpartition(":")
+    if prefix == "urn:vcloud:vm":
+        return "/".join([director_url, "api", "vApp", f"vm-{id}"])
+    if prefix == "urn:vcloud:vapp":
+        return "/".join([director_url, "api", "vApp", f"vapp-{id}"])
+
+    return None
@@ -0,0 +1,194 @@
+"""Module with the IBM Cloud IAM and VMware Cloud Director credential manager.
+
+Tokens are cached together with their real expiry and refreshed by a
+background thread shortly before they expire. Refreshes are single-flight:
+when several threads need a new token at the same time, one of them
+re-authenticates while the others wait for its result.
+
+Each token is an immutable record replaced by a single reference swap, so
+readers check and use it without taking the lock.
+"""
+
+import base64
+import json
+import logging
+import threading
+import time
+
+from typing import NamedTuple, Optional
+
+import lib.iam as iam
+import lib.vcfass as vcfass
+
+log = logging.getLogger(__name__)
+
+refresh_margin = 300  # Refresh tokens this many seconds before they expire
+vmware_token_lifetime = 1800  # Assumed lifetime in seconds of a VCD token without an exp claim
+refresh_retry_pause = 30  # Minimum pause in seconds between background refreshes, and after a failure
+
+
+class Token(NamedTuple):
+
+    # An access token and the epoch time it expires
+
+    value: str
+    expires: float
+
+
+def token_expiry(token: str, default_lifetime: int) -> float:
+    """Return the expiry of a token in epoch seconds.
+
+    Args:
+        token: An access token, the exp claim is read when it is a JWT.
+        default_lifetime: Lifetime in seconds assumed when the token carries no expiry.
+
+    Returns:
+        The expiry time in epoch seconds.
+    """
+
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + default_lifetime
+
+
+def request_token(request) -> Optional[str]:
+    """Return the bearer token a failed request was sent with.
+
+    Args:
+        request: The requests PreparedRequest, eg, HTTPError.request
+
+    Returns:
+        The bearer token or None if the request was not authorized with one.
+    """
+
+    if request is None:
+        return None
+
+    authorization = request.headers.get("Authorization", "")
+    if not authorization.startswith("Bearer "):
+        return None
+
+    return authorization[len("Bearer "):].split(";")[0]
+
+
+class CredentialManager:
+
+    # Cache of the IAM and VCD access tokens with single-flight refresh
+
+    def __init__(self, ibmcloud_api_key: str):
+        self.ibmcloud_api_key = ibmcloud_api_key
+        self.director_url = None
+        self.org = None
+
+        self._iam = None
+        self._vmware = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configure_director(self, director_url: str, org: str):
+        """Set the Director site and organisation the VCD token is issued for."""
+
+        self.director_url = director_url
+        self.org = org
+
+    def iam_access_token(self) -> str:
+        """Return a valid IBM IAM access token, re-authenticating if required."""
+
+        token = self._iam
+        if self._valid(token):
+            return token.value
+
+        with self._lock:
+            if not self._valid(self._iam):
+                self._refresh_iam()
+            return self._iam.value
+
+    def vmware_access_token(self) -> str:
+        """Return a valid VCD access token, re-authenticating if required."""
+
+        token = self._vmware
+        if self._valid(token):
+            return token.value
+
+        with self._lock:
+            if not self._valid(self._vmware):
+                self._refresh_vmware()
+            return self._vmware.value
+
+    def invalidate(self, token: Optional[str] = None):
+        """Discard a token rejected by the server.
+
+        Only the cached token matching the rejected one is dropped, so many
+        callers failing with the same stale token cause a single refresh.
+
+        Args:
+            token: The rejected token, None discards all cached tokens.
+        """
+
+        with self._lock:
+            if self._iam is not None and token in (None, self._iam.value):
+                log.info("Invalidating IBM Cloud IAM access token")
+                self._iam = None
+            if self._vmware is not None and token in (None, self._vmware.value):
+                log.info("Invalidating VMWare access token")
+                self._vmware = None
+
+    def start(self):
+        """Start the background refresh thread."""
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, name="credentials", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background refresh thread."""
+
+        self._stop.set()
+
+    def _valid(self, token, margin: float = 0) -> bool:
+        return token is not None and token.expires - margin > time.time()
+
+    def _refresh_iam(self):
+        # Caller holds self._lock
+        log.debug("Refreshing IBM Cloud IAM access token")
+        response = iam.request_ibm_iam_token(ibm_api_key=self.ibmcloud_api_key)
+        expires = response.get("expiration") or time.time() + response.get("expires_in", 3600)
+        self._iam = Token(value=response["access_token"], expires=float(expires))
+
+    def _refresh_vmware(self):
+        # Caller holds self._lock
+        if not self._valid(self._iam, refresh_margin):
+            self._refresh_iam()
+
+        log.debug("Refreshing VMWare access token")
+        value = vcfass.get_vmware_access_token(
+            ibm_iam_access_token=self._iam.value, url=self.director_url, org=self.org
+        )
+        self._vmware = Token(value=value, expires=token_expiry(value, vmware_token_lifetime))
+
+    def _refresh_loop(self):
+
+        # Refresh the tokens in the background just before they expire
+
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    if not self._valid(self._iam, refresh_margin):
+                        self._refresh_iam()
+                    if self.director_url is not None and not self._valid(self._vmware, refresh_margin):
+                        self._refresh_vmware()
+
+                    tokens = [t for t in (self._iam, self._vmware) if t is not None]
+                    next_refresh = min(t.expires for t in tokens) - refresh_margin
+
+                pause = max(next_refresh - time.time(), refresh_retry_pause)
+            except Exception as e:
+                log.error("Failed to refresh access tokens")
+                log.error(e)
+                pause = refresh_retry_pause
+
+            self._stop.wait(pause)
@@ -0,0 +1,155 @@
+"""Module with the event-driven scheduler engine.
+
+The engine keeps a min-heap of (next fire time, tag) entries. A cron
+expression is only evaluated when its tag is added, changes or fires, and
+the caller sleeps exactly until the earliest entry is due.
+"""
+
+import heapq
+import itertools
+import logging
+
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Optional
+
+import lib.tags as tags
+
+from lib.tag_store import TagStore
+
+log = logging.getLogger(__name__)
+
+
+class ScheduleEngine:
+
+    # Priority queue of the next fire time of every tag
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def update(self, vm_tags: TagStore, now: datetime) -> int:
+        """Reconcile the engine with the latest tag inventory
+
+        Args:
+            vm_tags: The tag inventory
+            now: The current time in the region
+
+        Returns:
+            The number of entries added or rescheduled
+        """
+
+        # Removed entries are dropped lazily when they reach the top of the heap
+        for key in [key for key in self._entries if key not in vm_tags]:
+            del self._entries[key]
+
+        changed = 0
+        for key, tag in vm_tags.items():
+            entry = self._entries.get(key)
+            if entry is not None and entry.tag["value"] == tag["value"]:
+                entry.tag = tag
+                continue
+
+            self._schedule(key, tag, tags.next_exec(tag["value"], now))
+            changed += 1
+
+        if changed:
+            log.debug(f"Rescheduled {changed} of {len(self._entries)} tags")
+
+        # Compact the heap once superseded entries dominate it
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(e.fire_time, e.seq, key) for key, e in self._entries.items()]
+            heapq.heapify(self._heap)
+
+        return changed
+
+    def next_fire(self) -> Optional[datetime]:
+        """Return the time of the earliest due entry or None if nothing is scheduled"""
+
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> list:
+        """Return the fires due at or before now and schedule their next fire time
+
+        A tag whose later fire times have also passed, eg, after the process
+        stalled, fires once for its latest due time and reports the earlier
+        ones as missed.
+
+        Args:
+            now: The current time in the region
+
+        Returns:
+            The due fires with the attributes tag, fire_time and missed
+        """
+
+        due = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+
+            fire_time, seq, key = heapq.heappop(self._heap)
+            entry = self._entries[key]
+
+            missed = 0
+            next_time = tags.next_exec(entry.tag["value"], fire_time)
+            while next_time <= now:
+                missed += 1
+                fire_time = next_time
+                next_time = tags.next_exec(entry.tag["value"], fire_time)
+
+            due.append(SimpleNamespace(tag=entry.tag, fire_time=fire_time, missed=missed))
+            self._schedule(key, entry.tag, next_time)
+
+        return due
+
+    def _schedule(self, key: tuple[str, str], tag: dict, fire_time: datetime):
+        seq = next(self._seq)
+        self._entries[key] = SimpleNamespace(tag=tag, fire_time=fire_time, seq=seq)
+        heapq.heappush(self._heap, (fire_time, seq, key))
+
+    def _discard_stale(self):
+        while self._heap:
+            fire_time, seq, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry.seq == seq:
+                return
+            heapq.heappop(self._heap)
+
+
+def catch_up(fires: list, now: datetime, window: float, tolerance: float) -> list:
+    """Apply the catch-up policy to due fires, logging every late or missed fire
+
+    Args:
+        fires: The due fires of ScheduleEngine.pop_due
+        now: The current time in the region
+        window: Fires later than this many seconds are skipped
+        tolerance: Fires later than this many seconds are reported as late
+
+    Returns:
+        The tags to execute
+    """
+
+    actions = []
+    for fire in fires:
+        tag = fire.tag
+        lateness = (now - fire.fire_time).total_seconds()
+
+        if fire.missed:
+            log.warning(f'Missed {fire.missed} earlier fires of {tag["key"]} on {tag["name"]} before {fire.fire_time}')
+
+        if lateness > window:
+            log.error(f'Missed {tag["key"]} on {tag["name"]} due at {fire.fire_time}, {lateness:.0f} seconds late - skipped')
+            continue
+
+        if lateness > tolerance:
+            log.warning(f'Late {tag["key"]} on {tag["name"]} due at {fire.fire_time}, firing {lateness:.0f} seconds late')
+
+        actions.append(tag)
+
+    return actions
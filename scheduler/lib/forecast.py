@@ -0,0 +1,203 @@
+"""Module with the schedule forecast of a tag inventory.
+
+Cron expressions are expanded into their fire times from the value sets of
+croniter.expand, once per distinct expression, instead of stepping get_next
+for every tag. Tags sharing an expression, key and VDC are then counted
+together, so a large inventory costs about as much as its distinct schedules.
+
+Fire times are built from the region's local calendar and follow croniter,
+and so the scheduler, across daylight saving transitions: a local time
+repeated when the clocks go back fires at both occurrences, and a local time
+skipped when they go forward fires once at the end of the gap.
+"""
+
+import logging
+
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Iterable, Optional
+
+from croniter import croniter
+
+log = logging.getLogger(__name__)
+
+lookback_days = 7  # Days of fires before the start replayed to infer the power state at the start
+
+
+def expand(cron: str, start: datetime, end: datetime) -> list[int]:
+    """Return the fire times of a cron expression in [start, end) as sorted epoch seconds
+
+    Args:
+        cron: A five field cron expression
+        start: The first instant, in the timezone the expression is evaluated in
+        end: The instant after the last
+    """
+
+    expanded, nth_weekday = croniter.expand(cron)
+    if len(expanded) != 5 or nth_weekday or any(isinstance(v, str) and v != '*' for field in expanded for v in field):
+        # Last day (L) and nth weekday (#) expressions are stepped with croniter
+        fires = []
+        it = croniter(cron, start - timedelta(seconds=1))
+        while (fire := it.get_next(datetime)) < end:
+            fires.append(int(fire.timestamp()))
+        return fires
+
+    minutes, hours, days, months, weekdays = [None if field == ['*'] else set(field) for field in expanded]
+    times = [(hour, minute) for hour in sorted(hours or range(24)) for minute in sorted(minutes or range(60))]
+    tz = start.tzinfo
+    start_ts, end_ts = start.timestamp(), end.timestamp()
+
+    fires = []
+    day = start.date()
+    while day <= end.date():
+        if months is None or day.month in months:
+            day_match = days is None or day.day in days
+            weekday_match = weekdays is None or day.isoweekday() % 7 in weekdays
+
+            # Like cron, a restricted day of month and day of week match either
+            if days is not None and weekdays is not None:
+                matched = day_match or weekday_match
+            else:
+                matched = day_match and weekday_match
+
+            if matched:
+                midnight = datetime(day.year, day.month, day.day, tzinfo=tz)
+                if midnight.utcoffset() == (midnight + timedelta(days=1)).utcoffset():
+                    for hour, minute in times:
+                        fire = datetime(day.year, day.month, day.day, hour, minute, tzinfo=tz).timestamp()
+                        if start_ts <= fire < end_ts:
+                            fires.append(int(fire))
+                else:
+                    # A daylight saving transition day
+                    transition_fires = {int(fire) for hour, minute in times
+                                        for fire in local_fires(datetime(day.year, day.month, day.day, hour, minute), tz)
+                                        if start_ts <= fire < end_ts}
+                    fires.extend(sorted(transition_fires))
+        day += timedelta(days=1)
+
+    return fires
+
+
+def local_fires(local: datetime, tz) -> list[float]:
+    """Return the epoch times a local wall clock time occurs at, like croniter
+
+    A repeated local time occurs twice, a skipped one once at the end of the gap.
+    """
+
+    first = local.replace(tzinfo=tz).timestamp()
+    if datetime.fromtimestamp(first, tz).replace(tzinfo=None) == local:
+        return sorted({first, local.replace(tzinfo=tz, fold=1).timestamp()})
+
+    # Find the instant the clocks went forward past the skipped time
+    low, high = first - 3 * 3600, first + 3 * 3600
+    while high - low > 1:
+        middle = (low + high) // 2
+        if datetime.fromtimestamp(middle, tz).replace(tzinfo=None) > local:
+            high = middle
+        else:
+            low = middle
+    return [high]
+
+
+def forecast(vm_tags: Iterable, start: datetime, days: int, initial: str = "infer") -> SimpleNamespace:
+    """Compute the action timeline of a tag inventory
+
+    Args:
+        vm_tags: The tags, eg, a TagStore
+        start: The start of the forecast in the region timezone
+        days: The length of the forecast
+        initial: The power state of every Virtual Machine at the start, on, off, or infer
+            it from the fires of the preceding lookback_days (off before them)
+
+    Returns:
+        A namespace with the per minute action counts, the per VDC totals, the
+        peak power-ons in a minute, the peak powered on Virtual Machines and the
+        projected powered on hours
+    """
+
+    end = start + timedelta(days=days)
+    lookback = start - timedelta(days=lookback_days) if initial == "infer" else start
+    start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+
+    # Group the tags by schedule, and every Virtual Machine by its pair of schedules
+    actions = Counter()
+    schedules = {}
+    for tag in vm_tags:
+        actions[(tag["key"], tag["value"], tag.get("vdc"))] += 1
+        schedules.setdefault(tag["vm_href"], {"vdc": tag.get("vdc")})[tag["key"]] = tag["value"]
+    pairs = Counter((s.get("ibm.manage.up"), s.get("ibm.manage.down"), s["vdc"]) for s in schedules.values())
+
+    cache = {}
+
+    def fires(cron: Optional[str]) -> list:
+        if cron is None:
+            return []
+        if cron not in cache:
+            cache[cron] = expand(cron, lookback, end)
+        return cache[cron]
+
+    # Actions per minute, overall and per VDC
+    per_minute = {}
+    vdcs = {}
+    for (key, cron, vdc), count in actions.items():
+        column = 0 if key == "ibm.manage.up" else 1
+        totals = vdcs.setdefault(vdc, SimpleNamespace(power_on=0, power_off=0, on_minutes={}, powered_on_hours=0.0))
+        for fire in fires(cron):
+            if fire < start_ts:
+                continue
+            minute = fire - fire % 60
+            per_minute.setdefault(minute, [0, 0])[column] += count
+            if column == 0:
+                totals.power_on += count
+                totals.on_minutes[minute] = totals.on_minutes.get(minute, 0) + count
+            else:
+                totals.power_off += count
+
+    # Power state of each pair of schedules, a power action on a Virtual Machine already in that state changes nothing
+    changes = Counter()
+    powered_on_start = 0
+    powered_on_seconds = 0
+    for (up, down, vdc), count in pairs.items():
+        events = sorted([(fire, True) for fire in fires(up)] + [(fire, False) for fire in fires(down)])
+
+        state = initial == "on"
+        index = 0
+        while index < len(events) and events[index][0] < start_ts:
+            state = events[index][1]
+            index += 1
+        if state:
+            powered_on_start += count
+
+        seconds = 0
+        since = start_ts
+        for fire, on in events[index:]:
+            if on == state:
+                continue
+            if state:
+                seconds += fire - since
+            changes[fire] += count if on else -count
+            state, since = on, fire
+        if state:
+            seconds += end_ts - since
+
+        powered_on_seconds += count * seconds
+        vdcs.setdefault(vdc, SimpleNamespace(power_on=0, power_off=0, on_minutes={}, powered_on_hours=0.0))
+        vdcs[vdc].powered_on_hours += count * seconds / 3600
+
+    powered_on = powered_on_start
+    peak_powered_on = (start_ts, powered_on)
+    for fire in sorted(changes):
+        powered_on += changes[fire]
+        if powered_on > peak_powered_on[1]:
+            peak_powered_on = (fire, powered_on)
+
+    timeline = sorted((minute, ups, downs) for minute, (ups, downs) in per_minute.items())
+    peak_power_on = max(((minute, ups) for minute, ups, _ in timeline), key=lambda item: item[1], default=(start_ts, 0))
+
+    return SimpleNamespace(
+        start=start, end=end, tags=sum(actions.values()), vms=len(schedules), schedules=len(cache),
+        timeline=timeline, vdcs=vdcs, peak_power_on=peak_power_on, peak_powered_on=peak_powered_on,
+        powered_on_hours=powered_on_seconds / 3600,
+    )
+
@@ -8,20 +8,25 @@ https://cloud.ibm.com/apidocs/iam-identity-token-api
 """
 
 import logging
+import os
+from typing import Any
 
 from lib.requests_session import requests_session
 
 log = logging.getLogger(__name__)
 
+iam_url = os.environ.get("ibmcloud_iam_url", "https://iam.cloud.ibm.com")  # Overridden to target a stand-in server
 
-def request_ibm_iam_access_token(ibm_api_key: str) -> str:
-    """The API call to get an IBM Cloud IAM access token.
+
+def request_ibm_iam_token(ibm_api_key: str) -> dict[str, Any]:
+    """The API call to get an IBM Cloud IAM token response.
 
     Args:
         ibm_api_key: IBM IAM API key.
 
     Returns:
-        IBM IAM access token.
+        IBM IAM token response including the access_token, expires_in and
+        expiration (epoch seconds) fields.
 
     Raises:
         requests.RequestException: all Requests package exceptions
@@ -31,7 +36,7 @@ def request_ibm_iam_access_token(ibm_api_key: str) -> str:
     # request retry mechanism
     s = requests_session()
 
-    endpoint_url = "/".join(["https://iam.cloud.ibm.com", "identity", "token"])
+    endpoint_url = "/".join([iam_url, "identity", "token"])
 
     payload = {
         "grant_type": "urn:ibm:params:oauth:grant-type:apikey",
@@ -41,6 +46,24 @@ def request_ibm_iam_access_token(ibm_api_key: str) -> str:
     log.debug("Request IBM Cloud IAM access token.")
     r = s.post(url=endpoint_url, data=payload)
     r.raise_for_status()
-    log.debug(f'Got IBM Cloud IAM access token: {r.json()["access_token"][:7]}(...)')
+    token = r.json()
+    log.debug(f'Got IBM Cloud IAM access token: {token["access_token"][:7]}(...)')
+
+    return token
+
+
+def request_ibm_iam_access_token(ibm_api_key: str) -> str:
+    """The API call to get an IBM Cloud IAM access token.
+
+    Args:
+        ibm_api_key: IBM IAM API key.
+
+    Returns:
+        IBM IAM access token.
+
+    Raises:
+        requests.RequestException: all Requests package exceptions
+            can be raised due to, e.g., connection or authorization errors.
+    """
 
-    return r.json()["access_token"]
+    return request_ibm_iam_token(ibm_api_key)["access_token"]
@@ -0,0 +1,96 @@
+"""Module with a per Virtual Machine metadata cache.
+
+Cached metadata records are revalidated with ETag/If-None-Match so an
+unchanged Virtual Machine costs a 304 response instead of a full body.
+"""
+
+import logging
+import threading
+
+from types import SimpleNamespace
+from typing import Any
+
+import lib.cloud_director as cloud_director
+
+log = logging.getLogger(__name__)
+
+
+class MetadataCache:
+
+    # Metadata records keyed by Virtual Machine href
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.revalidated = 0
+        self.downloaded = 0
+
+    def get_vm_metadata(self, vmware_access_token: str, href: str) -> dict[str, Any]:
+        """Get the metadata record of a Virtual Machine, revalidating any cached copy
+
+        Args:
+            vmware_access_token: A VMWare VCD Session token.
+            href: The href of the Virtual Machine
+
+        Returns:
+            A metadata record
+
+        Raises:
+            requests.RequestException: all Requests package exceptions
+                can be raised due to, e.g., connection or authorization errors.
+        """
+
+        with self._lock:
+            entry = self._entries.get(href)
+
+        metadata, etag = cloud_director.get_vm_metadata_if_modified(
+            vmware_access_token=vmware_access_token,
+            href=href,
+            etag=entry.etag if entry else None,
+        )
+
+        with self._lock:
+            if metadata is None:
+                self.revalidated += 1
+                return entry.metadata
+
+            self.downloaded += 1
+            if etag:
+                self._entries[href] = SimpleNamespace(etag=etag, metadata=metadata)
+            else:
+                self._entries.pop(href, None)
+
+        return metadata
+
+    def evict(self, hrefs: set) -> int:
+        """Drop the entries of Virtual Machines that are no longer present
+
+        Args:
+            hrefs: The hrefs of the Virtual Machines still present
+
+        Returns:
+            The number of evicted entries
+        """
+
+        with self._lock:
+            stale = [href for href in self._entries if href not in hrefs]
+            for href in stale:
+                del self._entries[href]
+
+        if stale:
+            log.debug(f"Evicted {len(stale)} metadata cache entries")
+
+        return len(stale)
+
+    def reset_stats(self) -> tuple[int, int]:
+        """Return and reset the (revalidated, downloaded) counters"""
+
+        with self._lock:
+            stats = (self.revalidated, self.downloaded)
+            self.revalidated = 0
+            self.downloaded = 0
+
+        return stats
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,145 @@
+"""Module with Prometheus format metrics and the embedded /metrics endpoint.
+
+Metrics are registered at import time of the module that owns them and are
+safe to update from any thread.
+
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+registry = []
+default_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Metric:
+
+    # Base class of a labelled metric family
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{format_labels(labels)} {value:g}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self) -> list:
+        samples = []
+        for name, labels, counts in super().samples():
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f"{name}_bucket", {**labels, "le": f"{bound:g}"}, count))
+            samples.append((f"{name}_bucket", {**labels, "le": "+Inf"}, counts[-2]))
+            samples.append((f"{name}_count", labels, counts[-2]))
+            samples.append((f"{name}_sum", labels, counts[-1]))
+        return samples
+
+
+def render() -> str:
+    """Return all registered metrics in the Prometheus text format"""
+
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    # Serves GET /metrics
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def start_http_server(port: int, address: str = "") -> ThreadingHTTPServer:
+    """Serve the /metrics endpoint from a background thread
+
+    Args:
+        port: The TCP port to listen on
+        address: The address to bind, all interfaces by default
+
+    Returns:
+        The running server
+    """
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
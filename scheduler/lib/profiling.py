@@ -0,0 +1,139 @@
+"""Module with on-demand cProfile and tracemalloc capture of scheduler cycles.
+
+Once armed, eg, through SIGUSR2, the next N refresh and action cycles are
+profiled and the results are dumped to disk:
+
+- <cycle>-<timestamp>.prof: cProfile statistics, eg, python -m pstats <file>
+- <cycle>-<timestamp>.mem.txt: the largest allocation growths during the cycle
+
+Only one cycle is profiled at a time. cProfile only sees the thread it is
+enabled on, so the worker tasks submitted through tracing.submit during a
+profiled cycle are profiled each on their own and merged into its statistics.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+memory_top = 50  # Number of allocation sites written per cycle
+
+_cycle = contextvars.ContextVar("profiled_cycle", default=None)
+
+
+class TaskStats:
+
+    # Merged cProfile statistics of the worker tasks of a profiled cycle
+
+    def __init__(self):
+        self.stats = None
+        self._lock = threading.Lock()
+
+    def add(self, profile: cProfile.Profile):
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def merge(self, stats: pstats.Stats):
+        """Add the task statistics to the statistics of the cycle"""
+
+        with self._lock:
+            if self.stats is not None:
+                stats.add(self.stats)
+
+
+def run(fn, *args, **kwargs):
+    """Run a worker task, profiled into the current cycle when it is being profiled"""
+
+    tasks = _cycle.get()
+    if tasks is None:
+        return fn(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # From Python 3.12 the profiler of the cycle already sees every thread
+        return fn(*args, **kwargs)
+
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profile.disable()
+        tasks.add(profile)
+
+
+class CycleProfiler:
+
+    # Profiles the next armed number of cycles
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._remaining = 0
+        self._lock = threading.Lock()
+        self._active = threading.Lock()
+
+    def arm(self, cycles: int):
+        """Profile the next cycles, safe to call from a signal handler"""
+
+        self._remaining = cycles
+        log.info(f"Profiling the next {cycles} cycles into {self.directory}")
+
+    @contextlib.contextmanager
+    def cycle(self, name: str):
+        """Profile the enclosed cycle if armed and no other cycle is being profiled"""
+
+        with self._lock:
+            armed = self._remaining > 0 and self._active.acquire(blocking=False)
+            if armed:
+                self._remaining -= 1
+
+        if not armed:
+            yield
+            return
+
+        try:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            tasks = TaskStats()
+            token = _cycle.set(tasks)
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                _cycle.reset(token)
+                after = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                self._dump(name, profiler, tasks, after.compare_to(before, "lineno"))
+        finally:
+            self._active.release()
+
+    def _dump(self, name: str, profiler: cProfile.Profile, tasks: TaskStats, memory: list):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{name}-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')}")
+            stats = pstats.Stats(profiler)
+            tasks.merge(stats)
+            stats.dump_stats(f"{path}.prof")
+            with open(f"{path}.mem.txt", "w") as f:
+                for stat in memory[:memory_top]:
+                    f.write(f"{stat}\n")
+            log.info(f"Wrote profile of {name} cycle to {path}.prof")
+        except Exception as e:
+            log.error(f"Failed to write profile of {name} cycle")
+            log.error(e)
+
+
+profiler = CycleProfiler(os.environ.get("profile_dir", os.path.join(os.path.dirname(__file__), "../profiles")))
@@ -1,33 +1,271 @@
+import contextlib
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
 import requests
 import urllib3
 
+from urllib3.exceptions import MaxRetryError, ResponseError
+
+import lib.metrics as metrics
+
+log = logging.getLogger(__name__)
+
+pool_connections = int(os.environ.get("http_pool_connections", 10))  # Number of per-host connection pools kept
+pool_maxsize = int(os.environ.get("http_pool_maxsize", 48))  # Keep-alive connections kept per host
+retry_budget_limit = int(os.environ.get("http_retry_budget", 100))  # Retries allowed per refresh or action cycle
+retry_after_max = float(os.environ.get("http_retry_after_max", 60))  # Longest honoured Retry-After in seconds
+
+
+requests_total = metrics.Counter("vmscheduler_http_requests_total", "HTTP requests per endpoint and status", ("endpoint", "status"))
+request_seconds = metrics.Histogram("vmscheduler_http_request_seconds", "HTTP request latency including retries", ("endpoint",))
+request_retries_total = metrics.Counter("vmscheduler_http_request_retries_total", "HTTP request retries per endpoint", ("endpoint",))
+retry_budget_exhausted_total = metrics.Counter(
+    "vmscheduler_http_retry_budget_exhausted_total", "HTTP retries refused because the cycle retry budget was spent", ("endpoint",)
+)
+
+endpoints = [
+    (re.compile(r"/identity/token$"), "iam_token"),
+    (re.compile(r"/v1/director_sites$"), "director_sites"),
+    (re.compile(r"/v1/vdcs$"), "vdcs"),
+    (re.compile(r"/cloudapi/1\.0\.0/sessions$"), "vcd_session"),
+    (re.compile(r"/cloudapi/1\.0\.0/auditTrail$"), "audit_trail"),
+    (re.compile(r"/api/query$"), "query"),
+    (re.compile(r"/metadata$"), "metadata"),
+    (re.compile(r"/power/action/powerOn$"), "power_on"),
+    (re.compile(r"/power/action/powerOff$"), "power_off"),
+    (re.compile(r"/api/vApp/vm-[^/]+$"), "vm"),
+    (re.compile(r"/api/vApp/vapp-[^/]+$"), "vapp"),
+]
+
+
+def endpoint(url: str) -> str:
+    """Return the endpoint class of a request URL, eg, metadata or power_on"""
+
+    parsed = urlparse(url)
+    for pattern, name in endpoints:
+        if pattern.search(parsed.path):
+            if name == "query":
+                query_type = parse_qs(parsed.query).get("type")
+                return f"query_{query_type[0]}" if query_type else name
+            return name
+
+    return "other"
+
+
+class RetryBudget:
+
+    # Retries shared by all requests of one refresh or action cycle
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        """Spend one retry, returns false once the budget is exhausted"""
+
+        with self._lock:
+            if self.spent >= self.limit:
+                return False
+            self.spent += 1
+            return True
+
+
+_budget = contextvars.ContextVar("retry_budget", default=None)
+
+
+@contextlib.contextmanager
+def retry_budget(limit: Optional[int] = None):
+    """Bound the retries of all requests made within the block
+
+    The budget follows the context into worker threads started through
+    lib.tracing.submit, so a cycle fanning out over many requests cannot
+    multiply a flaky endpoint into minutes of backoff.
+
+    Args:
+        limit: Number of retries allowed, http_retry_budget by default
+    """
+
+    budget = RetryBudget(retry_budget_limit if limit is None else limit)
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+        if budget.spent >= budget.limit:
+            log.warning(f"Retry budget of {budget.limit} exhausted, further retries of the cycle were refused")
+
+
+class BudgetRetry(urllib3.util.Retry):
+    """Retry drawing from the retry budget of the cycle and capping Retry-After"""
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, retry_after_max)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+
+        budget = _budget.get()
+        if budget is not None and not budget.take():
+            retry_budget_exhausted_total.inc(endpoint=endpoint(url or ""))
+            raise MaxRetryError(_pool, url, error or ResponseError("retry budget exhausted"))
+
+        return retry
+
+
+class RetryPolicy:
+
+    # Retry and timeout policy of an endpoint class
+
+    statuses = {429, 500, 502, 503, 504}
+    methods = {"GET", "POST", "PUT"}
+
+    def __init__(self, total: int, backoff_factor: float, backoff_max: float, connect_timeout: float, read_timeout: float,
+                 read: Optional[int] = None, statuses: Optional[set] = None):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.timeout = (connect_timeout, read_timeout)
+        self.read = read
+        if statuses is not None:
+            self.statuses = statuses
+
+    def retry(self) -> BudgetRetry:
+        # The final failed response is returned so raise_for_status reports its status
+        return BudgetRetry(
+            total=self.total,
+            read=self.read,
+            backoff_factor=self.backoff_factor,
+            backoff_max=self.backoff_max,
+            backoff_jitter=self.backoff_factor,
+            allowed_methods=self.methods,
+            status_forcelist=self.statuses,
+            raise_on_status=False,
+        )
+
+
+# Metadata is fetched again on the next refresh and the schedule loop retries a
+# failed power action action_retries times, so neither is worth a long stall.
+# A power call that may have reached VCD, ie, its response was lost or failed
+# other than with 429 or 503, is not sent again: the schedule loop retry reads
+# the power state first
+policies = {
+    "auth": RetryPolicy(total=4, backoff_factor=2, backoff_max=30, connect_timeout=10, read_timeout=60),
+    "query": RetryPolicy(total=4, backoff_factor=2, backoff_max=30, connect_timeout=10, read_timeout=120),
+    "metadata": RetryPolicy(total=2, backoff_factor=1, backoff_max=10, connect_timeout=10, read_timeout=30),
+    "power": RetryPolicy(total=2, backoff_factor=2, backoff_max=20, connect_timeout=10, read_timeout=60, read=0, statuses={429, 503}),
+}
+
+policy_classes = {
+    "iam_token": "auth",
+    "director_sites": "auth",
+    "vdcs": "auth",
+    "vcd_session": "auth",
+    "metadata": "metadata",
+    "power_on": "power",
+    "power_off": "power",
+}
+
+
+def retry_policy(name: str) -> RetryPolicy:
+    """Return the retry policy of an endpoint, queries and lookups share the query policy"""
+
+    return policies[policy_classes.get(name, "query")]
+
 
 class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
-    """Timeout and retry custom Transport Adapter"""
+    """Timeout and retry custom Transport Adapter
+
+    The adapter is shared by all threads, the retry policy of the endpoint is
+    installed per thread for the duration of each request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def max_retries(self):
+        return getattr(self._local, "max_retries", None) or self._max_retries
+
+    @max_retries.setter
+    def max_retries(self, value):
+        self._max_retries = value
 
     def send(
         self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
     ):
         """Sends PreparedRequest object. Returns Response object."""
-        self.max_retries = urllib3.util.Retry(
-            total=4,
-            backoff_factor=7,
-            allowed_methods={"GET", "POST", "PUT"},
-            status_forcelist={500, 501, 502, 503, 504, 505, 506, 507, 509, 510, 511},
-        )
-        self.DEFAULT_BACKOFF_MAX=30*60
-        return super().send(
-            request, stream=False, timeout=180, verify=True, cert=None, proxies=None
-        )
+        name = endpoint(request.url)
+        policy = retry_policy(name)
+        start = time.monotonic()
+        self._local.max_retries = policy.retry()
+        try:
+            response = super().send(
+                request,
+                stream=stream,
+                timeout=policy.timeout if timeout is None else timeout,
+                verify=verify,
+                cert=cert,
+                proxies=proxies,
+            )
+        except Exception:
+            request_seconds.observe(time.monotonic() - start, endpoint=name)
+            requests_total.inc(endpoint=name, status="error")
+            raise
+        finally:
+            self._local.max_retries = None
+
+        request_seconds.observe(time.monotonic() - start, endpoint=name)
+        requests_total.inc(endpoint=name, status=response.status_code)
+        retries = getattr(response.raw, "retries", None)
+        if retries is not None and retries.history:
+            request_retries_total.inc(len(retries.history), endpoint=name)
+
+        return response
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_local = threading.local()
+
+
+def _shared_adapter() -> TimeoutHTTPAdapter:
+    """Process-wide adapter holding the per-host keep-alive connection pools."""
+    global _adapter
+
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = TimeoutHTTPAdapter(
+                pool_connections=pool_connections, pool_maxsize=pool_maxsize
+            )
+        return _adapter
 
 
 def requests_session() -> requests.Session:
     """Request Session definition.
 
+    Each thread gets its own Session so cookies and headers never leak
+    between threads, while all Sessions share a single adapter so TCP and
+    TLS connections are kept alive and reused across calls.
+
     Returns:
         requests Session object.
     """
-    s = requests.Session()
-    s.mount("https://", TimeoutHTTPAdapter())
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = requests.Session()
+        s.mount("https://", _shared_adapter())
+        s.mount("http://", _shared_adapter())
+        _local.session = s
 
     return s
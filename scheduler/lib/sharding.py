@@ -0,0 +1,158 @@
+"""Module with the sharding of the Virtual Machine inventory across scheduler replicas.
+
+Replicas announce themselves through leases held in a lease backend and map
+every Virtual Machine onto a consistent hash ring of the live replicas. A
+replica only refreshes and acts on its own shard, and when a peer's lease
+expires its shard is redistributed. Every membership change bumps a version
+so the refresh threads rescan in full instead of waiting for their next
+scheduled full refresh.
+
+Any backend providing heartbeat, live_replicas and release can be used, the
+SQLite backend lets replicas sharing a volume (or a local test) coordinate.
+"""
+
+import bisect
+import contextlib
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+vnodes = 64  # Points per replica on the hash ring
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+def shard_key(href: str, vapp_href: Optional[str] = None) -> str:
+    """Return the key a Virtual Machine is sharded on
+
+    Virtual Machines of the same vApp share a shard so their actions can still
+    be coalesced into a single vApp power operation.
+    """
+
+    return vapp_href or href
+
+
+class HashRing:
+
+    # Consistent hash ring of the live replicas
+
+    def __init__(self, replicas: list):
+        self.replicas = sorted(replicas)
+        points = sorted((ring_hash(f"{replica}#{n}"), replica) for replica in self.replicas for n in range(vnodes))
+        self._hashes = [point[0] for point in points]
+        self._replicas = [point[1] for point in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        """Return the replica owning a key, None when there are no replicas"""
+
+        if not self._hashes:
+            return None
+
+        index = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._replicas[index]
+
+
+class SqliteLeaseBackend:
+
+    # Replica leases held in a SQLite database
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS leases (replica TEXT PRIMARY KEY, expires REAL NOT NULL)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def heartbeat(self, replica: str):
+        """Create or extend the lease of a replica"""
+
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO leases (replica, expires) VALUES (?, ?) "
+                "ON CONFLICT(replica) DO UPDATE SET expires = excluded.expires",
+                (replica, time.time() + self.ttl),
+            )
+
+    def live_replicas(self) -> list:
+        """Return the replicas holding an unexpired lease"""
+
+        with self._connect() as db:
+            now = time.time()
+            db.execute("DELETE FROM leases WHERE expires < ?", (now - self.ttl,))
+            return [row[0] for row in db.execute("SELECT replica FROM leases WHERE expires >= ?", (now,))]
+
+    def release(self, replica: str):
+        """Give up the lease of a replica so its peers take over immediately"""
+
+        with self._connect() as db:
+            db.execute("DELETE FROM leases WHERE replica = ?", (replica,))
+
+
+class ShardCoordinator:
+
+    # Membership and ownership of this replica
+
+    def __init__(self, backend, replica: str):
+        self.backend = backend
+        self.replica = replica
+        self.version = 0
+        self._ring = HashRing([replica])
+        self._stop = threading.Event()
+        self.refresh()
+
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="shard", daemon=True)
+        self._thread.start()
+
+    def refresh(self) -> int:
+        """Renew the lease of this replica and rebuild the ring if the membership changed
+
+        Returns:
+            The membership version, incremented on every change
+        """
+
+        self.backend.heartbeat(self.replica)
+        replicas = sorted(set(self.backend.live_replicas()) | {self.replica})
+
+        if replicas != self._ring.replicas:
+            log.info(f'Shard membership changed to {len(replicas)} replicas: {", ".join(replicas)}')
+            self._ring = HashRing(replicas)
+            self.version += 1
+
+        return self.version
+
+    def owns(self, href: str, vapp_href: Optional[str] = None) -> bool:
+        """Returns true if this replica owns the Virtual Machine"""
+
+        return self._ring.owner(shard_key(href, vapp_href)) == self.replica
+
+    def stop(self):
+        """Stop heartbeating and release the lease"""
+
+        self._stop.set()
+        self.backend.release(self.replica)
+
+    def _heartbeat_loop(self):
+
+        # Renew the lease well within its time to live
+
+        while not self._stop.wait(self.backend.ttl / 3):
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error("Failed to renew shard lease")
+                log.error(e)
@@ -0,0 +1,108 @@
+"""Module with the persistent tag inventory snapshot.
+
+The latest tag inventory is written to local disk after every refresh so a
+restarted scheduler can start scheduling immediately, while the first
+refresh reconciles it against fresh discovery in the background.
+
+Snapshots are gzipped JSON with a string table, the href, name and cron
+strings repeated across tags are stored only once.
+"""
+
+import gzip
+import json
+import logging
+import os
+import re
+import time
+
+from typing import Optional
+
+from lib.tag_store import TagStore
+from lib.tags import Tag
+
+log = logging.getLogger(__name__)
+
+snapshot_version = 1
+tag_fields = ["key", "value", "vm_href", "name", "vapp_href", "vdc", "boot_order"]
+
+
+def snapshot_path(directory: str, name: str, replica: Optional[str] = None) -> str:
+    """Return the snapshot file of a site, eg, snapshots/IBM_VCFaaS_Multitenant_-_FRA_my-org.json.gz
+
+    Args:
+        directory: The snapshot directory
+        name: The site and organisation
+        replica: The replica of a sharded scheduler, each replica saves its own shard to its own file
+    """
+
+    if replica is not None:
+        name = f"{name}.{replica}"
+    return os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]+", "_", name) + ".json.gz")
+
+
+def save(path: str, vm_tags: TagStore):
+    """Atomically write the tag inventory to a snapshot file
+
+    Args:
+        path: The snapshot file
+        vm_tags: The tag inventory
+    """
+
+    strings = {}
+    rows = []
+    for tag in vm_tags:
+        rows.append([strings.setdefault(tag.get(field), len(strings)) for field in tag_fields])
+
+    snapshot = {
+        "version": snapshot_version,
+        "saved": time.time(),
+        "fields": tag_fields,
+        "strings": list(strings),
+        "tags": rows,
+    }
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+    log.debug(f"Saved {len(vm_tags)} tags to {path}")
+
+
+def load(path: str, max_age: Optional[float] = None) -> TagStore:
+    """Read the tag inventory from a snapshot file
+
+    Args:
+        path: The snapshot file
+        max_age: Snapshots older than this many seconds are ignored
+
+    Returns:
+        The tag inventory, empty if there is no usable snapshot
+    """
+
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return TagStore()
+    except Exception as e:
+        log.error(f"Failed to read tag snapshot {path}")
+        log.error(e)
+        return TagStore()
+
+    if snapshot.get("version") != snapshot_version:
+        log.info(f"Ignoring tag snapshot {path} with version {snapshot.get('version')}")
+        return TagStore()
+
+    age = time.time() - snapshot["saved"]
+    if max_age is not None and age > max_age:
+        log.info(f"Ignoring tag snapshot {path} saved {age / 3600:.1f} hours ago")
+        return TagStore()
+
+    strings = snapshot["strings"]
+    fields = snapshot["fields"]
+    vm_tags = TagStore(Tag(**{field: strings[index] for field, index in zip(fields, row)}) for row in snapshot["tags"])
+
+    log.info(f"Loaded {len(vm_tags)} tags from snapshot {path} saved {age:.0f} seconds ago")
+    return vm_tags
@@ -0,0 +1,146 @@
+"""Module with the indexed tag inventory of a site.
+
+Tags are kept once per (Virtual Machine href, key) and indexed by Virtual
+Machine and by cron expression, so a tag is found in O(1) and a refresh is
+compared against the previous one without rebuilding either.
+
+The refresh thread builds a new store and publishes it frozen inside a
+versioned Inventory by swapping a single reference, so readers never lock
+and never see a half-built inventory.
+"""
+
+import logging
+import time
+
+from types import SimpleNamespace
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from lib.tags import Tag
+
+log = logging.getLogger(__name__)
+
+
+def tag_id(tag) -> tuple[str, str]:
+    """Return the identity of a tag, a Virtual Machine carries one tag per key"""
+
+    return (tag["vm_href"], tag["key"])
+
+
+class TagStore:
+
+    # Tags keyed by identity with Virtual Machine and cron expression indexes
+
+    def __init__(self, vm_tags: Iterable[Tag] = ()):
+        self._tags = {}
+        self._by_vm = {}
+        self._by_cron = {}
+        self._frozen = False
+        for tag in vm_tags:
+            self.add(tag)
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    def __iter__(self) -> Iterator[Tag]:
+        return iter(self._tags.values())
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self._tags
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TagStore):
+            return NotImplemented
+        return self._tags == other._tags
+
+    def items(self):
+        return self._tags.items()
+
+    def get(self, vm_href: str, key: str) -> Optional[Tag]:
+        """Return the tag of a Virtual Machine with a key, None if it has none"""
+
+        return self._tags.get((vm_href, key))
+
+    def for_vm(self, vm_href: str) -> list[Tag]:
+        """Return the tags of a Virtual Machine"""
+
+        return [self._tags[(vm_href, key)] for key in self._by_vm.get(vm_href, ())]
+
+    def for_cron(self, value: str) -> list[Tag]:
+        """Return the tags sharing a cron expression"""
+
+        return [self._tags[key] for key in self._by_cron.get(value, ())]
+
+    def crons(self) -> list[str]:
+        """Return the distinct cron expressions of the inventory"""
+
+        return list(self._by_cron)
+
+    def freeze(self) -> "TagStore":
+        """Make the store read-only before it is shared with other threads"""
+
+        self._frozen = True
+        return self
+
+    def add(self, tag: Tag):
+        """Add a tag, replacing the tag of the same Virtual Machine and key"""
+
+        self._check_mutable()
+        key = tag_id(tag)
+        self.discard(key)
+        self._tags[key] = tag
+        self._by_vm.setdefault(tag.vm_href, set()).add(tag.key)
+        self._by_cron.setdefault(tag.value, set()).add(key)
+
+    def discard(self, key: tuple[str, str]):
+        """Remove the tag with an identity if present"""
+
+        self._check_mutable()
+        tag = self._tags.pop(key, None)
+        if tag is None:
+            return
+
+        self._unindex(self._by_vm, tag.vm_href, tag.key)
+        self._unindex(self._by_cron, tag.value, key)
+
+    def diff(self, previous: Optional["TagStore"]) -> SimpleNamespace:
+        """Compare against an earlier inventory
+
+        Args:
+            previous: The earlier inventory, None compares against an empty one
+
+        Returns:
+            The identities of the added, changed and removed tags
+        """
+
+        previous_tags = previous._tags if previous is not None else {}
+        added = [key for key in self._tags if key not in previous_tags]
+        changed = [key for key, tag in self._tags.items() if key in previous_tags and previous_tags[key] != tag]
+        removed = [key for key in previous_tags if key not in self._tags]
+        return SimpleNamespace(added=added, changed=changed, removed=removed)
+
+    def _check_mutable(self):
+        if self._frozen:
+            raise TypeError("A published TagStore is read-only")
+
+    @staticmethod
+    def _unindex(index: dict, name: str, member):
+        members = index.get(name)
+        if members is None:
+            return
+        members.discard(member)
+        if not members:
+            del index[name]
+
+
+class Inventory(NamedTuple):
+
+    # An immutable published version of the tag inventory
+
+    version: int
+    tags: TagStore
+    published: float
+
+    def publish(self, vm_tags: TagStore) -> "Inventory":
+        """Return the next version holding a new tag inventory, which is frozen"""
+
+        return Inventory(version=self.version + 1, tags=vm_tags.freeze(), published=time.time())
@@ -1,9 +1,11 @@
 import os
 import json
+import sys
 
 import dateutil.tz
 from croniter import croniter
 from datetime import datetime
+from typing import Optional
 
 import logging
 
@@ -11,6 +13,8 @@ import logging
 log = logging.getLogger(__name__)
 
 valid_tags = ['ibm.manage.up', 'ibm.manage.down']
+boot_order_tag = 'ibm.manage.boot_order'   # Optional integer, Virtual Machines with a lower boot order power on first
+metadata_fields = [f'metadata:{tag}' for tag in valid_tags + [boot_order_tag]]
 
 region_timezones = {'eu-de': 'Europe/Berlin',
                     'us-south': 'America/Chicago',
@@ -18,6 +22,47 @@ region_timezones = {'eu-de': 'Europe/Berlin',
                     'ca-tor': 'America/St_Johns',
                     'jp-tok': 'Asia/Tokyo'}
 
+class Tag:
+
+    """
+    A scheduling tag of a Virtual Machine
+
+    Slotted with interned strings so a large inventory stays compact, and
+    readable like the dictionaries it replaces, eg, tag["vm_href"].
+    """
+
+    __slots__ = ('key', 'value', 'vm_href', 'name', 'vapp_href', 'vdc', 'boot_order')
+
+    def __init__(self, key: str, value: str, vm_href: str, name: str, vapp_href: Optional[str] = None, vdc: Optional[str] = None,
+                 boot_order: Optional[int] = None):
+        self.key = sys.intern(key)
+        self.value = sys.intern(value)
+        self.vm_href = sys.intern(vm_href)
+        self.name = sys.intern(name)
+        self.vapp_href = sys.intern(vapp_href) if vapp_href is not None else None
+        self.vdc = sys.intern(vdc) if vdc is not None else None
+        self.boot_order = boot_order
+
+    def __getitem__(self, field: str):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def get(self, field: str, default=None):
+        return getattr(self, field, default)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Tag):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __hash__(self) -> int:
+        return hash((self.vm_href, self.key, self.value))
+
+    def __repr__(self) -> str:
+        return f'Tag({self.key}={self.value!r} on {self.name})'
+
 def is_tag(tag: str) -> bool:
     """
     Returns true if the tag is a registered tag.
@@ -76,21 +121,50 @@ def next_exec(tag_content: str, now: datetime) -> int:
 
     return croniter(tag_content, now).get_next(datetime)
 
-def metadata_to_tag(metadata: dict, vm: dict) -> dict:
+def boot_order(metadata_entries: list, vm: dict) -> Optional[int]:
 
     """
-    Convert a director virtual machine metadata into a tag structure
+    Returns the boot order set in the metadata of a Virtual Machine, None if unset or invalid
     """
 
-    tag = {}
+    for metadata in metadata_entries:
+        if metadata.get("key") == boot_order_tag:
+            try:
+                return int(metadata["typedValue"]["value"])
+            except (KeyError, TypeError, ValueError):
+                log.error(f'ERROR: Tag: {boot_order_tag} Value: {metadata.get("typedValue")} for VM {vm["name"]} is not an integer !!')
+
+    return None
+
+def metadata_to_tag(metadata: dict, vm: dict, boot_order: Optional[int] = None) -> Optional[Tag]:
+
+    """
+    Convert a director virtual machine metadata into a tag structure, None if it is not a valid tag
+    """
+
+    tag = None
     if is_tag(metadata["key"]):
         if not is_valid_cron(metadata["typedValue"]["value"]):
             log.error(f'ERROR: Tag: {metadata["key"]} Value: {metadata["typedValue"]["value"]} for VM {vm["name"]} is Invalid !!')
         else:
             log.info(f'Found Tag - VM: {vm["name"]}, Name: {metadata["key"]}, Value: {metadata["typedValue"]["value"]}')
-            tag["key"] = metadata["key"]
-            tag["value"] = metadata["typedValue"]["value"]
-            tag["vm_href"] = vm["href"]
-            tag["name"] = vm["name"]
+            tag = Tag(key=metadata["key"], value=metadata["typedValue"]["value"], vm_href=vm["href"],
+                      name=vm["name"], vapp_href=vm.get("container"), vdc=vm.get("vdc"), boot_order=boot_order)
 
     return tag
+
+def record_to_tags(vm: dict) -> list:
+
+    """
+    Convert the metadata returned inline in a director query record into tag structures
+    """
+
+    vm_tags = []
+    metadata_entries = (vm.get("metadata") or {}).get("metadataEntry", [])
+    order = boot_order(metadata_entries, vm)
+    for metadata_entry in metadata_entries:
+        tag = metadata_to_tag(metadata_entry, vm, order)
+        if tag is not None:
+            vm_tags.append(tag)
+
+    return vm_tags
@@ -0,0 +1,250 @@
+"""Module with the asynchronous VCD task tracker.
+
+Power operations return a VCD task. The tracker polls all outstanding tasks
+in batches through a type=task query, records when and how each of them
+finished, exports the time to powered on as a histogram and reports its
+percentiles per action cycle.
+
+The same query releases the admission slots held by power-on tasks as soon as
+they finish, so no action worker waits on a task.
+"""
+
+import logging
+import math
+import threading
+import time
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+import requests
+
+import lib.cloud_director as cloud_director
+import lib.metrics as metrics
+
+log = logging.getLogger(__name__)
+
+poll_interval = 10  # Seconds between task polls while tasks are outstanding
+hold_poll_interval = 2  # Seconds between task polls while tasks hold admission slots
+hold_timeout = 10 * 60  # Seconds after which an unfinished task releases its admission slot
+task_timeout = 30 * 60  # Seconds after which an unfinished task is recorded as timed out
+terminal_status = {"success", "error", "aborted", "canceled"}
+cycle_history = 32  # Number of finished action cycles kept for reporting
+task_batch = 20  # Tracked tasks queried by href per task query
+max_task_batches = 5  # Beyond this many batches, every task started since the oldest tracked one is queried instead
+task_fields = ["href", "status", "endDate"]  # Task record fields used by the tracker
+
+time_to_powered_on_seconds = metrics.Histogram('vmscheduler_time_to_powered_on_seconds', 'Time from the dispatch of a power-on until its task succeeded', ('site',),
+                                               buckets=(5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800))
+tasks_total = metrics.Counter('vmscheduler_tasks_total', 'Power operation tasks per operation and status', ('site', 'operation', 'status'))
+
+
+def percentile(values: list, p: float) -> Optional[float]:
+    """Return the nearest-rank percentile of a list of values, None if empty"""
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def parse_date(value: Optional[str]) -> Optional[float]:
+    """Return a VCD ISO 8601 date as epoch seconds, None if absent or invalid"""
+
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except Exception:
+        return None
+
+
+class TaskTracker:
+
+    # Outstanding VCD tasks of the power operations, grouped per action cycle
+
+    def __init__(self, env):
+        self.env = env
+        self._tasks = {}
+        self._holds = {}
+        self._cycles = {}
+        self._finished = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._poll_loop, name="tasks", daemon=True)
+        self._thread.start()
+
+    def track(self, cycle: float, results: list):
+        """Register the tasks returned by a batch of power actions
+
+        Args:
+            cycle: The epoch time the action cycle was dispatched, latencies are measured from it
+            results: The action outcomes of lib.actions.execute_action
+        """
+
+        with self._lock:
+            stats = self._cycles.setdefault(cycle, SimpleNamespace(outstanding=0, powered_on=[], powered_off=0, failed=0, timed_out=0))
+            for result in results:
+                task = result.get("task")
+                if not task or "href" not in task:
+                    continue
+
+                self._tasks[task["href"]] = SimpleNamespace(
+                    cycle=cycle, action=result["action"], operation=result["outcome"], submitted=time.time()
+                )
+                stats.outstanding += 1
+
+            if stats.outstanding == 0:
+                del self._cycles[cycle]
+
+        self._wakeup.set()
+
+    def hold(self, task: dict, release: Callable[[], Any]):
+        """Call release once a task finished, failed or timed out
+
+        Args:
+            task: The task returned by a power operation
+            release: Returns the admission slot held by the task
+        """
+
+        with self._lock:
+            self._holds[task["href"]] = SimpleNamespace(release=release, submitted=time.time())
+
+        self._wakeup.set()
+
+    def percentiles(self, cycle: float) -> dict[str, Any]:
+        """Return the time-to-powered-on percentiles in seconds of an action cycle"""
+
+        with self._lock:
+            stats = self._cycles.get(cycle) or self._finished.get(cycle)
+            latencies = list(stats.powered_on) if stats else []
+
+        return {
+            "count": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+        }
+
+    def outstanding(self) -> int:
+        with self._lock:
+            return len(self._tasks) + len(self._holds)
+
+    def poll(self):
+        """Poll all outstanding tasks with a single paged type=task query"""
+
+        # Release the slots of held tasks past their timeout even when the query below fails
+        self._release_holds({}, time.time())
+
+        with self._lock:
+            if not self._tasks and not self._holds:
+                return
+            hrefs = set(self._tasks) | set(self._holds)
+            since = min(task.submitted for task in [*self._tasks.values(), *self._holds.values()])
+
+        # Query the tracked tasks by href, or when there are too many of them every task started
+        # after the oldest power call was submitted
+        if len(hrefs) <= task_batch * max_task_batches:
+            ordered = sorted(hrefs)
+            filters = ["(" + ",".join(f"href=={href}" for href in ordered[i:i + task_batch]) + ")" for i in range(0, len(ordered), task_batch)]
+        else:
+            filters = [f'startDate=ge={datetime.fromtimestamp(since - 60, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")}']
+
+        records = (record for filter in filters
+                   for record in cloud_director.iter_query(
+                       director_url=self.env.director_url,
+                       vmware_access_token=self.env.vmware_access_token,
+                       query_type="task",
+                       filter=filter,
+                       fields=task_fields,
+                   ))
+
+        now = time.time()
+        finished = {}
+        for record in records:
+            if record.get("href") in hrefs and record.get("status") in terminal_status:
+                finished[record["href"]] = record
+
+        self._release_holds(finished, now)
+
+        with self._lock:
+            for href, task in list(self._tasks.items()):
+                record = finished.get(href)
+                if record is None and now - task.submitted < task_timeout:
+                    continue
+
+                del self._tasks[href]
+                stats = self._cycles[task.cycle]
+                stats.outstanding -= 1
+
+                tasks_total.inc(site=self.env.name, operation=task.operation, status=record["status"] if record else "timed_out")
+                if record is None:
+                    log.error(f'Task for {task.operation} on {task.action["name"]} timed out')
+                    stats.timed_out += 1
+                elif record["status"] != "success":
+                    log.error(f'Task for {task.operation} on {task.action["name"]} finished with status {record["status"]}')
+                    stats.failed += 1
+                elif task.operation == "powered_on":
+                    completed = parse_date(record.get("endDate")) or now
+                    stats.powered_on.append(completed - task.cycle)
+                    time_to_powered_on_seconds.observe(completed - task.cycle, site=self.env.name)
+                else:
+                    stats.powered_off += 1
+
+                if stats.outstanding == 0:
+                    self._report(task.cycle, stats)
+
+    def _release_holds(self, finished: dict, now: float):
+        # Release the held slots of finished tasks and of tasks past hold_timeout
+
+        released = []
+        with self._lock:
+            for href, held in list(self._holds.items()):
+                record = finished.get(href)
+                if record is None and now - held.submitted < hold_timeout:
+                    continue
+                if record is None:
+                    log.warning(f'Task {href} did not finish within {hold_timeout} seconds, releasing its admission slot')
+                del self._holds[href]
+                released.append(held.release)
+
+        for release in released:
+            release()
+
+    def _report(self, cycle: float, stats):
+        # Caller holds self._lock
+        self._finished[cycle] = self._cycles.pop(cycle)
+        while len(self._finished) > cycle_history:
+            del self._finished[next(iter(self._finished))]
+
+        started = datetime.fromtimestamp(cycle).strftime("%Y-%m-%d %H:%M:%S")
+        latencies = stats.powered_on
+        summary = f'Tasks of cycle {started} finished: {len(latencies)} powered on, {stats.powered_off} powered off, {stats.failed} failed, {stats.timed_out} timed out'
+        if latencies:
+            summary += (f', time to powered on p50 {percentile(latencies, 50):.0f}s'
+                        f' p90 {percentile(latencies, 90):.0f}s p99 {percentile(latencies, 99):.0f}s')
+        log.info(summary)
+
+    def _poll_loop(self):
+
+        # Poll the outstanding tasks in the background
+
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self.outstanding():
+                with self._lock:
+                    interval = hold_poll_interval if self._holds else poll_interval
+                time.sleep(interval)
+                try:
+                    self.poll()
+                except requests.exceptions.HTTPError as e:
+                    log.error('Failed to query tasks')
+                    log.error(e)
+                    if e.response is not None and e.response.status_code == 401:
+                        self.env.rehydrate(e)
+                except Exception as e:
+                    log.error('Failed to query tasks')
+                    log.error(e)
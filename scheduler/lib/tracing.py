@@ -0,0 +1,91 @@
+"""Module with lightweight span tracing written as JSON lines.
+
+Spans nest through a context variable, eg, refresh -> page_fetch and
+refresh -> metadata_fetch, or action_cycle -> power_action. Work handed to
+a thread pool keeps its parent span when it is submitted with submit(), which
+also profiles it when submitted during a profiled cycle.
+
+Tracing is enabled by setting the trace_file environment variable, each
+finished span is appended as one JSON object per line.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from concurrent.futures import Executor, Future
+
+import lib.profiling as profiling
+
+log = logging.getLogger(__name__)
+
+trace_file = os.environ.get("trace_file")
+
+_current = contextvars.ContextVar("span", default=None)
+_lock = threading.Lock()
+_file = None
+
+
+def enabled() -> bool:
+    return trace_file is not None
+
+
+def _write(record: dict):
+    global _file
+
+    line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+    with _lock:
+        if _file is None:
+            _file = open(trace_file, "a", buffering=1)
+        _file.write(line)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Trace the enclosed block as a span, a no-op unless tracing is enabled
+
+    Args:
+        name: The span name, eg, page_fetch
+        attributes: Extra attributes recorded with the span
+    """
+
+    if not enabled():
+        yield
+        return
+
+    parent = _current.get()
+    record = {
+        "trace": parent["trace"] if parent else uuid.uuid4().hex[:16],
+        "span": uuid.uuid4().hex[:16],
+        "parent": parent["span"] if parent else None,
+        "name": name,
+        "thread": threading.current_thread().name,
+        "start": time.time(),
+    }
+    token = _current.set(record)
+    start = time.perf_counter()
+
+    try:
+        yield
+    except Exception as e:
+        attributes["error"] = str(e)
+        raise
+    finally:
+        _current.reset(token)
+        record["duration"] = time.perf_counter() - start
+        record["attributes"] = attributes
+        try:
+            _write(record)
+        except Exception as e:
+            log.debug(f"Failed to write span {name}: {e}")
+
+
+def submit(executor: Executor, fn, *args, **kwargs) -> Future:
+    """Submit work to an executor so its spans keep the current parent span and a profiled cycle profiles it too"""
+
+    return executor.submit(contextvars.copy_context().run, profiling.run, fn, *args, **kwargs)
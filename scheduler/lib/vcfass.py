@@ -5,12 +5,15 @@ https://cloud.ibm.com/apidocs/vmware-service#list-director-sites
 
 
 import logging
+import os
 from typing import Any
 
 from lib.requests_session import requests_session
 
 log = logging.getLogger(__name__)
 
+api_url = os.environ.get("ibmcloud_vcfaas_url", "https://api.{region}.vmware.cloud.ibm.com")  # Overridden to target a stand-in server
+
 
 def list_director_sites(ibm_iam_access_token: str, region: str) -> dict[str, Any]:
     """List Cloud Director site instances.
@@ -31,7 +34,7 @@ def list_director_sites(ibm_iam_access_token: str, region: str) -> dict[str, Any
     """
     s = requests_session()
 
-    base_url = f"https://api.{region}.vmware.cloud.ibm.com"
+    base_url = api_url.format(region=region)
 
     endpoint_url = "/".join([base_url, "v1", "director_sites"])
 
@@ -92,7 +95,7 @@ def list_vcfaas_vdcs(ibm_iam_access_token: str, region: str) -> dict[str, Any]:
    # request retry mechanism
     s = requests_session()
 
-    base_url = f"https://api.{region}.vmware.cloud.ibm.com"
+    base_url = api_url.format(region=region)
 
     endpoint_url = "/".join([base_url, "v1", "vdcs"])
 
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import lib.actions as actions
+
+vapp_href = "https://vcd/api/vApp/vapp-1"
+
+
+def action(n, key="ibm.manage.down"):
+    return {"key": key, "value": "0 18 * * *", "name": f"vm-{n}", "vm_href": f"https://vcd/api/vApp/vm-{n}", "vapp_href": vapp_href,
+            "vdc": "vdc-a", "boot_order": None}
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} error", response=response)
+
+
+def vapp_record(status=8, vms=2):
+    return {"name": "vapp-1", "status": status, "children": {"vm": [{"href": f"https://vcd/api/vApp/vm-{n}"} for n in range(vms)]}}
+
+
+@pytest.fixture
+def env():
+    rehydrated = []
+    return SimpleNamespace(director_url="https://vcd", vmware_access_token="token", rehydrated=rehydrated,
+                           rehydrate=lambda error: rehydrated.append(error.response.status_code))
+
+
+def test_vapp_is_read_again_after_a_401(env, monkeypatch):
+    replies = [http_error(401), vapp_record()]
+
+    def get_vapp_vm(vmware_access_token, href):
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(actions.cloud_director, "get_vapp_vm", get_vapp_vm)
+    group = [action(0), action(1)]
+
+    vapp_action = actions.get_vapp_action(env, vapp_href, "ibm.manage.down", group)
+    assert env.rehydrated == [401]
+    assert vapp_action["vapp"] and vapp_action["members"] == group and vapp_action["status"] == "POWERED_OFF"
+
+
+def test_vapp_that_cannot_be_read_powers_its_vms_individually(env, monkeypatch):
+    def get_vapp_vm(vmware_access_token, href):
+        raise http_error(503)
+
+    monkeypatch.setattr(actions.cloud_director, "get_vapp_vm", get_vapp_vm)
+    assert actions.get_vapp_action(env, vapp_href, "ibm.manage.down", [action(0), action(1)]) is None
+    assert env.rehydrated == []
+
+
+def test_vapp_with_other_vms_is_not_coalesced(env, monkeypatch):
+    monkeypatch.setattr(actions.cloud_director, "get_vapp_vm", lambda vmware_access_token, href: vapp_record(vms=3))
+    assert actions.get_vapp_action(env, vapp_href, "ibm.manage.down", [action(0), action(1)]) is None
+
+
+@pytest.mark.parametrize("status, outcome", [(8, "already_off"), (2, "already_off"), (18, "already_off"), (4, "powered_off"), (10, "powered_off")])
+def test_down_action_skips_vapps_already_off(env, monkeypatch, status, outcome):
+    sent = []
+    monkeypatch.setattr(actions.cloud_director, "get_vapp_vm", lambda vmware_access_token, href: vapp_record(status))
+    monkeypatch.setattr(actions.cloud_director, "powerOff", lambda href, token: sent.append(href) or {"href": "https://vcd/api/task/1"})
+
+    vapp_action = actions.get_vapp_action(env, vapp_href, "ibm.manage.down", [action(0), action(1)])
+    result = actions.execute_action(env, vapp_action)
+
+    assert result["outcome"] == outcome
+    assert sent == ([vapp_href] if outcome == "powered_off" else [])
+
+
+def test_failed_batch_reports_every_action_failed(env, monkeypatch):
+    def get_vapp_vm(vmware_access_token, href):
+        raise KeyError("unexpected")
+
+    monkeypatch.setattr(actions.cloud_director, "get_vapp_vm", get_vapp_vm)
+    executor = actions.ActionExecutor(workers=2)
+    batch = [action(0), action(1)]
+
+    reported = []
+    executor.dispatch(env, batch, reported.extend).join(5)
+    executor.shutdown()
+
+    assert [(result["action"], result["outcome"]) for result in reported] == [(batch[0], "failed"), (batch[1], "failed")]
@@ -0,0 +1,193 @@
+import threading
+import time
+
+from types import SimpleNamespace
+
+import lib.actions as actions
+import lib.tasks as tasks
+
+from lib.admission import AdmissionController, AdmissionQueue
+
+
+def power_on(name, vdc="vdc-a", vapp=None, boot_order=None, members=None):
+    action = {"key": "ibm.manage.up", "value": "0 8 * * *", "name": name, "vm_href": f"https://vcd/api/vApp/vm-{name}", "vapp_href": vapp,
+              "vdc": vdc, "boot_order": boot_order}
+    if members is not None:
+        action.update(vapp=True, vm_href=vapp, vapp_href=None, members=[{"name": member} for member in members])
+    return action
+
+
+def names(tickets):
+    return [ticket.action["name"] for ticket in tickets]
+
+
+def test_ramp_admits_the_burst_then_the_rate():
+    queue = AdmissionQueue(rate=2, burst=3, now=0)
+    for n in range(8):
+        queue.push(power_on(f"vm{n}"), now=0)
+
+    admitted, wait = queue.pop(now=0)
+    assert names(admitted) == ["vm0", "vm1", "vm2"]
+    assert wait == 0.5
+
+    assert queue.pop(now=0.25) == ([], 0.25)
+    admitted, _ = queue.pop(now=0.5)
+    assert names(admitted) == ["vm3"]
+    admitted, wait = queue.pop(now=2.0)
+    assert names(admitted) == ["vm4", "vm5", "vm6"]
+    assert wait == 0.5
+    assert len(queue) == 1
+
+
+def test_vapp_larger_than_the_burst_overdraws_a_full_bucket():
+    queue = AdmissionQueue(rate=1, burst=2, now=0)
+    queue.push(power_on("big", vapp="vapp-1", members=["a", "b", "c", "d"]), now=0)
+    queue.push(power_on("vm0"), now=0)
+
+    admitted, wait = queue.pop(now=0)
+    assert names(admitted) == ["big"]
+    # The bucket is 2 tokens short after the 4 Virtual Machine vApp
+    assert wait == 3
+
+
+def test_vdc_limit_holds_back_only_the_saturated_vdc():
+    queue = AdmissionQueue(vdc_limit=2, now=0)
+    a = [queue.push(power_on(f"a{n}", vdc="vdc-a"), now=0) for n in range(20)]
+    queue.push(power_on("b0", vdc="vdc-b"), now=0)
+    queue.push(power_on("b1", vdc="vdc-b"), now=0)
+
+    admitted, wait = queue.pop(now=0)
+    assert names(admitted) == ["a0", "a1", "b0", "b1"]
+    assert wait is None
+    assert queue.in_flight("vdc", "vdc-a") == 2
+
+    assert queue.pop(now=1) == ([], None)
+    queue.release(a[0])
+    assert names(queue.pop(now=1)[0]) == ["a2"]
+
+
+def test_vapp_limit():
+    queue = AdmissionQueue(vapp_limit=1, now=0)
+    first = queue.push(power_on("vm0", vapp="vapp-1"), now=0)
+    queue.push(power_on("vm1", vapp="vapp-1"), now=0)
+    queue.push(power_on("vm2", vapp="vapp-2"), now=0)
+
+    assert names(queue.pop(now=0)[0]) == ["vm0", "vm2"]
+    queue.release(first)
+    assert names(queue.pop(now=0)[0]) == ["vm1"]
+
+
+def test_vapp_larger_than_the_limit_is_admitted_alone():
+    queue = AdmissionQueue(vdc_limit=2, now=0)
+    single = queue.push(power_on("vm0"), now=0)
+    big = queue.push(power_on("big", vapp="vapp-1", members=["a", "b", "c"]), now=0)
+
+    assert names(queue.pop(now=0)[0]) == ["vm0"]
+    queue.release(single)
+    assert names(queue.pop(now=0)[0]) == ["big"]
+    assert queue.in_flight("vdc", "vdc-a") == 3
+
+    queue.release(big)
+    assert queue.in_flight("vdc", "vdc-a") == 0
+
+
+def test_boot_order_priority():
+    queue = AdmissionQueue(rate=1, burst=1, now=0)
+    queue.push(power_on("unordered"), now=0)
+    queue.push(power_on("app", boot_order=2), now=0)
+    queue.push(power_on("db", boot_order=1), now=0)
+    queue.push(power_on("first", boot_order=0), now=0)
+
+    order = []
+    for now in range(4):
+        order += names(queue.pop(now=now)[0])
+    assert order == ["first", "db", "app", "unordered"]
+
+
+def test_controller_starts_other_vdcs_while_one_is_saturated():
+    controller = AdmissionController(vdc_limit=2)
+    started = []
+    ready = threading.Event()
+
+    def start(ticket):
+        started.append(ticket)
+        if len(started) == 4:
+            ready.set()
+
+    for n in range(20):
+        controller.enqueue(power_on(f"a{n}", vdc="vdc-a"), start)
+    for n in range(4):
+        controller.enqueue(power_on(f"b{n}", vdc="vdc-b"), start)
+
+    assert ready.wait(5)
+    assert sorted(names(started)) == ["a0", "a1", "b0", "b1"]
+
+    controller.release(started[0])
+    controller.release(started[2])
+    deadline = time.monotonic() + 5
+    while len(started) < 6 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(names(started[4:])) == ["a2", "b2"]
+
+
+def test_held_power_ons_do_not_take_the_workers(monkeypatch):
+    sent = []
+    monkeypatch.setattr(actions.cloud_director, "query_vm", lambda **kwargs: [{"status": "UNKNOWN"}])
+    monkeypatch.setattr(actions.cloud_director, "powerOn", lambda href, token: sent.append(href) or {"href": f"{href}/task"})
+    monkeypatch.setattr(actions.cloud_director, "powerOff", lambda href, token: sent.append(href) or {"href": f"{href}/task"})
+
+    held = []
+    executor = actions.ActionExecutor(workers=1, coalesce_vapps=False, admission=AdmissionController(vdc_limit=1),
+                                      tracker=SimpleNamespace(hold=lambda task, release: held.append(release)))
+    env = SimpleNamespace(director_url="https://vcd", vmware_access_token="token")
+    batch = [power_on(f"a{n}", vdc="vdc-a") for n in range(3)] + [power_on("b0", vdc="vdc-b")]
+    batch.append({**power_on("c0", vdc="vdc-a"), "key": "ibm.manage.down"})
+
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(executor.run(env, batch)), daemon=True)
+    thread.start()
+
+    # The power-off and the other VDC go out while vdc-a waits for its first task
+    deadline = time.monotonic() + 5
+    while len(sent) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(href.rpartition("-")[2] for href in sent) == ["a0", "b0", "c0"]
+
+    while len(results) < len(batch) and time.monotonic() < deadline:
+        for release in held:
+            release()
+        held.clear()
+        time.sleep(0.01)
+    thread.join(1)
+    assert [result["outcome"] for result in results] == ["powered_off"] + ["powered_on"] * 4
+    executor.shutdown()
+
+
+def tracker(monkeypatch, status):
+    monkeypatch.setattr(tasks, "hold_poll_interval", 3600)
+    monkeypatch.setattr(tasks.cloud_director, "iter_query",
+                        lambda **kwargs: iter([{"href": "https://vcd/api/task/1", "status": status}]))
+    return tasks.TaskTracker(SimpleNamespace(director_url="https://vcd", vmware_access_token="token"))
+
+
+def test_hold_is_released_when_the_task_fails(monkeypatch):
+    released = []
+    task_tracker = tracker(monkeypatch, "error")
+    task_tracker.hold({"href": "https://vcd/api/task/1"}, lambda: released.append(True))
+
+    task_tracker.poll()
+    assert released == [True]
+    assert task_tracker.outstanding() == 0
+
+
+def test_hold_is_released_after_the_timeout(monkeypatch):
+    released = []
+    task_tracker = tracker(monkeypatch, "running")
+    task_tracker.hold({"href": "https://vcd/api/task/1"}, lambda: released.append(True))
+
+    task_tracker.poll()
+    assert released == []
+
+    monkeypatch.setattr(tasks, "hold_timeout", 0)
+    task_tracker.poll()
+    assert released == [True]
@@ -0,0 +1,107 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+
+import lib.credentials as credentials
+
+from lib.credentials import CredentialManager
+
+
+def jwt(expires):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": expires}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+@pytest.fixture
+def issued(monkeypatch):
+    # Issue numbered tokens, each VCD token expiring after the lifetime set on the namespace
+    issued = {"iam": [], "vcd": [], "lifetime": 3600, "delay": 0}
+
+    def request_ibm_iam_token(ibm_api_key):
+        time.sleep(issued["delay"])
+        issued["iam"].append(f"iam-{len(issued['iam'])}")
+        return {"access_token": issued["iam"][-1], "expiration": time.time() + 3600}
+
+    def get_vmware_access_token(ibm_iam_access_token, url, org):
+        time.sleep(issued["delay"])
+        issued["vcd"].append(jwt(time.time() + issued["lifetime"]))
+        return issued["vcd"][-1]
+
+    monkeypatch.setattr(credentials.iam, "request_ibm_iam_token", request_ibm_iam_token)
+    monkeypatch.setattr(credentials.vcfass, "get_vmware_access_token", get_vmware_access_token)
+    return issued
+
+
+def manager():
+    manager = CredentialManager(ibmcloud_api_key="key")
+    manager.configure_director(director_url="https://vcd", org="org")
+    return manager
+
+
+def test_token_expiry_reads_the_jwt_exp_claim():
+    assert credentials.token_expiry(jwt(1234567890), 1800) == 1234567890
+    assert abs(credentials.token_expiry("opaque", 1800) - (time.time() + 1800)) < 5
+
+
+def test_concurrent_callers_share_a_single_refresh(issued):
+    issued["delay"] = 0.1
+    tokens = manager()
+    results = []
+    barrier = threading.Barrier(8)
+
+    def call():
+        barrier.wait()
+        results.append(tokens.vmware_access_token())
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(issued["iam"]) == 1 and len(issued["vcd"]) == 1
+    assert results == issued["vcd"] * 8
+
+
+def test_invalidate_only_drops_the_rejected_token(issued):
+    tokens = manager()
+    first = tokens.vmware_access_token()
+
+    # A token other than the cached ones, eg, rejected before a refresh, changes nothing
+    tokens.invalidate("stale")
+    assert tokens.vmware_access_token() == first and tokens.iam_access_token() == "iam-0"
+
+    # The rejected VCD token is replaced, the IAM token is kept
+    tokens.invalidate(first)
+    second = tokens.vmware_access_token()
+    assert second != first and len(issued["vcd"]) == 2
+    assert tokens.iam_access_token() == "iam-0" and len(issued["iam"]) == 1
+
+    # Callers failing with the token already replaced do not refresh again
+    tokens.invalidate(first)
+    assert tokens.vmware_access_token() == second and len(issued["vcd"]) == 2
+
+    tokens.invalidate()
+    assert tokens.iam_access_token() == "iam-1"
+
+
+def test_background_refresh_before_the_token_expires(issued, monkeypatch):
+    monkeypatch.setattr(credentials, "refresh_margin", 1)
+    monkeypatch.setattr(credentials, "refresh_retry_pause", 0.05)
+    issued["lifetime"] = 1.5
+    tokens = manager()
+    first = tokens.vmware_access_token()
+
+    tokens.start()
+    try:
+        # Renewed about refresh_margin before its exp, while the first token is still valid
+        deadline = time.time() + 1.4
+        while len(issued["vcd"]) < 2 and time.time() < deadline:
+            time.sleep(0.02)
+        assert len(issued["vcd"]) >= 2
+        assert tokens.vmware_access_token() != first
+    finally:
+        tokens.stop()
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from lib.engine import ScheduleEngine, catch_up
+from lib.tag_store import TagStore
+from lib.tags import Tag
+
+start = datetime(2026, 10, 19, 7, 30, tzinfo=timezone.utc)  # A Monday
+
+
+def store(*tags):
+    return TagStore(tags)
+
+
+def up(vm, cron="0 8 * * *"):
+    return Tag("ibm.manage.up", cron, f"https://vcd/api/vApp/vm-{vm}", vm)
+
+
+def test_fires_when_due_and_reschedules():
+    engine = ScheduleEngine()
+    assert engine.update(store(up("a"), up("b", "0 9 * * *")), start) == 2
+    assert engine.next_fire() == start.replace(hour=8, minute=0)
+
+    assert engine.pop_due(start) == []
+    due = engine.pop_due(start.replace(hour=8, minute=0))
+    assert [(fire.tag.name, fire.missed) for fire in due] == [("a", 0)]
+    assert engine.next_fire() == start.replace(hour=9, minute=0)
+
+    engine.pop_due(start.replace(hour=9, minute=0))
+    assert engine.next_fire() == start.replace(hour=8, minute=0) + timedelta(days=1)
+
+
+def test_tag_edit_reschedules():
+    engine = ScheduleEngine()
+    engine.update(store(up("a")), start)
+
+    assert engine.update(store(up("a")), start) == 0
+    assert engine.update(store(up("a", "45 7 * * *")), start) == 1
+    assert engine.next_fire() == start.replace(hour=7, minute=45)
+
+    # The superseded 08:00 entry is dropped lazily and never fires
+    due = engine.pop_due(start.replace(hour=8, minute=30))
+    assert [(fire.tag.value, fire.fire_time.hour, fire.fire_time.minute) for fire in due] == [("45 7 * * *", 7, 45)]
+    assert engine.next_fire() == start.replace(hour=7, minute=45) + timedelta(days=1)
+
+
+def test_tag_removal_unschedules():
+    engine = ScheduleEngine()
+    engine.update(store(up("a"), up("b")), start)
+    engine.update(store(up("b")), start)
+
+    assert len(engine) == 1
+    assert [fire.tag.name for fire in engine.pop_due(start + timedelta(hours=1))] == ["b"]
+
+    engine.update(store(), start)
+    assert engine.next_fire() is None
+
+
+def test_stall_fires_once_and_counts_missed():
+    engine = ScheduleEngine()
+    engine.update(store(up("a", "*/15 * * * *")), start)
+
+    due = engine.pop_due(start + timedelta(hours=1, minutes=5))
+    assert len(due) == 1
+    assert due[0].fire_time == start.replace(hour=8, minute=30)
+    assert due[0].missed == 3
+    assert engine.next_fire() == start.replace(hour=8, minute=45)
+
+
+def fire(tag, fire_time, missed=0):
+    return SimpleNamespace(tag=tag, fire_time=fire_time, missed=missed)
+
+
+def test_fire_policy_fires_within_the_window():
+    now = start.replace(hour=8, minute=10)
+    fires = [fire(up("a"), start.replace(hour=8)), fire(up("b"), start.replace(hour=7, minute=50))]
+
+    assert [tag.name for tag in catch_up(fires, now, window=15 * 60, tolerance=60)] == ["a"]
+
+
+def test_skip_policy_skips_late_fires():
+    now = start.replace(hour=8, minute=0, second=30)
+    fires = [fire(up("a"), start.replace(hour=8)), fire(up("b"), start.replace(hour=7, minute=58), missed=2)]
+
+    assert [tag.name for tag in catch_up(fires, now, window=60, tolerance=60)] == ["a"]
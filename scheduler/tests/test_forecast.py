@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import dateutil.tz
+import pytest
+
+from croniter import croniter
+
+import lib.forecast as forecast
+
+from lib.tag_store import TagStore
+from lib.tags import Tag, region_timezones
+
+expressions = [
+    "*/15 * 1,15 * 1", "0 8 * * 1-5", "30 18 * * *", "0 * * * *", "*/20 1-3 * * *",
+    "30 1 * * *", "30 2 * * *", "15 2,3 * * *", "*/5 2 * * 0", "45 23 * * *", "0 0 1 * *",
+    "0 9 L * *", "0 7 * * 1#2",
+]
+
+# Windows around the 2026 and 2027 daylight saving transitions of the regions
+windows = [((2026, 3, 1), (2026, 4, 10)), ((2026, 10, 1), (2026, 11, 30)), ((2027, 3, 20), (2027, 4, 10))]
+
+
+def croniter_fires(cron, start, end):
+    fires = []
+    it = croniter(cron, start - timedelta(seconds=1))
+    while (fire := it.get_next(datetime)) < end:
+        fires.append(int(fire.timestamp()))
+    return fires
+
+
+@pytest.mark.parametrize("timezone", sorted(set(region_timezones.values())))
+@pytest.mark.parametrize("cron", expressions)
+def test_expand_matches_croniter(timezone, cron):
+    tz = dateutil.tz.gettz(timezone)
+    for start, end in windows:
+        start, end = datetime(*start, tzinfo=tz), datetime(*end, tzinfo=tz)
+        assert forecast.expand(cron, start, end) == croniter_fires(cron, start, end)
+
+
+def test_repeated_hour_fires_twice():
+    tz = dateutil.tz.gettz("America/Chicago")
+    start = datetime(2026, 10, 1, tzinfo=tz)
+
+    assert len(forecast.expand("*/15 * 1,15 * 1", start, datetime(2026, 11, 30, tzinfo=tz))) == 1156
+
+
+def test_forecast_counts_actions_and_powered_on_hours():
+    tz = dateutil.tz.gettz("Europe/Berlin")
+    start = datetime(2026, 10, 19, tzinfo=tz)  # A Monday
+    vm_tags = TagStore(
+        Tag(key, cron, f"https://vcd/api/vApp/vm-{n}", f"vm-{n}", vdc="vdc-a")
+        for n in range(3) for key, cron in (("ibm.manage.up", "0 8 * * 1-5"), ("ibm.manage.down", "0 18 * * 1-5"))
+    )
+
+    result = forecast.forecast(vm_tags, start, days=7, initial="off")
+
+    assert (result.tags, result.vms, result.schedules) == (6, 3, 2)
+    assert result.vdcs["vdc-a"].power_on == 15
+    assert result.peak_power_on == (int(start.replace(hour=8).timestamp()), 3)
+    assert result.peak_powered_on[1] == 3
+    assert result.powered_on_hours == pytest.approx(3 * 5 * 10)
@@ -0,0 +1,117 @@
+import json
+
+import pytest
+import requests
+
+import lib.metadata_cache as metadata_cache
+
+from lib.metadata_cache import MetadataCache
+
+
+def vm(n):
+    return f"https://vcd/api/vApp/vm-{n}"
+
+
+class Session:
+
+    # Serves the metadata of every Virtual Machine with ETag/If-None-Match like VCD, recording the requests
+
+    def __init__(self):
+        self.metadata = {}
+        self.etags = True
+        self.requests = []
+
+    def get(self, url, headers):
+        href = url.rpartition("/metadata")[0]
+        self.requests.append((href, headers.get("If-None-Match")))
+
+        response = requests.Response()
+        response.url = url
+        if href not in self.metadata:
+            response.status_code = 500
+            return response
+
+        etag = f'"{hash(json.dumps(self.metadata[href]))}"'
+        if self.etags:
+            response.headers["ETag"] = etag
+        if headers.get("If-None-Match") == etag:
+            response.status_code = 304
+        else:
+            response.status_code = 200
+            response._content = json.dumps(self.metadata[href]).encode()
+        return response
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = Session()
+    monkeypatch.setattr(metadata_cache.cloud_director, "requests_session", lambda: session)
+    return session
+
+
+def entries(value):
+    return {"metadataEntry": [{"key": "ibm.manage.up", "typedValue": {"value": value}}]}
+
+
+def test_unchanged_metadata_is_revalidated(session):
+    cache = MetadataCache()
+    session.metadata[vm(1)] = entries("0 8 * * *")
+
+    assert cache.get_vm_metadata(vmware_access_token="token", href=vm(1)) == entries("0 8 * * *")
+    assert cache.get_vm_metadata(vmware_access_token="token", href=vm(1)) == entries("0 8 * * *")
+
+    first, second = session.requests
+    assert first == (vm(1), None) and second[1] is not None
+    assert cache.reset_stats() == (1, 1)
+    assert cache.reset_stats() == (0, 0)
+
+
+def test_changed_metadata_replaces_the_cached_copy(session):
+    cache = MetadataCache()
+    session.metadata[vm(1)] = entries("0 8 * * *")
+    cache.get_vm_metadata(vmware_access_token="token", href=vm(1))
+
+    session.metadata[vm(1)] = entries("0 9 * * *")
+    assert cache.get_vm_metadata(vmware_access_token="token", href=vm(1)) == entries("0 9 * * *")
+    assert cache.get_vm_metadata(vmware_access_token="token", href=vm(1)) == entries("0 9 * * *")
+    assert cache.reset_stats() == (1, 2)
+
+
+def test_metadata_without_an_etag_is_not_cached(session):
+    cache = MetadataCache()
+    session.etags = False
+    session.metadata[vm(1)] = entries("0 8 * * *")
+
+    cache.get_vm_metadata(vmware_access_token="token", href=vm(1))
+    cache.get_vm_metadata(vmware_access_token="token", href=vm(1))
+
+    assert [etag for _, etag in session.requests] == [None, None]
+    assert len(cache) == 0
+
+
+def test_failed_request_keeps_the_cached_copy(session):
+    cache = MetadataCache()
+    session.metadata[vm(1)] = entries("0 8 * * *")
+    cache.get_vm_metadata(vmware_access_token="token", href=vm(1))
+
+    del session.metadata[vm(1)]
+    with pytest.raises(requests.exceptions.HTTPError):
+        cache.get_vm_metadata(vmware_access_token="token", href=vm(1))
+    assert len(cache) == 1
+
+
+def test_evict_drops_the_vms_no_longer_present(session):
+    cache = MetadataCache()
+    for n in range(3):
+        session.metadata[vm(n)] = entries("0 8 * * *")
+        cache.get_vm_metadata(vmware_access_token="token", href=vm(n))
+
+    assert cache.evict({vm(0), vm(2)}) == 1
+    assert len(cache) == 2
+    assert cache.evict({vm(0), vm(2)}) == 0
+
+    # An evicted Virtual Machine is downloaded in full again
+    session.requests.clear()
+    cache.get_vm_metadata(vmware_access_token="token", href=vm(1))
+    cache.get_vm_metadata(vmware_access_token="token", href=vm(2))
+    assert session.requests[0] == (vm(1), None) and session.requests[1][1] is not None
@@ -0,0 +1,125 @@
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+import urllib3
+
+from urllib3.exceptions import MaxRetryError
+
+import lib.requests_session as requests_session
+
+vcd = "https://vcd.example.com"
+
+
+def response(status, **headers):
+    return urllib3.response.HTTPResponse(status=status, headers=headers)
+
+
+def test_retries_stop_once_the_cycle_budget_is_spent():
+    with requests_session.retry_budget(2) as budget:
+        retry = requests_session.retry_policy("query").retry()
+        for _ in range(2):
+            retry = retry.increment(method="GET", url=f"{vcd}/api/query", response=response(503))
+
+        with pytest.raises(MaxRetryError):
+            retry.increment(method="GET", url=f"{vcd}/api/query", response=response(503))
+        assert budget.spent == 2
+
+    exhausted = dict((labels["endpoint"], value) for _, labels, value in requests_session.retry_budget_exhausted_total.samples())
+    assert exhausted["query"] >= 1
+
+
+def test_budget_is_per_cycle():
+    with requests_session.retry_budget(1):
+        requests_session.retry_policy("query").retry().increment(method="GET", url=f"{vcd}/api/query", response=response(503))
+    with requests_session.retry_budget(1):
+        requests_session.retry_policy("query").retry().increment(method="GET", url=f"{vcd}/api/query", response=response(503))
+
+    # Outside a cycle only the policy bounds the retries
+    requests_session.retry_policy("query").retry().increment(method="GET", url=f"{vcd}/api/query", response=response(503))
+
+
+def test_retry_after_is_capped():
+    retry = requests_session.retry_policy("query").retry()
+    assert retry.get_retry_after(response(503, **{"Retry-After": "5"})) == 5
+    assert retry.get_retry_after(response(429, **{"Retry-After": "3600"})) == requests_session.retry_after_max
+    assert retry.get_retry_after(response(503)) is None
+
+
+@pytest.mark.parametrize("url, name, timeout, total", [
+    (f"{vcd}/api/vApp/vm-1/metadata", "metadata", (10, 30), 2),
+    (f"{vcd}/api/vApp/vm-1/power/action/powerOn", "power_on", (10, 60), 2),
+    (f"{vcd}/api/query?type=vm&page=1", "query_vm", (10, 120), 4),
+    (f"{vcd}/cloudapi/1.0.0/sessions", "vcd_session", (10, 60), 4),
+])
+def test_endpoint_policies(url, name, timeout, total):
+    assert requests_session.endpoint(url) == name
+    policy = requests_session.retry_policy(name)
+    assert policy.timeout == timeout and policy.retry().total == total
+
+    # Only power calls are never sent again after a read error
+    assert policy.retry().read == (0 if name == "power_on" else None)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    # Record the retry and timeout every request reaches the transport with, two requests overlap
+    sent = {}
+    barrier = threading.Barrier(2)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        barrier.wait(5)
+        sent[request.url] = (self.max_retries, timeout)
+        barrier.wait(5)
+        reply = requests.Response()
+        reply.status_code = 200
+        return reply
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, "send", send)
+    return sent
+
+
+def test_shared_adapter_installs_the_policy_per_thread(sent):
+    adapter = requests_session.TimeoutHTTPAdapter()
+    default = adapter.max_retries
+    urls = [f"{vcd}/api/vApp/vm-1/power/action/powerOn", f"{vcd}/api/query?type=vm"]
+
+    threads = [threading.Thread(target=adapter.send, args=(requests.Request("GET", url).prepare(),)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    power_retry, power_timeout = sent[urls[0]]
+    query_retry, query_timeout = sent[urls[1]]
+    assert (power_retry.read, power_retry.status_forcelist, power_timeout) == (0, {429, 503}, (10, 60))
+    assert (query_retry.read, query_retry.total, query_timeout) == (None, 4, (10, 120))
+    assert adapter.max_retries is default
+
+
+class DroppingHandler(BaseHTTPRequestHandler):
+
+    # Counts the requests and closes the connection without a response, as if the response was lost
+
+    def do_POST(self):
+        self.server.requests += 1
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_power_call_with_a_lost_response_is_not_sent_again():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DroppingHandler)
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/api/vApp/vm-1/power/action/powerOn"
+        with pytest.raises(requests.exceptions.ConnectionError):
+            requests_session.requests_session().post(url)
+        assert server.requests == 1
+    finally:
+        server.shutdown()
@@ -0,0 +1,33 @@
+import time
+
+from lib.actions import RetryQueue
+
+
+def tag(name):
+    return {"key": "ibm.manage.up", "value": "0 8 * * *", "name": name, "vm_href": f"https://vcd/api/vApp/vm-{name}"}
+
+
+def test_failed_actions_are_retried_after_the_delay():
+    queue = RetryQueue(retries=2, delay=60)
+    vapp = {"key": "ibm.manage.up", "name": "vapp", "vm_href": "https://vcd/api/vApp/vapp-1", "vapp": True,
+            "members": [tag("b"), tag("c")]}
+    results = [{"action": tag("a"), "outcome": "failed"}, {"action": vapp, "outcome": "failed"},
+               {"action": tag("d"), "outcome": "powered_on"}]
+
+    assert queue.add(results, attempt=0) == 3
+    now = time.monotonic()
+    assert queue.pop_due(now) == {}
+    assert 59 < queue.next_due(now) <= 60
+
+    due = queue.pop_due(now + 60)
+    assert [t["name"] for t in due[1]] == ["a", "b", "c"]
+    assert queue.next_due(now) is None
+
+
+def test_retries_are_bounded():
+    queue = RetryQueue(retries=1, delay=60)
+    failed = [{"action": tag("a"), "outcome": "failed"}]
+
+    assert queue.add(failed, attempt=0) == 1
+    assert queue.add(failed, attempt=1) == 0
+    assert RetryQueue(retries=0, delay=60).add(failed, attempt=0) == 0
@@ -0,0 +1,72 @@
+import time
+
+from lib.sharding import HashRing, ShardCoordinator, SqliteLeaseBackend, shard_key
+
+keys = [f"https://vcd/api/vApp/vm-{n}" for n in range(2000)]
+
+
+def owners(ring):
+    return {key: ring.owner(key) for key in keys}
+
+
+def test_join_only_moves_keys_to_the_new_replica():
+    before = owners(HashRing(["a", "b", "c"]))
+    after = owners(HashRing(["a", "b", "c", "d"]))
+
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(after[key] == "d" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+
+
+def test_leave_only_moves_the_keys_of_the_leaving_replica():
+    before = owners(HashRing(["a", "b", "c", "d"]))
+    after = owners(HashRing(["a", "b", "c"]))
+
+    assert all(before[key] == "d" for key in keys if before[key] != after[key])
+    assert "d" not in after.values()
+
+
+def test_ring_is_independent_of_replica_order():
+    assert owners(HashRing(["c", "a", "b"])) == owners(HashRing(["a", "b", "c"]))
+
+
+def test_vms_of_a_vapp_share_a_shard():
+    ring = HashRing(["a", "b", "c", "d"])
+    vapp = "https://vcd/api/vApp/vapp-7"
+
+    assert len({ring.owner(shard_key(f"https://vcd/api/vApp/vm-{n}", vapp)) for n in range(50)}) == 1
+    assert shard_key("https://vcd/api/vApp/vm-1") == "https://vcd/api/vApp/vm-1"
+
+
+def test_empty_ring_owns_nothing():
+    assert HashRing([]).owner(keys[0]) is None
+
+
+def test_lease_expiry_and_release(tmp_path):
+    backend = SqliteLeaseBackend(str(tmp_path / "leases.db"), ttl=0.2)
+    backend.heartbeat("a")
+    backend.heartbeat("b")
+    assert sorted(backend.live_replicas()) == ["a", "b"]
+
+    time.sleep(0.3)
+    backend.heartbeat("a")
+    assert backend.live_replicas() == ["a"]
+
+    backend.release("a")
+    assert backend.live_replicas() == []
+
+
+def test_coordinator_takes_over_an_expired_peer(tmp_path):
+    path = str(tmp_path / "leases.db")
+    peer = SqliteLeaseBackend(path, ttl=0.2)
+    peer.heartbeat("b")
+
+    coordinator = ShardCoordinator(SqliteLeaseBackend(path, ttl=0.2), "a")
+    coordinator.stop()
+    version = coordinator.version
+    assert not all(coordinator.owns(key) for key in keys)
+
+    time.sleep(0.3)
+    assert coordinator.refresh() == version + 1
+    assert all(coordinator.owns(key) for key in keys)
+    assert coordinator.refresh() == version + 1
@@ -0,0 +1,96 @@
+import gzip
+import json
+import time
+
+import lib.snapshot as snapshot
+
+from lib.tag_store import TagStore
+from lib.tags import Tag
+
+up, down = "ibm.manage.up", "ibm.manage.down"
+vapp = "https://vcd/api/vApp/vapp-1"
+
+
+def inventory():
+    return TagStore([
+        Tag(up, "0 8 * * 1-5", "https://vcd/api/vApp/vm-1", "db", vapp, "vdc-a", 1),
+        Tag(down, "0 18 * * 1-5", "https://vcd/api/vApp/vm-1", "db", vapp, "vdc-a", 1),
+        Tag(up, "0 8 * * 1-5", "https://vcd/api/vApp/vm-2", "app", vapp, "vdc-a", 2),
+        Tag(down, "0 18 * * 1-5", "https://vcd/api/vApp/vm-2", "app", vapp, "vdc-a"),
+        Tag(up, "30 7 * * *", "https://vcd/api/vApp/vm-3", "standalone"),
+    ])
+
+
+def write(path, fields, strings, rows, saved=None, version=snapshot.snapshot_version):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump({"version": version, "saved": time.time() if saved is None else saved,
+                   "fields": fields, "strings": strings, "tags": rows}, f)
+
+
+def test_round_trip_keeps_every_field(tmp_path):
+    path = str(tmp_path / "site.json.gz")
+    snapshot.save(path, inventory())
+
+    loaded = snapshot.load(path)
+    assert loaded == inventory()
+    assert loaded.get("https://vcd/api/vApp/vm-1", up)["boot_order"] == 1
+    assert loaded.get("https://vcd/api/vApp/vm-3", up)["vapp_href"] is None
+
+
+def test_repeated_strings_are_stored_once(tmp_path):
+    path = str(tmp_path / "site.json.gz")
+    snapshot.save(path, inventory())
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        saved = json.load(f)
+    assert len(saved["strings"]) == len(set(map(json.dumps, saved["strings"])))
+    assert saved["strings"].count("0 8 * * 1-5") == 1
+    assert saved["strings"].count(vapp) == 1
+    assert len(saved["tags"]) == 5
+
+
+def test_older_snapshot_without_vdc_and_boot_order_loads(tmp_path):
+    path = str(tmp_path / "site.json.gz")
+    write(path, ["key", "value", "vm_href", "name", "vapp_href"],
+          [up, "0 8 * * *", "https://vcd/api/vApp/vm-1", "web", vapp], [[0, 1, 2, 3, 4]])
+
+    tag = snapshot.load(path).get("https://vcd/api/vApp/vm-1", up)
+    assert tag["value"] == "0 8 * * *" and tag["vapp_href"] == vapp
+    assert tag["vdc"] is None and tag["boot_order"] is None
+
+
+def test_snapshot_older_than_max_age_is_ignored(tmp_path):
+    path = str(tmp_path / "site.json.gz")
+    write(path, snapshot.tag_fields, [up, "0 8 * * *", "https://vcd/api/vApp/vm-1", "web", None],
+          [[0, 1, 2, 3, 4, 4, 4]], saved=time.time() - 7200)
+
+    assert len(snapshot.load(path, max_age=3600)) == 0
+    assert len(snapshot.load(path, max_age=10800)) == 1
+    assert len(snapshot.load(path)) == 1
+
+
+def test_unusable_snapshot_loads_empty(tmp_path):
+    path = str(tmp_path / "site.json.gz")
+    assert len(snapshot.load(path)) == 0
+
+    write(path, snapshot.tag_fields, [up], [[0]], version=snapshot.snapshot_version + 1)
+    assert len(snapshot.load(path)) == 0
+
+    with open(path, "wb") as f:
+        f.write(b"not gzip")
+    assert len(snapshot.load(path)) == 0
+
+
+def test_snapshot_path_is_a_safe_file_name():
+    assert snapshot.snapshot_path("snapshots", "IBM VCFaaS Multitenant - FRA/my-org") == \
+        "snapshots/IBM_VCFaaS_Multitenant_-_FRA_my-org.json.gz"
+
+
+def test_replicas_sharing_a_directory_keep_their_own_shard(tmp_path):
+    shards = {"replica-a": TagStore(list(inventory())[:2]), "replica-b": TagStore(list(inventory())[2:])}
+    for replica, shard in shards.items():
+        snapshot.save(snapshot.snapshot_path(str(tmp_path), "FRA/my-org", replica), shard)
+
+    assert snapshot.snapshot_path(str(tmp_path), "FRA/my-org", "replica-a") != snapshot.snapshot_path(str(tmp_path), "FRA/my-org")
+    for replica, shard in shards.items():
+        assert snapshot.load(snapshot.snapshot_path(str(tmp_path), "FRA/my-org", replica)) == shard
@@ -0,0 +1,75 @@
+import pytest
+
+from lib.tag_store import Inventory, TagStore, tag_id
+from lib.tags import Tag
+
+up, down = "ibm.manage.up", "ibm.manage.down"
+
+
+def tag(n, key=up, cron="0 8 * * *", **fields):
+    # Build the strings at runtime so equal tags do not share constant objects
+    return Tag(key, "".join(cron), f"https://vcd/api/vApp/vm-{n}", f"vm-{n}", **fields)
+
+
+def test_equal_tags_compare_every_field():
+    assert tag(1) == tag(1)
+    assert hash(tag(1)) == hash(tag(1))
+    assert tag(1) != tag(1, cron="0 9 * * *")
+    assert tag(1) != tag(1, vdc="vdc-a")
+    assert tag(1, boot_order=1) != tag(1, boot_order=2)
+    assert tag(1, vapp_href="https://vcd/api/vApp/vapp-1") != tag(1)
+
+
+def test_tags_share_interned_strings():
+    first, second = tag(1), tag(2)
+    assert first.value is second.value and first.key is second.key
+
+    with pytest.raises(AttributeError):
+        first.extra = True
+
+
+def test_tags_read_like_dictionaries():
+    tagged = tag(1, vdc="vdc-a")
+    assert tagged["vm_href"] == "https://vcd/api/vApp/vm-1" and tagged.get("vdc") == "vdc-a"
+    assert tagged.get("missing", 0) == 0
+    with pytest.raises(KeyError):
+        tagged["missing"]
+
+
+def test_diff_reports_added_changed_and_removed_tags():
+    previous = TagStore([tag(1), tag(1, down, "0 18 * * *"), tag(2), tag(3, boot_order=1)])
+    current = TagStore([tag(1), tag(2, cron="0 9 * * *"), tag(3, boot_order=2), tag(4)])
+
+    diff = current.diff(previous)
+    assert diff.added == [tag_id(tag(4))]
+    assert sorted(diff.changed) == sorted([tag_id(tag(2)), tag_id(tag(3))])
+    assert diff.removed == [tag_id(tag(1, down))]
+
+
+def test_diff_of_an_equal_inventory_is_empty():
+    diff = TagStore([tag(1), tag(2)]).diff(TagStore([tag(2), tag(1)]))
+    assert (diff.added, diff.changed, diff.removed) == ([], [], [])
+
+    assert len(TagStore([tag(1)]).diff(None).added) == 1
+
+
+def test_indexes_follow_replaced_and_discarded_tags():
+    store = TagStore([tag(1), tag(1, down, "0 18 * * *"), tag(2)])
+    store.add(tag(1, cron="0 9 * * *"))
+
+    assert len(store) == 3
+    assert sorted(t.name for t in store.for_cron("0 8 * * *")) == ["vm-2"]
+    assert sorted(store.crons()) == ["0 18 * * *", "0 8 * * *", "0 9 * * *"]
+    assert {t.value for t in store.for_vm("https://vcd/api/vApp/vm-1")} == {"0 9 * * *", "0 18 * * *"}
+
+    store.discard(tag_id(tag(2)))
+    store.discard(tag_id(tag(5)))
+    assert "0 8 * * *" not in store.crons() and store.get("https://vcd/api/vApp/vm-2", up) is None
+
+
+def test_published_inventory_is_read_only():
+    inventory = Inventory(version=0, tags=TagStore().freeze(), published=0).publish(TagStore([tag(1)]))
+
+    assert inventory.version == 1
+    with pytest.raises(TypeError):
+        inventory.tags.add(tag(2))
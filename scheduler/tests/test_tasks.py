@@ -0,0 +1,108 @@
+from types import SimpleNamespace
+
+import pytest
+
+import lib.tasks as tasks
+
+from lib.tasks import TaskTracker
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    # Tasks are polled by the tests, the background poller never wakes up in time
+    monkeypatch.setattr(tasks, "poll_interval", 3600)
+    monkeypatch.setattr(tasks, "hold_poll_interval", 3600)
+    env = SimpleNamespace(director_url="https://vcd", vmware_access_token="token", name="tracker-site", rehydrate=None)
+    return TaskTracker(env)
+
+
+@pytest.fixture
+def query(monkeypatch):
+    # Serve the task records, recording the filter and fields of every query
+    calls = []
+    records = {}
+
+    def iter_query(director_url, vmware_access_token, query_type, filter, fields=None, workers=1):
+        calls.append(SimpleNamespace(query_type=query_type, filter=filter, fields=fields))
+        return iter(records.values())
+
+    monkeypatch.setattr(tasks.cloud_director, "iter_query", iter_query)
+    return SimpleNamespace(calls=calls, records=records)
+
+
+def result(n, outcome="powered_on"):
+    return {"action": {"name": f"vm-{n}"}, "outcome": outcome, "task": {"href": f"https://vcd/api/task/{n}"}}
+
+
+def finish(query, n, status="success", end="2026-10-19T08:00:30.000Z"):
+    href = f"https://vcd/api/task/{n}"
+    query.records[href] = {"href": href, "status": status, "endDate": end}
+
+
+def powered_on_count(site):
+    return sum(value for name, labels, value in tasks.time_to_powered_on_seconds.samples()
+               if name.endswith("_count") and labels["site"] == site)
+
+
+def test_records_the_time_to_powered_on_of_finished_tasks(tracker, query):
+    cycle = tasks.parse_date("2026-10-19T08:00:00.000Z")
+    tracker.track(cycle, [result(1), result(2), result(3), result(4, "powered_off"), {"action": {}, "outcome": "already_on", "task": None}])
+    assert tracker.outstanding() == 4
+
+    finish(query, 1)
+    finish(query, 2, end="2026-10-19T08:01:30.000Z")
+    finish(query, 3, status="error")
+    finish(query, 4)
+    query.records["https://vcd/api/task/other"] = {"href": "https://vcd/api/task/other", "status": "success"}
+    tracker.poll()
+
+    assert tracker.outstanding() == 0
+    assert tracker.percentiles(cycle) == {"count": 2, "p50": 30, "p90": 90, "p99": 90}
+    assert powered_on_count("tracker-site") >= 2
+
+
+def test_queries_only_the_tracked_tasks_and_the_fields_used(tracker, query):
+    tracker.track(1.0, [result(n) for n in range(tasks.task_batch + 1)])
+    tracker.poll()
+
+    assert [call.query_type for call in query.calls] == ["task", "task"]
+    assert all(call.fields == ["href", "status", "endDate"] for call in query.calls)
+    filtered = {href.partition("href==")[2] for call in query.calls for href in call.filter.strip("()").split(",")}
+    assert filtered == {f"https://vcd/api/task/{n}" for n in range(tasks.task_batch + 1)}
+    assert tracker.outstanding() == tasks.task_batch + 1
+
+
+def test_many_tasks_are_queried_by_start_date(tracker, query):
+    tracker.track(1.0, [result(n) for n in range(tasks.task_batch * tasks.max_task_batches + 1)])
+    tracker.poll()
+
+    assert len(query.calls) == 1 and query.calls[0].filter.startswith("startDate=ge=")
+
+
+def test_unfinished_tasks_time_out(tracker, query, monkeypatch):
+    cycle = 1.0
+    tracker.track(cycle, [result(1)])
+    tracker.poll()
+    assert tracker.outstanding() == 1
+
+    monkeypatch.setattr(tasks, "task_timeout", 0)
+    tracker.poll()
+    assert tracker.outstanding() == 0
+    assert tracker.percentiles(cycle)["count"] == 0
+
+
+def test_holds_are_released_when_their_task_finishes_or_times_out(tracker, query, monkeypatch):
+    released = []
+    tracker.hold({"href": "https://vcd/api/task/1"}, lambda: released.append(1))
+    tracker.hold({"href": "https://vcd/api/task/2"}, lambda: released.append(2))
+
+    tracker.poll()
+    assert released == []
+
+    finish(query, 1, status="error")
+    tracker.poll()
+    assert released == [1]
+
+    monkeypatch.setattr(tasks, "hold_timeout", 0)
+    tracker.poll()
+    assert released == [1, 2] and tracker.outstanding() == 0
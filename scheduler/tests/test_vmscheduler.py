@@ -0,0 +1,284 @@
+import threading
+import time
+
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import lib.snapshot as snapshot
+import vmscheduler
+
+from lib.tag_store import Inventory, TagStore
+from lib.tags import Tag
+
+up, down = "ibm.manage.up", "ibm.manage.down"
+
+
+def vm(n, *crons):
+    href = f"https://vcd/api/vApp/vm-{n}"
+    return [Tag(key, cron, href, f"vm-{n}") for key, cron in zip((up, down), crons)]
+
+
+def site(vm_tags=(), **attributes):
+    ns = SimpleNamespace(inventory=Inventory(version=0, tags=TagStore(vm_tags).freeze(), published=0),
+                         vm_tags_changed=threading.Event(), shard=None)
+    for name, value in attributes.items():
+        setattr(ns, name, value)
+    return ns
+
+
+def test_reconciled_unchanged_inventory_keeps_its_snapshot_fresh(tmp_path, monkeypatch):
+    path = str(tmp_path / "site.json.gz")
+    inventory = vm(1, "0 8 * * *", "0 18 * * *")
+    ns = site(inventory, snapshot_path=path)
+
+    # Saved when the tags last changed, more than max_age ago
+    saved = time.time() - 2 * vmscheduler.snapshot_max_age
+    monkeypatch.setattr(snapshot.time, "time", lambda: saved)
+    snapshot.save(path, ns.inventory.tags)
+    monkeypatch.undo()
+    assert len(snapshot.load(path, max_age=vmscheduler.snapshot_max_age)) == 0
+
+    # An incremental refresh without changes does not rewrite it, a full rescan does
+    vmscheduler.publish_tags(ns, TagStore(inventory))
+    assert len(snapshot.load(path, max_age=vmscheduler.snapshot_max_age)) == 0
+
+    vmscheduler.publish_tags(ns, TagStore(inventory), reconciled=True)
+    assert snapshot.load(path, max_age=vmscheduler.snapshot_max_age) == TagStore(inventory)
+    assert ns.inventory.version == 0 and not ns.vm_tags_changed.is_set()
+
+
+def test_changed_inventory_is_published_and_saved(tmp_path):
+    path = str(tmp_path / "site.json.gz")
+    ns = site(vm(1, "0 8 * * *"), snapshot_path=path)
+
+    changed = TagStore(vm(1, "0 9 * * *") + vm(2, "0 8 * * *"))
+    vmscheduler.publish_tags(ns, changed)
+
+    assert ns.inventory.version == 1 and ns.inventory.tags == changed
+    assert ns.vm_tags_changed.is_set()
+    assert snapshot.load(path) == changed
+
+
+class Stop(BaseException):
+    pass
+
+
+def test_schedule_loop_survives_an_unexpected_error(monkeypatch):
+    calls = []
+
+    def get_now(region):
+        # Fail the first cycle, then leave the loop on the second
+        calls.append(region)
+        raise RuntimeError("unexpected") if len(calls) == 1 else Stop()
+
+    monkeypatch.setattr(vmscheduler.tags, "get_now", get_now)
+    monkeypatch.setattr(vmscheduler, "loop_error_pause", 0)
+    ns = site(env=SimpleNamespace(name="loop-site", ibmcloud_region="eu-de", director_url="https://vcd", vmware_access_token="token"))
+
+    with pytest.raises(Stop):
+        vmscheduler.schedule_loop(ns)
+
+    assert len(calls) == 2
+    assert ("vmscheduler_loop_errors_total", {"site": "loop-site", "loop": "schedule"}, 1) in vmscheduler.loop_errors_total.samples()
+
+
+def event(n, timestamp, entity="vm"):
+    return {"eventType": f"com/vmware/cloud/event/{entity}/modify", "timestamp": timestamp,
+            "entity": {"id": f"urn:vcloud:{entity}:{n}"}}
+
+
+class Director:
+
+    # Serves a stubbed audit trail, Virtual Machine query and metadata, recording the requests
+
+    def __init__(self, events=()):
+        self.events = list(events)
+        self.crons = {}
+        self.failing = set()
+        self.reads = []
+        self.filters = []
+        self.fetched = []
+
+    def iter_audit_trail(self, director_url, vmware_access_token, since):
+        self.reads.append(since)
+        return iter([e for e in self.events if e["timestamp"] >= since])
+
+    def iter_query_vm(self, director_url, vmware_access_token, filter, fields, workers=None):
+        self.filters.append(filter)
+        return iter([{"name": f"vm-{n}", "href": f"https://vcd/api/vApp/vm-{n}", "container": "https://vcd/api/vApp/vapp-1"}
+                     for n in sorted(self.crons) if not filter.startswith("(") or f"vm-{n}" in filter or "vapp-1" in filter])
+
+    def get_vm_metadata(self, href, vmware_access_token):
+        n = int(href.rpartition("-")[2])
+        self.fetched.append(n)
+        if n in self.failing:
+            raise RuntimeError("metadata unavailable")
+        return {"metadataEntry": [{"key": up, "typedValue": {"value": self.crons[n]}}] if self.crons[n] else []}
+
+    def evict(self, hrefs):
+        return 0
+
+    def reset_stats(self):
+        return 0, 0
+
+    def __len__(self):
+        return 0
+
+
+@pytest.fixture
+def director(monkeypatch):
+    director = Director()
+    monkeypatch.setattr(vmscheduler.cloud_director, "iter_audit_trail", director.iter_audit_trail)
+    monkeypatch.setattr(vmscheduler.cloud_director, "iter_query_vm", director.iter_query_vm)
+    monkeypatch.setattr(vmscheduler, "discovery_mode", "metadata")
+    return director
+
+
+def audit_site(director, vm_tags=(), **attributes):
+    return site(vm_tags, metadata_cache=director, metadata_fetched={},
+                env=SimpleNamespace(name="audit-site", ibmcloud_region="eu-de", director_url="https://vcd", vmware_access_token="token"),
+                **attributes)
+
+
+def crons(vm_tags):
+    return {(tag.name, tag.key, tag.value) for tag in vm_tags}
+
+
+def test_watermark_advances_to_the_latest_event(director):
+    director.crons = {1: "0 9 * * *", 2: "0 8 * * *"}
+    director.events = [event(1, "2026-01-01T10:00:01.000Z"), event(2, "2026-01-01T10:00:02.500Z")]
+    ns = audit_site(director, vm(1, "0 8 * * *"))
+
+    vm_metadata, vm_count, watermark, seen = vmscheduler.refresh_changed_tags(ns, "2026-01-01T10:00:00.000Z")
+
+    assert crons(vm_metadata) == crons(vm(1, "0 9 * * *") + vm(2, "0 8 * * *")) and vm_count == 2
+    assert watermark == "2026-01-01T10:00:02.500Z" and len(seen) == 2
+
+    # The next read reaches back audit_overlap seconds before the watermark
+    assert director.reads == [vmscheduler.audit_timestamp(vmscheduler.parse_date("2026-01-01T10:00:00.000Z") - vmscheduler.audit_overlap)]
+
+
+def test_overlapping_events_are_handled_once(director):
+    director.crons = {1: "0 9 * * *", 2: "0 8 * * *"}
+    director.events = [event(1, "2026-01-01T10:00:01.000Z")]
+    ns = audit_site(director)
+    _, _, watermark, seen = vmscheduler.refresh_changed_tags(ns, "2026-01-01T10:00:00.000Z")
+
+    # An event recorded late, behind the watermark, is still picked up; the one already handled is not
+    director.events.append(event(2, "2026-01-01T10:00:00.500Z"))
+    director.filters.clear()
+    _, vm_count, next_watermark, next_seen = vmscheduler.refresh_changed_tags(ns, watermark, seen)
+
+    assert vm_count == 1 and "vm-1" not in director.filters[0]
+    assert next_watermark == watermark and len(next_seen) == 2
+
+    # Nothing new leaves the inventory as it is
+    director.filters.clear()
+    vm_metadata, vm_count, _, _ = vmscheduler.refresh_changed_tags(ns, next_watermark, next_seen)
+    assert vm_metadata is ns.inventory.tags and vm_count == 0 and director.filters == []
+
+
+def test_watermark_holds_while_a_metadata_fetch_fails(director):
+    director.crons = {1: "0 9 * * *", 2: "0 9 * * *"}
+    director.failing = {2}
+    director.events = [event(1, "2026-01-01T10:00:01.000Z"), event(2, "2026-01-01T10:00:02.000Z")]
+    ns = audit_site(director, vm(2, "0 8 * * *"))
+
+    vm_metadata, _, watermark, seen = vmscheduler.refresh_changed_tags(ns, "2026-01-01T10:00:00.000Z", frozenset({"earlier"}))
+
+    # The failed Virtual Machine keeps its tags and its events are read again
+    assert crons(vm_metadata) == crons(vm(1, "0 9 * * *") + vm(2, "0 8 * * *"))
+    assert watermark == "2026-01-01T10:00:00.000Z" and seen == frozenset({"earlier"})
+
+
+def test_vapp_events_refetch_the_vms_of_the_vapp(director):
+    director.crons = {1: "0 9 * * *", 2: "0 9 * * *"}
+    director.events = [event(1, "2026-01-01T10:00:01.000Z", entity="vapp")]
+    ns = audit_site(director, vm(1, "0 8 * * *") + vm(2, "0 8 * * *"))
+
+    vm_metadata, vm_count, _, _ = vmscheduler.refresh_changed_tags(ns, "2026-01-01T10:00:00.000Z")
+
+    assert director.filters[0].startswith("(container==https://vcd/api/vApp/vapp-1)")
+    assert vm_count == 2 and crons(vm_metadata) == crons(vm(1, "0 9 * * *") + vm(2, "0 9 * * *"))
+
+
+def test_unreadable_audit_trail_falls_back_to_a_full_rescan(director, monkeypatch, tmp_path):
+    refreshes = []
+
+    def refresh_tags(ns):
+        # The second full rescan ends the test
+        refreshes.append(time.time())
+        if len(refreshes) == 2:
+            raise Stop()
+        return TagStore(), 0
+
+    def iter_audit_trail(director_url, vmware_access_token, since):
+        director.reads.append(since)
+        response = requests.Response()
+        response.status_code = 500
+        raise requests.exceptions.HTTPError(response=response)
+
+    monkeypatch.setattr(vmscheduler, "refresh_tags", refresh_tags)
+    monkeypatch.setattr(vmscheduler.cloud_director, "iter_audit_trail", iter_audit_trail)
+    monkeypatch.setattr(vmscheduler, "revalidate_hot", lambda ns: None)
+    monkeypatch.setattr(vmscheduler, "incremental_refresh", True)
+    monkeypatch.setattr(vmscheduler, "incremental_pause", 0)
+    ns = audit_site(director, snapshot_path=str(tmp_path / "site.json.gz"))
+
+    with pytest.raises(Stop):
+        vmscheduler.vm_tag_update(ns)
+
+    # The incremental read after the first full rescan reached back audit_overlap seconds before it started
+    started = refreshes[0]
+    (since,) = director.reads
+    assert started - vmscheduler.audit_overlap - 1 <= vmscheduler.parse_date(since) <= started - vmscheduler.audit_overlap
+
+    # Its failure dropped the watermark, so the next refresh was a full rescan
+    assert len(refreshes) == 2 and ns.audit_watermark is None
+
+
+def test_full_refresh_reuses_the_metadata_of_vms_without_an_action_due(director, monkeypatch):
+    # Virtual Machine 1 fires within the cold refresh interval, 2 much later and 3 is untagged
+    now = vmscheduler.tags.get_now("eu-de")
+    soon = f"{(now.minute + 5) % 60} * * * *"
+    later = "0 0 1 7 *" if (now.month, now.day) in ((12, 31), (1, 1)) else "0 0 1 1 *"
+    director.crons = {1: soon, 2: later, 3: None}
+    monkeypatch.setattr(vmscheduler, "cold_refresh_interval", 900)
+
+    ns = audit_site(director)
+    vm_metadata, _ = vmscheduler.refresh_tags(ns)
+    ns.inventory = ns.inventory.publish(vm_metadata)
+    assert sorted(director.fetched) == [1, 2, 3]
+
+    # Only the Virtual Machine about to fire, and one never fetched, are fetched again
+    director.crons[4] = later
+    director.fetched.clear()
+    vm_metadata, vm_count = vmscheduler.refresh_tags(ns)
+
+    assert sorted(director.fetched) == [1, 4] and vm_count == 4
+    assert crons(vm_metadata) == crons(vm(1, soon) + vm(2, later) + vm(4, later))
+
+    # Once the interval has passed every Virtual Machine is fetched again
+    ns.metadata_fetched = {href: fetched - 900 for href, fetched in ns.metadata_fetched.items()}
+    director.fetched.clear()
+    vmscheduler.refresh_tags(ns)
+    assert sorted(director.fetched) == [1, 2, 3, 4]
+
+
+def test_moved_vm_is_fetched_again(director, monkeypatch):
+    director.crons = {1: "0 0 1 1 *"}
+    monkeypatch.setattr(vmscheduler, "cold_refresh_interval", 900)
+
+    ns = audit_site(director)
+    ns.inventory = ns.inventory.publish(vmscheduler.refresh_tags(ns)[0])
+
+    # The tags carry the vApp of the record, a moved Virtual Machine is not reused
+    monkeypatch.setattr(director, "iter_query_vm", lambda **query: iter([{"name": "vm-1", "href": "https://vcd/api/vApp/vm-1",
+                                                                         "container": "https://vcd/api/vApp/vapp-2"}]))
+    monkeypatch.setattr(vmscheduler.cloud_director, "iter_query_vm", director.iter_query_vm)
+    director.fetched.clear()
+    vm_metadata, _ = vmscheduler.refresh_tags(ns)
+
+    assert director.fetched == [1] and {tag.vapp_href for tag in vm_metadata} == {"https://vcd/api/vApp/vapp-2"}
@@ -7,18 +7,78 @@ import requests
 import threading
 import time
 import signal
+import socket
 import lib.logger as logger
-import lib.iam as iam
 import lib.vcfass as vcfass
 import lib.cloud_director as cloud_director
+import lib.credentials as credentials
+import lib.metadata_cache as metadata_cache
+import lib.metrics as metrics
+import lib.profiling as profiling
+import lib.requests_session as requests_session
+import lib.snapshot as snapshot
 import lib.tags as tags
-
+import lib.tag_store as tag_store
+import lib.tracing as tracing
+
+from concurrent.futures import ThreadPoolExecutor
+from lib.actions import ActionExecutor, RetryQueue
+from lib.admission import AdmissionController
+from lib.engine import ScheduleEngine, catch_up
+from lib.sharding import ShardCoordinator, SqliteLeaseBackend
+from lib.tasks import TaskTracker, parse_date
 from types import SimpleNamespace
+from typing import Optional
 from urllib.parse import urlparse
-from datetime import datetime, timedelta
-
-tag_update_pause = 60   # How long between updates in seconds
-resolution_window = 2   # Round up in minutes for task execution times, eg, 15 means tasks executed every 15 minutes
+from datetime import datetime, timedelta, timezone
+
+tag_update_pause = int(os.environ.get('tag_update_pause', 60))   # Shortest pause in seconds between full refreshes
+max_refresh_pause = int(os.environ.get('max_refresh_pause', 900))   # Longest pause in seconds between full refreshes
+refresh_cost_factor = float(os.environ.get('refresh_cost_factor', 4))   # Pause between full refreshes as a multiple of their measured duration
+cost_smoothing = 0.3   # Weight of the latest refresh duration in the measured refresh cost
+hot_window = int(os.environ.get('hot_window', 300))   # Longest lead in seconds before an action its VM is revalidated at, 0 disables revalidation
+hot_pause = 15   # Seconds between checks for VMs about to fire
+cold_refresh_interval = int(os.environ.get('cold_refresh_interval', 900))   # Seconds a full refresh reuses the metadata of a VM with no action due within them, 0 fetches every VM
+incremental_refresh = os.environ.get('incremental_refresh', 'false').lower() == 'true'   # Re-fetch only the VMs named by the audit trail between full rescans
+incremental_pause = int(os.environ.get('incremental_pause', 15))   # Seconds between incremental refreshes
+full_rescan_interval = int(os.environ.get('full_rescan_interval', 3600))   # Seconds between full rescans in incremental mode
+audit_overlap = 60   # Seconds each audit trail read reaches back before its watermark, for events recorded late
+audit_batch = 16   # Changed VMs or vApps queried per discovery query
+max_sleep = 60   # Longest sleep in seconds of the scheduling loop, bounds the reaction to wall clock adjustments
+loop_error_pause = 15   # Seconds the refresh or schedule loop of a site pauses after an unexpected error
+late_tolerance = 60   # Actions firing later than this many seconds are reported as late
+catch_up_policy = os.environ.get('catch_up_policy', 'fire')   # fire: late actions still fire within catch_up_window, skip: late actions are skipped
+catch_up_window = int(os.environ.get('catch_up_window', 15))   # Minutes a late action may still fire with the fire policy
+discovery_mode = os.environ.get('discovery_mode', 'metadata')   # metadata: one metadata GET per VM, query: tags returned inline in the VM query
+query_fields = ['name', 'status', 'container', 'vdc', 'isVAppTemplate', 'isInMaintenanceMode', 'isExpired']   # VM record fields used by the scheduler
+discovery_filter = 'isVAppTemplate==false;isInMaintenanceMode==false;isExpired==false'   # VMs never scheduled are dropped by the server
+metadata_workers = int(os.environ.get('metadata_workers', 16))   # Concurrent metadata requests during a tag refresh, 1 fetches serially
+query_workers = int(os.environ.get('query_workers', 4))   # Concurrent query pages fetched once the first page reveals the total, 1 fetches in order
+action_workers = int(os.environ.get('action_workers', 16))   # Concurrent power actions, 1 executes serially
+vapp_coalescing = os.environ.get('vapp_coalescing', 'true').lower() == 'true'   # One vApp power action when all its VMs share the due action
+action_retries = int(os.environ.get('action_retries', 2))   # Further attempts of a power action whose call failed, 0 never retries
+action_retry_delay = int(os.environ.get('action_retry_delay', 60))   # Seconds before the first retry of a failed power action, each further retry waits one more delay
+power_on_rate = float(os.environ.get('power_on_rate', 0))   # Power-ons admitted per second once power_on_burst is spent, 0 does not ramp
+power_on_burst = int(os.environ.get('power_on_burst', 10))   # Power-ons admitted at once before power_on_rate applies
+power_on_vdc_limit = int(os.environ.get('power_on_vdc_limit', 0))   # VMs powering on at once per VDC until their task finishes, 0 is unlimited
+power_on_vapp_limit = int(os.environ.get('power_on_vapp_limit', 0))   # VMs powering on at once per vApp until their task finishes, 0 is unlimited
+shard_lease_path = os.environ.get('shard_lease_path')   # SQLite lease database shared by the replicas, unset runs a single unsharded replica
+snapshot_dir = os.environ.get('snapshot_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots'))   # Where the tag inventory is persisted for warm restarts
+snapshot_max_age = 7 * 24 * 3600   # Snapshots older than this many seconds are ignored at startup
+replica_id = os.environ.get('replica_id', f'{socket.gethostname()}-{os.getpid()}')   # Identity of this replica on the shard ring
+
+profile_cycles = int(os.environ.get('profile_cycles', 3))   # Refresh and action cycles profiled after each SIGUSR2
+profile_on_start = os.environ.get('profile_on_start', 'false').lower() == 'true'   # Also profile the first profile_cycles cycles after startup
+metrics_port = int(os.environ.get('metrics_port', 8000))   # Port of the Prometheus /metrics endpoint, 0 disables it
+
+refresh_seconds = metrics.Histogram('vmscheduler_refresh_seconds', 'Duration of a tag inventory refresh', ('site', 'mode'))
+inventory_vms = metrics.Gauge('vmscheduler_inventory_vms', 'Virtual Machines returned by the last refresh', ('site',))
+inventory_tags = metrics.Gauge('vmscheduler_inventory_tags', 'Tags found by the last refresh', ('site',))
+cycle_actions = metrics.Histogram('vmscheduler_cycle_actions', 'Actions dispatched per cycle', ('site',), buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+action_lateness_seconds = metrics.Histogram('vmscheduler_action_lateness_seconds', 'Delay between the scheduled time of an action and its dispatch', ('site',), buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900))
+loop_heartbeat = metrics.Gauge('vmscheduler_loop_heartbeat_timestamp_seconds', 'Epoch time the refresh or schedule loop of a site last completed a cycle', ('site', 'loop'))
+loop_errors_total = metrics.Counter('vmscheduler_loop_errors_total', 'Unexpected errors of the refresh or schedule loop of a site', ('site', 'loop'))
+sleep_overshoot_seconds = metrics.Histogram('vmscheduler_sleep_overshoot_seconds', 'Delay between the intended and actual wake up of the scheduling loop', ('site',), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
 
 # configure logging
 logger.config(os.path.basename(__file__))
@@ -30,170 +90,710 @@ class ExitCommand(Exception):
 def signal_handler(signal, frame):
     raise ExitCommand()
 
+def profile_handler(signal, frame):
+    profiling.profiler.arm(profile_cycles)
+
+def load_sites() -> list:
+    """
+    Returns the sites to schedule, eg, ibmcloud_sites='[{"region": "eu-de", "site": "IBM VCFaaS Multitenant - FRA", "orgs": ["my-org"]}]'
+
+    Without ibmcloud_sites the single ibmcloud_region and ibmcloud_vcfaas_site are used. A site
+    without orgs schedules the organisation of its first VDC.
+    """
+
+    if 'ibmcloud_sites' in os.environ:
+        try:
+            configured = json.loads(os.environ['ibmcloud_sites'])
+        except ValueError as e:
+            raise Exception(f'Error: ibmcloud_sites is not valid JSON: {e}')
+    else:
+        if 'ibmcloud_region' not in os.environ:
+            raise Exception('Error: ibmcloud_region environment variable missing.')
+        if 'ibmcloud_vcfaas_site' not in os.environ:
+            raise Exception('Error: ibmcloud_vcfaas_site environment variable missing.')
+        configured = [{'region': os.environ['ibmcloud_region'], 'site': os.environ['ibmcloud_vcfaas_site']}]
+
+    sites = []
+    for site in configured:
+        if site.get('region') not in tags.region_timezones.keys():
+            raise Exception(f'Error: ibmcloud_region {site.get("region")} has no valid timezone.')
+        if not site.get('site'):
+            raise Exception(f'Error: site missing for region {site["region"]}.')
+
+        for org in site.get('orgs') or [None]:
+            sites.append({'region': site['region'], 'site': site['site'], 'org': org})
+
+    return sites
+
 class Environment:
 
-    # Class to handle global environment variables
+    # Class to handle the environment of one Director site and organisation
 
-    def __init__(self):
+    def __init__(self, site: dict):
         # Get environment variables
-        log.info('Retrieving Environment....')
+        log.info(f'Retrieving Environment for {site["site"]}....')
         if 'ibmcloud_api_key' in os.environ:
             self.ibmcloud_api_key = os.environ['ibmcloud_api_key']
         else:
             raise Exception('Error: ibmcloud_api_key environment variable missing.')
 
-        if 'ibmcloud_region' in os.environ:
-            self.ibmcloud_region = os.environ['ibmcloud_region']
-            if self.ibmcloud_region not in tags.region_timezones.keys():
-                raise Exception(f'Error: ibmcloud_region {self.ibmcloud_region} has no valid timezone.')
-        else:
-            raise Exception('Error: ibmcloud_region environment variable missing.')
+        self.ibmcloud_region = site['region']
+        self.ibmcloud_vcfaas_site = site['site']
 
-        if 'ibmcloud_vcfaas_site' in os.environ:
-            self.ibmcloud_vcfaas_site = os.environ['ibmcloud_vcfaas_site']
-        else:
-            raise Exception('Error: ibmcloud_vcfaas_site environment variable missing.')
-        
-        # Get IBM Cloud Session Token
-        ibm_iam_access_token = iam.request_ibm_iam_access_token(
-            ibm_api_key=self.ibmcloud_api_key
-        )
+        # Cache the IBM Cloud and VMware tokens, refreshed in the background before they expire
+        self.credentials = credentials.CredentialManager(ibmcloud_api_key=self.ibmcloud_api_key)
+        ibm_iam_access_token = self.credentials.iam_access_token()
 
         # Get director site
         director_sites = vcfass.list_director_sites(
             ibm_iam_access_token=ibm_iam_access_token, region=self.ibmcloud_region
         )['director_sites']
 
-        director_site = [d for d in director_sites if d.get('name') == self.ibmcloud_vcfaas_site][0]
+        director_site = [d for d in director_sites if d.get('name') == self.ibmcloud_vcfaas_site]
         if not director_site:
             raise Exception(f'ERROR: Site not found: {self.ibmcloud_vcfaas_site}')
+        director_site = director_site[0]
 
         # Get Director URL for the Site
         # Note: We assume we have at least 1 VDC which is always the case for multi-tenant sites
 
         vdcs = vcfass.list_vcfaas_vdcs(region = self.ibmcloud_region,ibm_iam_access_token=ibm_iam_access_token)['vdcs']
-        vdc =  [v for v in vdcs if v['director_site']['id'] == director_site["id"]][0]
+        vdcs = [v for v in vdcs if v['director_site']['id'] == director_site["id"]]
+        if site['org'] is not None:
+            vdcs = [v for v in vdcs if v['org_name'] == site['org']]
+            if not vdcs:
+                raise Exception(f'ERROR: No VDC of organisation {site["org"]} on site {self.ibmcloud_vcfaas_site}')
+        vdc = vdcs[0]
         self.director_url = urlparse(vdc['director_site']['url']).scheme + "://" + urlparse(vdc['director_site']['url']).netloc
-        org = vdc['org_name']
+        self.org = vdc['org_name']
+        self.name = f'{self.ibmcloud_vcfaas_site}/{self.org}'
 
         # Get VMware Access Token
-        self.vmware_access_token = vcfass.get_vmware_access_token(
-                                        ibm_iam_access_token = ibm_iam_access_token, 
-                                        url = self.director_url,
-                                        org = org)
-        
+        self.credentials.configure_director(director_url = self.director_url, org = self.org)
+        self.credentials.vmware_access_token()
+        self.credentials.start()
+
+    @property
+    def vmware_access_token(self) -> str:
+        return self.credentials.vmware_access_token()
+
+    def rehydrate(self, error: requests.exceptions.HTTPError):
+        """
+        Discard the token rejected with a 401, the next caller re-authenticates
+        """
+
+        log.info('Rehydrating tokens')
+        self.credentials.invalidate(credentials.request_token(error.request))
+
     def dump(self):
         log.info(f'ibmcloud_region: {self.ibmcloud_region}')
         log.info(f'ibmcloud_vcfaas_site: {self.ibmcloud_vcfaas_site}')
+        log.info(f'org: {self.org}')
         log.info(f'director_url: {self.director_url}')
         log.info(f'ibmcloud_api_key: <<Secret>>')
         log.info(f'ibm_api_key: <<Secret>>')
         log.info(f'vmware_access_token: <<Secret>>')
 
-def vm_tag_update(ns, vm_tags_lock, env_lock):
+def skip_vm(vm) -> bool:
+    """
+    Returns true if the Virtual Machine is not eligible for scheduling
 
-    # Configuration update thread to update the Virtual Machine Metadata
+    The discovery query already filters these out server side, a flag missing
+    from a projected record counts as false
+    """
 
-    while True:
-        log.info(f'----- Refreshing Virtual Machine Tags -------')
+    if vm.get("isVAppTemplate", False):
+        log.debug(f'Skipped {vm["name"]} - VM is a VAPPTemplate')
+        return True
 
-        vm_tags = []
+    if vm.get("isInMaintenanceMode", False):
+        log.debug(f'Skipped {vm["name"]} - VM in maintenance mode')
+        return True
 
-        # Query all Virtual Machines
+    if vm.get("isExpired", False):
+        log.debug(f'Skipped {vm["name"]} - VM has expired')
+        return True
 
-        try:
-            log.info(f'Query all  Virtual Machines')
-            filter = ""
-            query_vms =  cloud_director.query_vm(director_url = ns.env.director_url, 
-                                                vmware_access_token = ns.env.vmware_access_token, 
-                                                filter = filter)
-
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 401:
-                log.error(e)
-                log.info('Rehydrating tokens')
-                with env_lock:
-                    ns.env = Environment()
-            else:
-                log.error(f'Failed to query Virtual Machines')
-                log.error(e)
-            continue
+    return False
 
-        except Exception as e:
-            log.error(f"Failed to query Virtual Machines")
+def get_vm_tags(ns, vm) -> Optional[list]:
+    """
+    Retrieve the metadata of a Virtual Machine and convert it into tags
+
+    Returns None if the metadata could not be retrieved
+    """
+
+    vm_metadata = []
+
+    try:
+        with tracing.span('metadata_fetch', href = vm["href"]):
+            metadata = ns.metadata_cache.get_vm_metadata(href = vm["href"], vmware_access_token = ns.env.vmware_access_token)
+
+        order = tags.boot_order(metadata["metadataEntry"], vm)
+        for metadata_entry in metadata["metadataEntry"]:
+            tag = tags.metadata_to_tag(metadata_entry, vm, order)
+
+            if tag is not None:
+                vm_metadata.append(tag)
+
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 401:
             log.error(e)
-            continue
+            ns.env.rehydrate(e)
+        else:
+            log.error(f'Failed to query Virtual Machine Metadata')
+            log.error(e)
+        return None
 
-        # Get metadata for all Relevant Virtual Machines
+    except Exception as e:
+        log.error(f"Failed to query Virtual Machine Metadata")
+        log.error(e)
+        return None
 
-        vm_metadata = []
-        log.info(f'Query Virtual Machines Metadata')
-        for vm in query_vms:
+    return vm_metadata
+
+def reusable(vm, vm_tags) -> bool:
+    """
+    Returns true if the tags of a Virtual Machine still match its queried record, ie, it was not renamed or moved
+    """
+
+    return all(tag.name == vm["name"] and tag.vapp_href == vm.get("container") and tag.vdc == vm.get("vdc") for tag in vm_tags)
+
+def discover_tags(ns, query_vms, reuse: frozenset = frozenset()) -> tuple[tag_store.TagStore, set, int, set]:
+    """
+    Collect the tags of the relevant Virtual Machines of a query, processing each query page as it arrives
+
+    A Virtual Machine whose metadata could not be retrieved keeps its tags of the published inventory, as
+    does one in reuse whose record is unchanged, without retrieving its metadata.
 
-            if vm["isVAppTemplate"]:
-                log.debug(f'Skipped {vm["name"]} - VM is a VAPPTemplate')
+    Returns the tags, the hrefs of the relevant Virtual Machines, the number of Virtual Machines queried
+    and the hrefs of the Virtual Machines whose metadata could not be retrieved
+    """
+
+    vm_metadata = tag_store.TagStore()
+    relevant_hrefs = set()
+    failed_hrefs = set()
+    vm_count = 0
+
+    # Get metadata for all Relevant Virtual Machines, fanned out over a bounded worker pool
+
+    with ThreadPoolExecutor(max_workers=metadata_workers) as executor:
+        futures = []
+        for vm in query_vms:
+            vm_count += 1
+            if skip_vm(vm):
                 continue
 
-            if vm["isInMaintenanceMode"]:
-                log.debug(f'Skipped {vm["name"]} - VM in maintenance mode')
+            if ns.shard is not None and not ns.shard.owns(vm["href"], vm.get("container")):
                 continue
 
-            if vm["isExpired"]:
-                log.debug(f'Skipped {vm["name"]} - VM has expired')
-                continue       
+            relevant_hrefs.add(vm["href"])
+            if discovery_mode == 'query':
+                # Tags were returned inline with the Virtual Machine record
+                for tag in tags.record_to_tags(vm):
+                    vm_metadata.add(tag)
+            elif vm["href"] in reuse and reusable(vm, ns.inventory.tags.for_vm(vm["href"])):
+                for tag in ns.inventory.tags.for_vm(vm["href"]):
+                    vm_metadata.add(tag)
+            else:
+                futures.append((vm["href"], tracing.submit(executor, get_vm_tags, ns, vm)))
 
-            try:
-                filter = ""
-                metadata = cloud_director.get_vm_metadata(href = vm["href"], vmware_access_token = ns.env.vmware_access_token)
+        for href, future in futures:
+            vm_tags = future.result()
+            if vm_tags is None:
+                failed_hrefs.add(href)
+                vm_tags = ns.inventory.tags.for_vm(href)
+            else:
+                ns.metadata_fetched[href] = time.monotonic()
+            for tag in vm_tags:
+                vm_metadata.add(tag)
+
+    return vm_metadata, relevant_hrefs, vm_count, failed_hrefs
+
+def due_vms(ns, now: datetime, seconds: float) -> set:
+    """
+    Returns the Virtual Machines of the published inventory with an action due within some seconds
+    """
+
+    horizon = now + timedelta(seconds=seconds)
+    inventory = ns.inventory.tags
+    return {tag.vm_href for cron in inventory.crons() if tags.next_exec(cron, now) <= horizon for tag in inventory.for_cron(cron)}
+
+def cold_vms(ns) -> frozenset:
+    """
+    Returns the Virtual Machines whose metadata a full refresh reuses
+
+    These were fetched less than cold_refresh_interval seconds ago and have no action due
+    within it, untagged Virtual Machines included. A late tag edit on one is still seen by
+    the incremental refresh or, for a tagged one, by its revalidation just before it fires.
+    """
+
+    if discovery_mode != 'metadata' or cold_refresh_interval <= 0:
+        return frozenset()
+
+    since = time.monotonic() - cold_refresh_interval
+    due = due_vms(ns, tags.get_now(ns.env.ibmcloud_region), cold_refresh_interval)
+    return frozenset(href for href, fetched in ns.metadata_fetched.items() if fetched > since and href not in due)
+
+def refresh_tags(ns) -> tuple[tag_store.TagStore, int]:
+    """
+    Discover the tags of all relevant Virtual Machines
+
+    Returns the tags and the number of Virtual Machines queried
+    """
+
+    # Only eligible Virtual Machines and only the fields used are returned
+    filter = discovery_filter
+    fields = query_fields + tags.metadata_fields if discovery_mode == 'query' else query_fields
+    query_vms = cloud_director.iter_query_vm(director_url = ns.env.director_url,
+                                             vmware_access_token = ns.env.vmware_access_token,
+                                             filter = filter,
+                                             fields = fields,
+                                             workers = query_workers)
+
+    reuse = cold_vms(ns)
+    vm_metadata, relevant_hrefs, vm_count, _ = discover_tags(ns, query_vms, reuse)
+
+    if discovery_mode == 'metadata':
+
+        # Forget Virtual Machines that disappeared from the query
+
+        ns.metadata_cache.evict(relevant_hrefs)
+        ns.metadata_fetched = {href: fetched for href, fetched in ns.metadata_fetched.items() if href in relevant_hrefs}
+        revalidated, downloaded = ns.metadata_cache.reset_stats()
+        log.info(f'Metadata cache: {revalidated} not modified, {downloaded} downloaded, {len(ns.metadata_cache)} cached, '
+                 f'{len(reuse & relevant_hrefs)} reused without an action due')
+
+    return vm_metadata, vm_count
+
+def audit_timestamp(epoch: float) -> str:
+    """
+    Returns an epoch time in the ISO 8601 format of the audit trail
+    """
+
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+def refetch_tags(ns, vm_hrefs: set, vapp_hrefs: set) -> tuple[tag_store.TagStore, int, set]:
+    """
+    Re-discover some Virtual Machines, and the Virtual Machines of some vApps, in the published inventory
+
+    Their records and tags are re-fetched with the same filter and fields as a
+    full rescan; a Virtual Machine no longer returned, eg, deleted or now in
+    maintenance mode, loses its tags, one whose metadata could not be
+    retrieved keeps them.
+
+    Returns a copy of the published inventory with their tags replaced, the number of Virtual Machines re-fetched
+    and the hrefs of the Virtual Machines whose metadata could not be retrieved
+    """
+
+    # Query the Virtual Machines in batches
+    fields = query_fields + tags.metadata_fields if discovery_mode == 'query' else query_fields
+    filters = []
+    for attribute, hrefs in (('href', sorted(vm_hrefs)), ('container', sorted(vapp_hrefs))):
+        for i in range(0, len(hrefs), audit_batch):
+            filters.append('(' + ','.join(f'{attribute}=={href}' for href in hrefs[i:i + audit_batch]) + f');{discovery_filter}')
+
+    query_vms = (vm for filter in filters
+                    for vm in cloud_director.iter_query_vm(director_url = ns.env.director_url,
+                                                           vmware_access_token = ns.env.vmware_access_token,
+                                                           filter = filter,
+                                                           fields = fields))
+    changed, _, vm_count, failed_hrefs = discover_tags(ns, query_vms)
+
+    # Replace the tags of every named Virtual Machine
+    vm_metadata = tag_store.TagStore(ns.inventory.tags)
+    for tag in list(vm_metadata):
+        if tag.vm_href in vm_hrefs or tag.vapp_href in vapp_hrefs:
+            vm_metadata.discard(tag_store.tag_id(tag))
+    for tag in changed:
+        vm_metadata.add(tag)
+
+    return vm_metadata, vm_count, failed_hrefs
+
+def audit_event_key(event: dict):
+    """
+    Returns the identity of an audit trail event, its eventId or else its timestamp, type and entity
+    """
+
+    return event.get('eventId') or (event.get('timestamp'), event.get('eventType'), (event.get('entity') or {}).get('id'))
+
+def refresh_changed_tags(ns, since: str, seen: frozenset = frozenset()) -> tuple[tag_store.TagStore, int, str, frozenset]:
+    """
+    Re-discover only the Virtual Machines named by audit trail events after a watermark
+
+    The trail is read from audit_overlap seconds before the watermark, so an event recorded late,
+    ie, with an earlier timestamp than one already read, is not missed, and the events already
+    handled, in seen, are skipped. Every other event on a Virtual Machine, or on its vApp, re-fetches
+    its record and tags. The watermark does not advance while a metadata fetch fails, so its events
+    are read again.
+
+    Returns the tags, the number of Virtual Machines re-fetched, the new watermark and the events
+    handled within the overlap before it
+    """
+
+    vm_hrefs = set()
+    vapp_hrefs = set()
+    latest = parse_date(since)
+    read = {}
+    events = cloud_director.iter_audit_trail(director_url = ns.env.director_url,
+                                             vmware_access_token = ns.env.vmware_access_token,
+                                             since = audit_timestamp(latest - audit_overlap))
+    for event in events:
+        key = audit_event_key(event)
+        timestamp = parse_date(event.get('timestamp'))
+        if timestamp is not None:
+            latest = max(latest, timestamp)
+            read[key] = timestamp
+        if key in seen:
+            continue
+
+        href = cloud_director.entity_href(ns.env.director_url, (event.get('entity') or {}).get('id', ''))
+        if href is not None:
+            (vapp_hrefs if '/vapp-' in href else vm_hrefs).add(href)
+
+    # Remember the events the next read overlaps
+    handled = frozenset(key for key, timestamp in read.items() if timestamp >= latest - audit_overlap)
+    watermark = audit_timestamp(latest)
+    if not vm_hrefs and not vapp_hrefs:
+        return ns.inventory.tags, 0, watermark, handled
 
-                for metadata_entry in metadata["metadataEntry"]:
-                    tag = tags.metadata_to_tag(metadata_entry, vm)
+    log.info(f'Audit trail since {since} names {len(vm_hrefs)} Virtual Machines and {len(vapp_hrefs)} vApps')
 
-                    if len(tag) > 0:
-                        vm_metadata.append(tag)
+    vm_metadata, vm_count, failed_hrefs = refetch_tags(ns, vm_hrefs, vapp_hrefs)
+    if failed_hrefs:
+        return vm_metadata, vm_count, since, seen
+    return vm_metadata, vm_count, watermark, handled
+
+def revalidate_lead(ns) -> float:
+    """
+    Returns how many seconds before an action its Virtual Machine is revalidated
+
+    The lead covers one check interval and the measured revalidation time, so the
+    revalidation lands just before the action fires, capped at hot_window.
+    """
+
+    return min(hot_pause + (ns.revalidate_cost if ns.revalidate_cost is not None else hot_pause), hot_window)
+
+def hot_vms(ns, now: datetime) -> dict:
+    """
+    Returns the Virtual Machines with an action due within the revalidation lead that were not revalidated
+    for it yet, with the time of their latest such action
+
+    Cron expressions are evaluated once each through the inventory's cron index.
+    """
+
+    horizon = now + timedelta(seconds=revalidate_lead(ns))
+    inventory = ns.inventory.tags
+    hot = {}
+    for cron in inventory.crons():
+        fire = tags.next_exec(cron, now)
+        if fire > horizon:
+            continue
+
+        for tag in inventory.for_cron(cron):
+            revalidated = ns.revalidated.get(tag.vm_href)
+            if revalidated is None or revalidated < fire:
+                hot[tag.vm_href] = max(hot.get(tag.vm_href, fire), fire)
+
+    return hot
+
+def revalidate_hot(ns):
+    """
+    Re-fetch the tags of the Virtual Machines about to fire so a late edit is still honoured
+    """
+
+    now = tags.get_now(ns.env.ibmcloud_region)
+    ns.revalidated = {href: fire for href, fire in ns.revalidated.items() if fire >= now}
+
+    hot = hot_vms(ns, now)
+    if not hot:
+        return
+
+    start = time.monotonic()
+    with tracing.span('revalidate', site = ns.env.name, vms = len(hot)), requests_session.retry_budget():
+        vm_metadata, vm_count, failed_hrefs = refetch_tags(ns, set(hot), set())
+
+    # A Virtual Machine whose metadata could not be retrieved keeps its tags and is retried on the next check
+    ns.revalidated.update((href, fire) for href, fire in hot.items() if href not in failed_hrefs)
+    publish_tags(ns, vm_metadata)
+
+    elapsed = time.monotonic() - start
+    ns.revalidate_cost = elapsed if ns.revalidate_cost is None else (1 - cost_smoothing) * ns.revalidate_cost + cost_smoothing * elapsed
+    refresh_seconds.observe(elapsed, site=ns.env.name, mode='hot')
+    log.info(f'Revalidated {len(hot) - len(failed_hrefs)} of {len(hot)} Virtual Machines of {ns.env.name} about to fire in {elapsed:.1f} seconds')
+
+def publish_tags(ns, vm_metadata: tag_store.TagStore, reconciled: bool = False):
+    """
+    Publish a changed inventory by swapping the reference, the schedule loop never waits on a refresh
+
+    A reconciled inventory, ie, the result of a full rescan, is saved to the snapshot even when unchanged,
+    so the snapshot age is that of the last full rescan and a steady inventory still warm starts
+    """
+
+    diff = vm_metadata.diff(ns.inventory.tags)
+    changed = bool(diff.added or diff.changed or diff.removed)
+    if changed:
+        ns.inventory = ns.inventory.publish(vm_metadata)
+        ns.vm_tags_changed.set()
+        log.info(f'Tags changed: {len(diff.added)} added, {len(diff.changed)} changed, {len(diff.removed)} removed, published version {ns.inventory.version}')
+    elif not reconciled:
+        return
+
+    # Persist the inventory for a warm restart
+    try:
+        snapshot.save(ns.snapshot_path, vm_metadata)
+    except Exception as e:
+        log.error(f'Failed to save tag snapshot {ns.snapshot_path}')
+        log.error(e)
+
+def shard_changed(ns, version: Optional[int]) -> bool:
+    """
+    Returns true if the shard membership changed since the version of the last full rescan
+    """
+
+    return ns.shard is not None and ns.shard.version != version
+
+def vm_tag_update(ns):
+
+    # Configuration update thread to update the Virtual Machine Metadata. Full refreshes are spaced
+    # by their measured cost, and in between the Virtual Machines about to fire are revalidated.
+
+    ns.metadata_cache = metadata_cache.MetadataCache()
+    ns.audit_watermark = None
+    ns.audit_seen = frozenset()
+    ns.metadata_fetched = {}
+    ns.revalidated = {}
+    ns.refresh_cost = None
+    ns.revalidate_cost = None
+    last_full_rescan = None
+    shard_version = None
+
+    while True:
+        try:
+            log.info(f'----- Refreshing Virtual Machine Tags ({ns.env.name}) -------')
+
+            # A membership change moves Virtual Machines between shards, which only a full rescan picks up
+            refresh_start = time.monotonic()
+            full = (not incremental_refresh or ns.audit_watermark is None or shard_changed(ns, shard_version)
+                    or refresh_start - last_full_rescan >= max(full_rescan_interval, refresh_cost_factor * ns.refresh_cost))
+            if full and ns.shard is not None:
+                shard_version = ns.shard.version
+
+            # Query all Virtual Machines and their tags
+
+            try:
+                with profiling.profiler.cycle('refresh'), tracing.span('refresh', site = ns.env.name, full = full), requests_session.retry_budget():
+                    if full:
+                        log.info(f'Query all  Virtual Machines with {query_workers} page workers and {metadata_workers} metadata workers')
+                        watermark, seen = audit_timestamp(time.time()), frozenset()
+                        vm_metadata, vm_count = refresh_tags(ns)
+                    else:
+                        vm_metadata, vm_count, watermark, seen = refresh_changed_tags(ns, ns.audit_watermark, ns.audit_seen)
 
             except requests.exceptions.HTTPError as e:
                 if e.response.status_code == 401:
                     log.error(e)
-                    log.info('Rehydrating tokens')
-                    with env_lock:
-                        ns.env = Environment()
+                    ns.env.rehydrate(e)
                 else:
-                    log.error(f'Failed to query Virtual Machine Metadata')
+                    log.error(f'Failed to query Virtual Machines')
                     log.error(e)
+                    # Fall back to a full rescan, eg, when the audit trail cannot be read
+                    ns.audit_watermark = None
                 continue
 
             except Exception as e:
-                log.error(f"Failed to query Virtual Machine Metadata")
+                log.error(f"Failed to query Virtual Machines")
                 log.error(e)
+                ns.audit_watermark = None
                 continue
 
-        with vm_tags_lock:
-            ns.vm_tags = vm_metadata
+            ns.audit_watermark, ns.audit_seen = watermark, seen
+            publish_tags(ns, vm_metadata, reconciled=full)
+
+            refresh_time = time.monotonic() - refresh_start
+            refresh_seconds.observe(refresh_time, site=ns.env.name, mode='full' if full else 'incremental')
+            inventory_tags.set(len(vm_metadata), site=ns.env.name)
+            if full:
+                last_full_rescan = refresh_start
+                ns.refresh_cost = refresh_time if ns.refresh_cost is None else (1 - cost_smoothing) * ns.refresh_cost + cost_smoothing * refresh_time
+                inventory_vms.set(vm_count, site=ns.env.name)
+                log.info(f'Refreshed {len(vm_metadata)} tags from {vm_count} Virtual Machines of {ns.env.name} in {refresh_time:.1f} seconds')
+            else:
+                log.info(f'Refreshed {len(vm_metadata)} tags re-fetching {vm_count} changed Virtual Machines of {ns.env.name} in {refresh_time:.1f} seconds')
+
+            # Space full refreshes by their cost so a large inventory is not rescanned back to back
+            if incremental_refresh:
+                pause = incremental_pause
+            else:
+                pause = min(max(tag_update_pause, refresh_cost_factor * ns.refresh_cost), max_refresh_pause)
+                log.info(f'Next full refresh of {ns.env.name} in {pause:.0f} seconds')
+
+            # Until then, revalidate the Virtual Machines about to fire just before they do
+            next_refresh = refresh_start + pause
+            while time.monotonic() < next_refresh and not shard_changed(ns, shard_version):
+                try:
+                    revalidate_hot(ns)
+                except requests.exceptions.HTTPError as e:
+                    log.error(f'Failed to revalidate Virtual Machines')
+                    log.error(e)
+                    if e.response is not None and e.response.status_code == 401:
+                        ns.env.rehydrate(e)
+                except Exception as e:
+                    log.error(f'Failed to revalidate Virtual Machines')
+                    log.error(e)
+
+                loop_heartbeat.set(time.time(), site=ns.env.name, loop='refresh')
+                time.sleep(max(min(hot_pause, next_refresh - time.monotonic()), 0))
 
-        time.sleep(tag_update_pause)
+        except Exception as e:
+            # Keep refreshing, a failed cycle shows as a stale heartbeat
+            log.error(f'Unexpected error in the refresh loop of {ns.env.name}, resuming in {loop_error_pause} seconds')
+            log.exception(e)
+            loop_errors_total.inc(site=ns.env.name, loop='refresh')
+            ns.audit_watermark = None
+            time.sleep(loop_error_pause)
 
     # os.kill(os.getpid(), signal.SIGUSR1)
 
-def round_up(time: datetime, resolution):
+def still_scheduled(ns, tag) -> bool:
     """
-    Round up the time in minutes to the resolution
+    Returns true if a tag is still published unchanged and its Virtual Machine is still owned by this replica
     """
 
-    new_minute = ((time.minute // resolution) + 1 ) * resolution
-    minute_delta = new_minute - time.minute
-    new_time = time + timedelta(minutes = minute_delta)
-    return new_time.replace(second=0, microsecond=0)
+    current = ns.inventory.tags.get(tag["vm_href"], tag["key"])
+    if current is None or current["value"] != tag["value"]:
+        return False
+
+    return ns.shard is None or ns.shard.owns(tag["vm_href"], tag.get("vapp_href"))
 
-def round_down(time: datetime, resolution):
+def admission_controller(site: str):
     """
-    Round down the time in minutes to the resolution
+    Returns the power-on admission controller of a site, None if no power_on limit is set
     """
 
-    new_minute = ((time.minute // resolution)) * resolution
-    minute_delta = time.minute - new_minute
-    new_time = time - timedelta(minutes = minute_delta)
-    return new_time.replace(second=0, microsecond=0)
+    if not (power_on_rate or power_on_vdc_limit or power_on_vapp_limit):
+        return None
+
+    return AdmissionController(rate=power_on_rate, burst=power_on_burst, vdc_limit=power_on_vdc_limit,
+                               vapp_limit=power_on_vapp_limit, site=site)
+
+def schedule_loop(ns):
+
+    # Scheduling loop of a site, ticking when the next action is due or the tags change.
+    # Due actions are handed to the executor so a long batch never delays the next tick.
+
+    engine = ScheduleEngine()
+    tracker = TaskTracker(ns.env)
+    executor = ActionExecutor(workers=action_workers, coalesce_vapps=vapp_coalescing, admission=admission_controller(ns.env.name),
+                              tracker=tracker)
+    retry_queue = RetryQueue(retries=action_retries, delay=action_retry_delay)
+    window = catch_up_window * 60 if catch_up_policy == 'fire' else late_tolerance
+    version = None
+
+    def dispatch(actions: list, attempt: int):
+        # Follow the returned VCD tasks until the Virtual Machines reach their target state,
+        # and queue the actions whose call failed for another attempt
+        cycle = time.time()
+
+        def finished(results):
+            tracker.track(cycle, results)
+            retry_queue.add(results, attempt)
+
+        executor.dispatch(ns.env, actions, finished)
+
+    while True:
+        try:
+            log.info(f'----- Start main processing loop ({ns.env.name}) -------')
+
+            now = tags.get_now(ns.env.ibmcloud_region)
+
+            # Reschedule new and changed tags of a newly published inventory
+            ns.vm_tags_changed.clear()
+            inventory = ns.inventory
+            if inventory.version != version:
+                engine.update(inventory.tags, now)
+                version = inventory.version
+
+            # Dispatch due actions, only acting on Virtual Machines this replica still owns
+            fires = engine.pop_due(now)
+            for fire in fires:
+                action_lateness_seconds.observe((now - fire.fire_time).total_seconds(), site=ns.env.name)
+            actions = catch_up(fires, now, window, late_tolerance)
+            if ns.shard is not None:
+                actions = [action for action in actions if ns.shard.owns(action["vm_href"], action.get("vapp_href"))]
+            if actions:
+                cycle_actions.observe(len(actions), site=ns.env.name)
+                log.info(f'Executing {len(actions)} actions on {ns.env.name} with {action_workers} workers')
+                dispatch(actions, 0)
+
+            # Retry the failed actions whose delay passed, unless their tag changed since
+            for attempt, retried in retry_queue.pop_due(time.monotonic()).items():
+                retried = [tag for tag in retried if still_scheduled(ns, tag)]
+                if retried:
+                    log.info(f'Retrying {len(retried)} failed actions on {ns.env.name}, attempt {attempt + 1}')
+                    dispatch(retried, attempt)
+            loop_heartbeat.set(time.time(), site=ns.env.name, loop='schedule')
+
+            # Sleep on the monotonic clock until the next action or retry is due, waking at least every
+            # max_sleep seconds to notice wall clock adjustments
+            now = tags.get_now(ns.env.ibmcloud_region)
+            next = engine.next_fire()
+            retry_wait = retry_queue.next_due(time.monotonic())
+            if next is None and retry_wait is None:
+                log.info(f'No actions scheduled on {ns.env.name}, sleeping until the tags change')
+                ns.vm_tags_changed.wait(max_sleep)
+            else:
+                sleep_time = min(max((next - now).total_seconds(), 0), max_sleep) if next is not None else max_sleep
+                if retry_wait is not None:
+                    sleep_time = min(sleep_time, retry_wait)
+                if next is None:
+                    log.info(f'Next retry on {ns.env.name} due in {retry_wait:.0f} seconds, sleeping for {sleep_time:.0f} seconds')
+                else:
+                    log.info(f'Next action on {ns.env.name} due at {next}, sleeping for {sleep_time:.0f} seconds')
+                deadline = time.monotonic() + sleep_time
+                while not ns.vm_tags_changed.is_set() and time.monotonic() < deadline:
+                    ns.vm_tags_changed.wait(deadline - time.monotonic())
+                if not ns.vm_tags_changed.is_set():
+                    sleep_overshoot_seconds.observe(time.monotonic() - deadline, site=ns.env.name)
+
+        except Exception as e:
+            # Keep scheduling, a failed cycle shows as a stale heartbeat
+            log.error(f'Unexpected error in the schedule loop of {ns.env.name}, resuming in {loop_error_pause} seconds')
+            log.exception(e)
+            loop_errors_total.inc(site=ns.env.name, loop='schedule')
+            time.sleep(loop_error_pause)
+
+def run_site(site: dict, shard):
+
+    # Site thread, each site has its own tokens, refresh thread and action executor
+
+    while True:
+        try:
+            env = Environment(site)
+            break
+        except Exception as e:
+            log.error(f'Failed to initialise site {site["site"]}, retrying in {tag_update_pause} seconds')
+            log.error(e)
+            time.sleep(tag_update_pause)
+
+    # Initialise environment
+    ns = SimpleNamespace()
+    ns.env = env
+    ns.env.dump()
+    ns.shard = shard
+
+    # Initialise the Virtual Machine Metadata tags from the last snapshot, the first refresh reconciles them
+    ns.snapshot_path = snapshot.snapshot_path(snapshot_dir, ns.env.name, shard.replica if shard is not None else None)
+    ns.inventory = tag_store.Inventory(version=0, tags=snapshot.load(ns.snapshot_path, max_age=snapshot_max_age).freeze(), published=time.time())
+
+    # Signal the schedule loop when a new inventory is published
+    ns.vm_tags_changed = threading.Event()
+
+    # Spawn the VDC Update Thread
+    vm_tag_update_thread = threading.Thread(target=vm_tag_update, args=(ns,), daemon=True)
+    vm_tag_update_thread.start()
+
+    schedule_loop(ns)
 
 def main() -> int:
 
@@ -206,98 +806,44 @@ def main() -> int:
     
 
     # Check vars
-    if resolution_window > 60:
-        log.error('ERROR - Resolution window must be between 0-60')
+    if discovery_mode not in ['metadata', 'query']:
+        log.error('ERROR - Discovery mode must be metadata or query')
         exit()
-    elif (60 % resolution_window) != 0:
-        log.error('ERROR - Resolution window must be a factor of 60')
+    elif catch_up_policy not in ['fire', 'skip']:
+        log.error('ERROR - Catch up policy must be fire or skip')
         exit()
 
-    # Register signal handler
-    signal.signal(signal.SIGUSR1, signal_handler)
+    sites = load_sites()
 
-    # Initialise environment
-    ns = SimpleNamespace()
-    ns.env = Environment()
-    ns.env.dump()
+    # Export the scheduler metrics
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
 
-    # Initialise the Virtual Machine Metadata tags
-    ns.vm_tags = []
+    # Register signal handlers, SIGUSR2 profiles the next cycles
+    signal.signal(signal.SIGUSR1, signal_handler)
+    signal.signal(signal.SIGUSR2, profile_handler)
+    if profile_on_start:
+        profiling.profiler.arm(profile_cycles)
 
-    # Create locks 
-    vm_tags_lock = threading.Lock()
-    env_lock = threading.Lock()
+    # Join the other replicas, each replica refreshes and acts on its own shard of the Virtual Machines
+    shard = None
+    if shard_lease_path:
+        shard = ShardCoordinator(SqliteLeaseBackend(shard_lease_path, ttl=tag_update_pause), replica_id)
+        log.info(f'Running as replica {replica_id} with leases in {shard_lease_path}')
 
-    # Spawn the VDC Update Thread
-    vm_tag_update_thread = threading.Thread(target=vm_tag_update, args=(ns, vm_tags_lock, env_lock))
-    vm_tag_update_thread.start()
+    # Spawn one thread per site and organisation so a slow site cannot delay the others
+    for site in sites:
+        site_thread = threading.Thread(target=run_site, args=(site, shard), name=f'{site["region"]}/{site["site"]}', daemon=True)
+        site_thread.start()
 
     # Main loop
     try:
-        actions = {}
         while True:
-            log.info(f'----- Start main processing loop -------')
-
-            actions = []
-            now = round_down(tags.get_now(ns.env.ibmcloud_region), resolution_window)
-
-            # Build current actions list
-            with vm_tags_lock:
-                for tag in ns.vm_tags:
-                    next = tags.next_exec(tag["value"], now)
-                    delta = next - now
-                    if (next != now):
-                        if (now + timedelta(minutes = resolution_window)) >= next:
-                            actions.append(tag)
-
-            # Sleep to the end of the cycle
-            now = tags.get_now(ns.env.ibmcloud_region)
-            sleep_time = round_up(now, resolution_window) - now
-            log.info(f'Number of Actions registered after next sleep - {len(actions)}')
-            log.info(f'Sleeping for {sleep_time.seconds} seconds')
-            time.sleep(sleep_time.seconds)
-
-            # Rehydrate access tokens just in case
-            log.info(f'Preparing to execute actions...')
-            with env_lock:
-                ns.env = Environment()
-
-            # Run through actions list
-            log.info(f'Executing {len(actions)} actions')
-            for action in actions:
-                try:
-                    log.info(f'Processing Actions:')
-                    log.info(f'    Name: {action["name"]}')
-                    log.info(f'    Key: {action["key"]}')
-                    log.info(f'    Value: {action["value"]}')
-                    log.info(f'    href: {action["vm_href"]}')
-
-                    #Get current status
-                    filter = f'name=={action["name"]}'
-                    query_vms =  cloud_director.query_vm(director_url = ns.env.director_url, 
-                                                        vmware_access_token = ns.env.vmware_access_token, 
-                                                        filter = filter)
-                    status = query_vms[0]["status"]
-            
-                    if action["key"] == 'ibm.manage.up':
-                        if status == 'POWERED_ON':
-                            log.info(f'WARNING: Virtual Machine: {action["name"]} was already powered on')
-                        else:
-                            log.info(f'Powering on Virtual Machine: {action["name"]}')
-                            task = cloud_director.powerOn(action["vm_href"], ns.env.vmware_access_token)
-                    elif action["key"]== 'ibm.manage.down':
-                        if status == 'POWERED_OFF':
-                            log.info(f'WARNING: Virtual Machine: {action["name"]} was already powered off')
-                        else:
-                            log.info(f'Powering off Virtual Machine: {action["name"]}')
-                            task = cloud_director.powerOff(action["vm_href"], ns.env.vmware_access_token)
-                except Exception as e:
-                    log.error(f'Failed to execute {action["key"]} on {action["vm_href"]}')
-                    log.error(e)
-                    continue
+            time.sleep(tag_update_pause)
 
     except ExitCommand:
-        pass
+        if shard is not None:
+            shard.stop()
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())